@@ -0,0 +1,481 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Admin tools for the Telegram RPG Adventure Bot
+
+Streams all player records (player:{chat_id}) and save slots
+(saves:{chat_id}:<slot>) to gzip-compressed NDJSON and back, batch by batch, so backups and migrations between Redis instances do
+not load everything into memory or block the live bot.
+
+The broadcast command sends a message to every player through the bot's
+rate-limited sender, checkpointing its SCAN position so an interrupted
+broadcast resumes where it stopped.
+
+The report command combines the analytics counters with the story graph:
+which branches players take, where they stop, how many find each item and
+how far they get along a funnel of scenes.
+
+Redis is selected with the same environment variables as the bot
+(REDIS_HOST, REDIS_PORT, REDIS_DB, REDIS_CLUSTER, REDIS_SHARDS) or --url.
+
+Usage:
+python admin.py export players.ndjson.gz [--batch 500] [--rate 0] [--progress 5]
+python admin.py import players.ndjson.gz [--batch 500] [--rate 0] [--progress 5] [--no-overwrite]
+python admin.py report [--story story/story.json] [--funnel scene_a,scene_b,...]
+python admin.py broadcast --text "..." [--job name] [--rate 25] [--workers 4] [--dry-run]
+"""
+
+import argparse
+import gzip
+import hashlib
+import json
+import sys
+import time
+from collections import deque
+
+import threading
+
+import redis
+from telebot.apihelper import ApiTelegramException
+
+import story_graph
+import telegram_rpg_bot as rpg
+
+class Throughput:
+    """Caps the record rate (0 = unlimited) and prints progress (and an ETA if the total is known)"""
+
+    def __init__(self, label, rate=0, progress_every=5, total=None, done=0, unit='players'):
+        self.label = label
+        self.unit = unit
+        self.rate = rate
+        self.progress_every = progress_every
+        self.total = total
+        # Work done by an earlier run that is being resumed counts for progress, not for the rate
+        self.resumed = self.done = done
+        self.started = self.last_report = time.monotonic()
+
+    def add(self, count):
+        self.done += count
+        now = time.monotonic()
+        if self.rate > 0:
+            # Sleep until the records so far fit the allowed rate
+            ahead = (self.done - self.resumed) / self.rate - (now - self.started)
+            if ahead > 0:
+                time.sleep(ahead)
+                now = time.monotonic()
+        if self.progress_every > 0 and now - self.last_report >= self.progress_every:
+            self.last_report = now
+            self.report(now)
+
+    def report(self, now=None):
+        elapsed = (now or time.monotonic()) - self.started
+        rate = (self.done - self.resumed) / elapsed if elapsed > 0 else 0
+        line = f"{self.label}: {self.done} {self.unit} in {elapsed:.1f}s ({rate:.0f}/s)"
+        if self.total:
+            left = max(self.total - self.done, 0)
+            eta = f"{left / rate:.0f}s" if rate > 0 else "?"
+            line += f", {100 * min(self.done, self.total) / self.total:.1f}% of ~{self.total}, ETA {eta}"
+        print(line, file=sys.stderr)
+
+def connect(url=None):
+    """Point the bot's storage layer at the Redis to work with"""
+    if url:
+        rpg.redis_client, rpg.redis_ring = redis.Redis.from_url(url, decode_responses=True), None
+        rpg.redis_client.ping()
+    else:
+        rpg.redis_client, rpg.redis_ring = rpg.connect_redis()
+    if not rpg.redis_client:
+        raise SystemExit("Redis is not available")
+
+def fetch_batch(node, keys):
+    """Read values and remaining TTLs of a batch of keys in one round trip"""
+    pipe = node.pipeline(transaction=False)
+    if rpg.REDIS_CLUSTER:
+        # Player keys hash to different slots, so no multi-key MGET here
+        for key in keys:
+            pipe.get(key)
+    else:
+        pipe.mget(keys)
+    for key in keys:
+        pipe.pttl(key)
+    results = pipe.execute()
+    values = results[:len(keys)] if rpg.REDIS_CLUSTER else results[0]
+    return zip(keys, values, results[-len(keys):])
+
+def export_players(path, batch_size=500, rate=0, progress_every=5):
+    """Write every player record and save slot to a gzip NDJSON file; returns the record count"""
+    throughput = Throughput('Exported', rate, progress_every, unit='records')
+    with gzip.open(path, 'wt', encoding='utf-8') as out:
+        for node in rpg.redis_nodes():
+            # Saves outlive player records, so they are scanned on their own
+            for pattern, write in (('player:*', write_batch), ('saves:*', write_saves_batch)):
+                keys = []
+                for key in node.scan_iter(match=pattern, count=batch_size):
+                    keys.append(key)
+                    if len(keys) >= batch_size:
+                        throughput.add(write(out, node, keys))
+                        keys = []
+                if keys:
+                    throughput.add(write(out, node, keys))
+    throughput.report()
+    return throughput.done
+
+def write_batch(out, node, keys):
+    """Export one batch of keys; returns how many records were written"""
+    records = []
+    for key, value, ttl_ms in fetch_batch(node, keys):
+        if value is None:
+            # Expired between SCAN and GET
+            continue
+        try:
+            state = json.loads(value)
+        except ValueError:
+            print(f"Skipping {key}: not valid JSON", file=sys.stderr)
+            continue
+        record = {'chat_id': rpg.player_key_chat_id(key), 'state': state}
+        if ttl_ms > 0:
+            record['ttl_ms'] = ttl_ms
+        records.append((key, record))
+    # Legacy keys are whole states; current ones are snapshots of the log
+    apply_logs(node, [record for key, record in records if '{' in key])
+    for _, record in records:
+        out.write(json.dumps(record, ensure_ascii=False) + '\n')
+    return len(records)
+
+def apply_logs(node, records):
+    """Bring exported snapshots up to date with the log entries after them (two round trips)"""
+    pipe = node.pipeline(transaction=False)
+    for record in records:
+        pipe.get(rpg.player_key(record['chat_id'], 'snapshotid'))
+    logged = [(record, last_id) for record, last_id in zip(records, pipe.execute()) if last_id]
+    pipe = node.pipeline(transaction=False)
+    for record, last_id in logged:
+        pipe.xrange(rpg.player_key(record['chat_id'], 'events'), min=last_id)
+    for (record, last_id), entries in zip(logged, pipe.execute()):
+        for entry_id, entry in entries:
+            if entry_id != last_id:
+                rpg.apply_stream_entry(record['state'], entry)
+
+def write_saves_batch(out, node, keys):
+    """Export one batch of save slot lists; returns how many records were written"""
+    pipe = node.pipeline(transaction=False)
+    for key in keys:
+        pipe.lrange(key, 0, -1).pttl(key)
+    results = pipe.execute()
+    written = 0
+    for key, checkpoints, ttl_ms in zip(keys, results[::2], results[1::2]):
+        if not checkpoints:
+            # Expired between SCAN and LRANGE
+            continue
+        record = {'chat_id': rpg.key_hash_tag(key), 'slot': int(key.rsplit(':', 1)[1]), 'checkpoints': checkpoints}
+        if ttl_ms > 0:
+            record['ttl_ms'] = ttl_ms
+        out.write(json.dumps(record, ensure_ascii=False) + '\n')
+        written += 1
+    return written
+
+def import_players(path, batch_size=500, rate=0, progress_every=5, overwrite=True):
+    """Load player records and save slots from a gzip NDJSON file; returns the record count"""
+    throughput = Throughput('Imported', rate, progress_every, unit='records')
+    batch = []
+    with gzip.open(path, 'rt', encoding='utf-8') as source:
+        for line_number, line in enumerate(source, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+                if 'checkpoints' in record:
+                    key = rpg.saves_key(record['chat_id'], int(record['slot']))
+                    batch.append((key, record['checkpoints'], record.get('ttl_ms')))
+                else:
+                    batch.append((rpg.player_key(record['chat_id']), record['state'], record.get('ttl_ms')))
+            except (ValueError, KeyError) as e:
+                print(f"Skipping line {line_number}: {e}", file=sys.stderr)
+                continue
+            if len(batch) >= batch_size:
+                throughput.add(store_batch(batch, overwrite))
+                batch = []
+    if batch:
+        throughput.add(store_batch(batch, overwrite))
+    # Running bots drop every cached player state
+    rpg.redis_client.publish(rpg.PLAYER_CACHE_CHANNEL, 'admin *')
+    throughput.report()
+    return throughput.done
+
+# KEYS[1] = save slot list; ARGV = 1 to replace an existing list, TTL in ms, checkpoints...
+# Replaces the list as a whole, so a running bot never sees half of it
+RESTORE_SAVE_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    if ARGV[1] ~= '1' then
+        return 0
+    end
+    redis.call('DEL', KEYS[1])
+end
+redis.call('RPUSH', KEYS[1], unpack(ARGV, 3))
+redis.call('PEXPIRE', KEYS[1], ARGV[2])
+return 1
+"""
+
+def store_batch(batch, overwrite):
+    """Write one batch with a pipeline per Redis node; returns the batch size"""
+    pipes = {}
+    for key, state, ttl_ms in batch:
+        node = rpg.redis_for(key)
+        pipe = pipes.get(id(node))
+        if pipe is None:
+            pipe = pipes[id(node)] = node.pipeline(transaction=False)
+        if key.startswith('saves:'):
+            # Same lifetime the bot gives a fresh save
+            ttl_ms = ttl_ms or rpg.SAVE_TTL_DAYS * 86400 * 1000
+            pipe.eval(RESTORE_SAVE_SCRIPT, 1, key, int(overwrite), ttl_ms, *state)
+            continue
+        value = json.dumps(state, ensure_ascii=False)
+        if ttl_ms:
+            pipe.set(key, value, px=ttl_ms, nx=not overwrite)
+        else:
+            # Same lifetime the bot gives a fresh save
+            pipe.set(key, value, ex=86400, nx=not overwrite)
+        if overwrite:
+            # The imported state is whole: log entries written before do not apply to it
+            pipe.delete(rpg.player_key(rpg.player_key_chat_id(key), 'snapshotid'))
+    for pipe in pipes.values():
+        pipe.execute()
+    return len(batch)
+
+def scan_nodes():
+    """Every Redis server to SCAN for player keys (each Cluster primary separately)"""
+    if rpg.REDIS_CLUSTER:
+        return [rpg.redis_client.get_redis_connection(node) for node in rpg.redis_client.get_primaries()]
+    return rpg.redis_nodes()
+
+def count_players(batch_size):
+    """Count player keys with a SCAN pass (for progress and ETA)"""
+    return sum(1 for node in scan_nodes() for _ in node.scan_iter(match='player:*', count=batch_size))
+
+# 400 descriptions that mean the chat itself is gone; other 400s are about
+# the message (too long, bad entities...) and must not mark anyone blocked
+GONE_CHAT_ERRORS = ('chat not found', 'user is deactivated')
+
+def is_blocked_error(error):
+    """Whether a send error means the player can no longer be reached"""
+    if not isinstance(error, ApiTelegramException):
+        return False
+    if error.error_code == 403:
+        return True
+    description = (error.description or '').lower()
+    return error.error_code == 400 and any(reason in description for reason in GONE_CHAT_ERRORS)
+
+class BroadcastResults:
+    """Counts delivery outcomes reported by the sender threads"""
+
+    def __init__(self, checkpoint):
+        self.counts = {name: int(checkpoint.get(name, 0)) for name in ('sent', 'blocked', 'failed', 'skipped')}
+        self.newly_blocked = []
+        self.lock = threading.Lock()
+
+    def on_done(self, chat_id, result, error):
+        with self.lock:
+            if error is None:
+                self.counts['sent'] += 1
+            elif is_blocked_error(error):
+                # Blocked the bot, deactivated or the chat is gone
+                self.counts['blocked'] += 1
+                self.newly_blocked.append(chat_id)
+            else:
+                self.counts['failed'] += 1
+                print(f"Failed to send to {chat_id}: {error}", file=sys.stderr)
+
+    def total(self):
+        return sum(self.counts.values())
+
+def run_broadcast(text, send, job, batch_size=1000, rate=rpg.SEND_RATE, workers=rpg.SEND_WORKERS, progress_every=5):
+    """
+    Send text to every player in a private chat. Chat ids come from SCAN
+    batches; each batch is sent through a RateLimitedSender and then
+    checkpointed (SCAN cursor and counters in the broadcast:{game}:<job>
+    hash), so a rerun of the same job resumes after the last finished batch.
+    Players who blocked the bot are remembered in blocked:{game} and skipped.
+    Returns the counters.
+    """
+    checkpoint_key = f'broadcast:{{game}}:{job}'
+    checkpoint = rpg.redis_client.hgetall(checkpoint_key)
+    results = BroadcastResults(checkpoint)
+    sender = rpg.RateLimitedSender(send, rate=rate, workers=workers, queue_size=batch_size)
+    throughput = Throughput('Broadcast', 0, progress_every, count_players(batch_size), results.total())
+
+    for index, node in enumerate(scan_nodes()):
+        if checkpoint.get(f'done:{index}'):
+            continue
+        cursor = int(checkpoint.get(f'cursor:{index}', 0))
+        while True:
+            cursor, keys = node.scan(cursor, match='player:*', count=batch_size)
+            # Group members share their chat, which is not messaged once per member
+            chat_ids = [chat_id for chat_id in map(rpg.player_key_chat_id, keys) if not rpg.is_group_player(chat_id)]
+            before = results.total()
+            if chat_ids:
+                blocked = rpg.redis_client.smismember(rpg.BLOCKED_KEY, chat_ids)
+                for chat_id, is_blocked in zip(chat_ids, blocked):
+                    if is_blocked:
+                        results.counts['skipped'] += 1
+                    else:
+                        sender.submit(chat_id, text, on_done=results.on_done)
+                sender.flush(float('inf'))
+
+            pipe = rpg.redis_client.pipeline(transaction=False)
+            if results.newly_blocked:
+                pipe.sadd(rpg.BLOCKED_KEY, *results.newly_blocked)
+                results.newly_blocked = []
+            pipe.hset(checkpoint_key, mapping=dict(results.counts, **{f'cursor:{index}': cursor}))
+            if cursor == 0:
+                pipe.hset(checkpoint_key, f'done:{index}', 1)
+            pipe.execute()
+            throughput.add(results.total() - before)
+            if cursor == 0:
+                break
+
+    sender.close()
+    throughput.report()
+    return results.counts
+
+def percent(part, whole):
+    """Format a share for the report ('-' when there is nothing to compare with)"""
+    return f"{100 * part / whole:.1f}%" if whole else "-"
+
+def shortest_paths(start, edges):
+    """Breadth-first search over the scene graph; returns {scene: previous scene}"""
+    parents = {start: None}
+    queue = deque([start])
+    while queue:
+        scene = queue.popleft()
+        for target in edges.get(scene, {}).values():
+            if target not in parents:
+                parents[target] = scene
+                queue.append(target)
+    return parents
+
+def funnel_steps(funnel, start, parents):
+    """A single target scene expands to the shortest path from the start scene"""
+    if len(funnel) != 1:
+        return funnel
+    path, scene = [], funnel[0]
+    if scene not in parents:
+        return funnel
+    while scene is not None:
+        path.append(scene)
+        scene = parents[scene]
+    return path[::-1]
+
+def analytics_report(story_data, stats, funnel=()):
+    """Render branch shares, per-scene drop-off, item rates and a funnel"""
+    index = story_graph.build_index(story_data)
+    start, edges = story_data['start_scene'], index['edges']
+    parents = shortest_paths(start, edges)
+    players = stats['players']
+    scene_players, visits, edge_counts = stats['scene_players'], stats['scenes'], stats['edges']
+
+    exits = {}
+    for edge, count in edge_counts.items():
+        scene = edge.partition('>')[0]
+        exits[scene] = exits.get(scene, 0) + count
+
+    lines = [f"Story graph version {index['version']}", f"Unique players: {players}", ""]
+
+    start_presses = sum(edge_counts.get(f'{start}>{choice}', 0) for choice in edges[start])
+    lines.append(f"Branches from {start}:")
+    for choice, target in edges[start].items():
+        count = edge_counts.get(f'{start}>{choice}', 0)
+        lines.append(f"  {choice} -> {target}: {count} ({percent(count, start_presses)})")
+    lines.append("")
+
+    lines.append("Scenes (players / visits / left by a button / drop-off / deaths):")
+    # Breadth-first order reads roughly like the story; unreachable scenes last
+    for scene in list(parents) + index['unreachable']:
+        scene_visits = visits.get(scene, 0)
+        left = exits.get(scene, 0)
+        drop_off = percent(max(scene_visits - left, 0), scene_visits)
+        lines.append(
+            f"  {scene}: {scene_players.get(scene, 0)} / {scene_visits} / {left} / {drop_off} / "
+            f"{stats['deaths'].get(scene, 0)}"
+        )
+    lines.append("")
+
+    lines.append("Items found (share of players):")
+    for item in sorted(index['item_paths']):
+        count = stats['items'].get(item, 0)
+        lines.append(f"  {item}: {count} ({percent(count, players)})")
+    lines.append("")
+
+    steps = funnel_steps(list(funnel), start, parents)
+    if steps:
+        lines.append("Funnel (unique players, share of first step / of previous step):")
+        first = previous = None
+        for scene in steps:
+            count = scene_players.get(scene, 0)
+            if first is None:
+                first = previous = count
+            lines.append(f"  {scene}: {count} ({percent(count, first)} / {percent(count, previous)})")
+            previous = count
+        lines.append("")
+    return "\n".join(lines)
+
+def main():
+    parser = argparse.ArgumentParser(description="Admin tools for the RPG bot")
+    parser.add_argument('--url', help="Redis URL (default: the bot's REDIS_* settings)")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    for name, help_text in (('export', "stream all players and saves to a gzip NDJSON file"),
+                            ('import', "load players and saves from a gzip NDJSON file")):
+        command = commands.add_parser(name, help=help_text)
+        command.add_argument('path', help="NDJSON file (.ndjson.gz)")
+        command.add_argument('--batch', type=int, default=500, help="keys per SCAN/pipeline batch")
+        command.add_argument('--rate', type=float, default=0, help="maximum records per second (0 = unlimited)")
+        command.add_argument('--progress', type=float, default=5, help="seconds between progress lines (0 = off)")
+        if name == 'import':
+            command.add_argument('--no-overwrite', action='store_true', help="keep players and save slots that already exist")
+    report = commands.add_parser('report', help="scene funnels, drop-off and item rates")
+    report.add_argument('--story', default=story_graph.DEFAULT_STORY, help="story data the counters refer to")
+    report.add_argument('--funnel', default='', help="comma-separated scenes, or one scene for the shortest path to it")
+    broadcast = commands.add_parser('broadcast', help="send a message to every player")
+    source = broadcast.add_mutually_exclusive_group(required=True)
+    source.add_argument('--text', help="message text")
+    source.add_argument('--text-file', help="file with the message text")
+    broadcast.add_argument('--job', help="job name for resuming (default: derived from the text)")
+    broadcast.add_argument('--batch', type=int, default=1000, help="keys per SCAN batch and checkpoint")
+    broadcast.add_argument('--rate', type=float, default=rpg.SEND_RATE, help="messages per second")
+    broadcast.add_argument('--workers', type=int, default=rpg.SEND_WORKERS, help="concurrent sender threads")
+    broadcast.add_argument('--progress', type=float, default=5, help="seconds between progress lines (0 = off)")
+    broadcast.add_argument('--dry-run', action='store_true', help="walk all players without calling Telegram")
+    args = parser.parse_args()
+
+    connect(args.url)
+    if args.command == 'report':
+        story_data = story_graph.load_story_data(args.story)
+        stats = rpg.read_stats(list(story_data['scenes']))
+        funnel = [scene for scene in args.funnel.split(',') if scene]
+        unknown = [scene for scene in funnel if scene not in story_data['scenes']]
+        if unknown:
+            raise SystemExit(f"Unknown scenes in --funnel: {', '.join(unknown)}")
+        print(analytics_report(story_data, stats, funnel))
+    elif args.command == 'broadcast':
+        if args.text_file:
+            with open(args.text_file, encoding='utf-8') as text_file:
+                text = text_file.read()
+        else:
+            text = args.text
+        job = args.job or hashlib.sha1(text.encode('utf-8')).hexdigest()[:12]
+        if args.dry_run:
+            # Separate checkpoint, so a dry run does not mark the real job as done
+            job, send = f'{job}:dry-run', lambda chat_id, text: None
+        else:
+            send = rpg.bot.send_message
+        counts = run_broadcast(text, send, job, args.batch, args.rate, args.workers, args.progress)
+        print(f"Broadcast {job}: " + ", ".join(f"{name} {count}" for name, count in counts.items()))
+    elif args.command == 'export':
+        count = export_players(args.path, args.batch, args.rate, args.progress)
+        print(f"Exported {count} records (players and save slots) to {args.path}")
+    else:
+        count = import_players(args.path, args.batch, args.rate, args.progress, not args.no_overwrite)
+        print(f"Imported {count} records (players and save slots) from {args.path}")
+
+if __name__ == '__main__':
+    main()
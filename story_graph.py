@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Story graph analyzer for the Telegram RPG Adventure Bot
+
+Reads the story data (story/story.json), extracts the scene/choice graph
+and reports reachability, unreachable scenes, buttons that lead nowhere,
+dead ends, cycles and the shortest path to every item.
+
+It also writes a precomputed index (story_index.json) with the allowed
+(scene, choice) edges; the bot builds the same index when it loads the story.
+
+Usage:
+python story_graph.py [--story story/story.json] [--output story_index.json]
+"""
+
+import argparse
+import hashlib
+import json
+import os
+from collections import deque
+
+DEFAULT_STORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'story', 'story.json')
+DEFAULT_INDEX = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'story_index.json')
+
+def load_story_data(path=DEFAULT_STORY):
+    """Read the raw story data from a JSON file"""
+    with open(path, encoding='utf-8') as story_file:
+        return json.load(story_file)
+
+def scene_buttons(story_data, scene):
+    """Return the keyboard rows of a scene (its own buttons or a shared keyboard)"""
+    if 'buttons' in scene:
+        return scene['buttons']
+    if 'keyboard' in scene:
+        return story_data['keyboards'][scene['keyboard']]
+    return []
+
+def scene_outcomes(scene):
+    """Return the possible outcomes of a scene (both branches for item checks and encounters)"""
+    if 'requires' in scene:
+        return [scene['with_item'], scene['without_item']]
+    if 'encounter' in scene:
+        return [scene['encounter']['win'], scene['encounter']['lose']]
+    return [scene]
+
+def encounter_loot(story_data, scene):
+    """Return the items an encounter scene can drop (from its monsters' loot tables)"""
+    if 'encounter' not in scene:
+        return []
+    monsters = story_data.get('monsters', {}).get(scene['encounter']['monsters'], [])
+    loot_tables = [story_data.get('loot', {}).get(monster.get('loot'), []) for monster in monsters]
+    return list(dict.fromkeys(entry['item'] for table in loot_tables for entry in table if entry.get('item')))
+
+def extract_graph(story_data):
+    """
+    Build the story graph from the story data.
+    Returns a dict with:
+    - start: the scene the game starts in
+    - scenes: {scene: {'choices': [choice, ...], 'items': [item, ...]}}
+    - dispatch: {choice: scene}
+    """
+    scenes = {}
+    for scene_id, scene in story_data['scenes'].items():
+        choices = [button['choice'] for row in scene_buttons(story_data, scene) for button in row]
+        scenes[scene_id] = {
+            # Keep the first occurrence only, buttons may repeat a choice
+            'choices': list(dict.fromkeys(choices)),
+            'items': [outcome['grant'] for outcome in scene_outcomes(scene) if 'grant' in outcome]
+            + encounter_loot(story_data, scene)
+        }
+    return {'start': story_data['start_scene'], 'scenes': scenes, 'dispatch': dict(story_data['choices'])}
+
+def _strongly_connected_components(nodes, successors):
+    """Tarjan's algorithm (iterative); returns components with a cycle"""
+    index_of, lowlink, on_stack = {}, {}, set()
+    stack, components = [], []
+    counter = 0
+
+    for root in nodes:
+        if root in index_of:
+            continue
+        work = [(root, iter(successors.get(root, ())))]
+        index_of[root] = lowlink[root] = counter
+        counter += 1
+        stack.append(root)
+        on_stack.add(root)
+        while work:
+            node, children = work[-1]
+            advanced = False
+            for child in children:
+                if child not in index_of:
+                    index_of[child] = lowlink[child] = counter
+                    counter += 1
+                    stack.append(child)
+                    on_stack.add(child)
+                    work.append((child, iter(successors.get(child, ()))))
+                    advanced = True
+                    break
+                if child in on_stack:
+                    lowlink[node] = min(lowlink[node], index_of[child])
+            if advanced:
+                continue
+            work.pop()
+            if work:
+                parent = work[-1][0]
+                lowlink[parent] = min(lowlink[parent], lowlink[node])
+            if lowlink[node] == index_of[node]:
+                component = []
+                while True:
+                    member = stack.pop()
+                    on_stack.discard(member)
+                    component.append(member)
+                    if member == node:
+                        break
+                if len(component) > 1 or node in successors.get(node, ()):
+                    components.append(sorted(component))
+    return components
+
+def analyze(graph):
+    """
+    Compute reachability, unreachable scenes, dead buttons, dead ends,
+    cycles and the shortest choice path to every item.
+    """
+    start, scenes, dispatch = graph['start'], graph['scenes'], graph['dispatch']
+    edges = {
+        scene: {choice: dispatch[choice] for choice in info['choices'] if dispatch.get(choice) in scenes}
+        for scene, info in scenes.items()
+    }
+
+    # Breadth-first search gives shortest paths from the start scene
+    parents = {start: None}
+    queue = deque([start])
+    while queue:
+        scene = queue.popleft()
+        for choice, target in edges.get(scene, {}).items():
+            if target not in parents:
+                parents[target] = (scene, choice)
+                queue.append(target)
+
+    def path_to(scene):
+        path = []
+        while parents[scene] is not None:
+            scene, choice = parents[scene]
+            path.append(choice)
+        return path[::-1]
+
+    item_paths = {}
+    for scene in sorted(parents, key=lambda s: len(path_to(s))):
+        for item in scenes[scene]['items']:
+            item_paths.setdefault(item, path_to(scene))
+
+    successors = {scene: set(targets.values()) for scene, targets in edges.items()}
+    all_choices = sorted({choice for info in scenes.values() for choice in info['choices']})
+
+    return {
+        'edges': edges,
+        'reachable': sorted(parents),
+        'unreachable': sorted(set(scenes) - set(parents)),
+        'dead_buttons': sorted(choice for choice in all_choices if choice not in dispatch),
+        'dead_ends': sorted(scene for scene in parents if not edges.get(scene)),
+        'cycles': _strongly_connected_components(sorted(parents), successors),
+        'item_paths': item_paths,
+        'choices': all_choices
+    }
+
+def build_index(story_data):
+    """Build the precomputed transition index for the runtime"""
+    report = analyze(extract_graph(story_data))
+    # The version changes whenever the edges or the list of choices change
+    graph_json = json.dumps([report['edges'], report['choices']], sort_keys=True, ensure_ascii=False)
+    report['version'] = hashlib.sha1(graph_json.encode('utf-8')).hexdigest()[:12]
+    return report
+
+def format_report(index):
+    """Render the analysis as human-readable text"""
+    lines = [
+        f"Story graph version {index['version']}",
+        f"Scenes: {len(index['edges'])}, choices: {len(index['choices'])}, "
+        f"reachable scenes: {len(index['reachable'])}",
+        ""
+    ]
+
+    def section(title, values):
+        lines.append(f"{title} ({len(values)}):")
+        lines.extend(f"  - {value}" for value in values)
+        lines.append("")
+
+    section("Unreachable scenes", index['unreachable'])
+    section("Buttons that lead nowhere", index['dead_buttons'])
+    section("Dead ends (no way out)", index['dead_ends'])
+    section("Cycles", [", ".join(component) for component in index['cycles']])
+    section("Shortest path to each item", [
+        f"{item}: {' -> '.join(path) or '(start)'}" for item, path in sorted(index['item_paths'].items())
+    ])
+    return "\n".join(lines)
+
+def main():
+    parser = argparse.ArgumentParser(description="Analyze the story graph of the RPG bot")
+    parser.add_argument('--story', default=DEFAULT_STORY, help="story data to analyze")
+    parser.add_argument('--output', default=DEFAULT_INDEX, help="where to write the precomputed index")
+    args = parser.parse_args()
+
+    index = build_index(load_story_data(args.story))
+    print(format_report(index))
+
+    with open(args.output, 'w', encoding='utf-8') as index_file:
+        json.dump(index, index_file, ensure_ascii=False, indent=2, sort_keys=True)
+    print(f"Index written to {args.output}")
+
+if __name__ == '__main__':
+    main()
@@ -12,1392 +12,3439 @@ Replace 'YOUR_BOT_TOKEN_HERE' with your actual bot token from @BotFather
 """
 
 import telebot
-from telebot import types
+from telebot import apihelper, types
+from telebot.apihelper import ApiTelegramException
+import base64
+import binascii
+import bisect
+import collections
+import contextlib
+import hashlib
+import heapq
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import json
 import os
+import functools
+from queue import Empty, Full, Queue
+import re
+import secrets
+import signal
+import socket
+import string
+import struct
+import threading
+import time
+from types import MappingProxyType
+import zlib
 import redis
 
-# Initialize bot with placeholder token
-BOT_TOKEN = 'YOUR_BOT_TOKEN_HERE'
+import story_graph
+
+# Process start, used to report cold-start time
+STARTED_AT = time.monotonic()
+
+# Initialize bot with placeholder token (or BOT_TOKEN from the environment)
+BOT_TOKEN = os.getenv('BOT_TOKEN', 'YOUR_BOT_TOKEN_HERE')
 bot = telebot.TeleBot(BOT_TOKEN)
 
-# Redis connection for persistent storage
-try:
-    # Try connecting to Redis service (in Docker) or localhost
-    redis_client = redis.Redis(host=os.getenv('REDIS_HOST', 'localhost'), port=6379, db=0, decode_responses=True)
-    # Test connection
-    redis_client.ping()
-    print("Connected to Redis successfully")
-except:
-    # Fallback to in-memory storage if Redis is not available
-    print("Redis not available, using in-memory storage")
-    redis_client = None
+# Port of the health/readiness HTTP endpoint (/healthz, /readyz); 0 disables it
+HEALTH_PORT = int(os.getenv('HEALTH_PORT', '8080'))
+
+# Number of worker processes; 0 or 1 runs everything in a single polling process
+BOT_WORKERS = int(os.getenv('BOT_WORKERS', '0'))
+# Per-worker queue bound, so the polling front slows down when workers fall behind
+WORKER_QUEUE_SIZE = int(os.getenv('WORKER_QUEUE_SIZE', '1000'))
+# A worker that dies sooner than this after its start is not started again: the bot stops
+WORKER_MIN_UPTIME = 10
+
+# How this process runs:
+# - polling: receive and handle updates here (default)
+# - ingest: receive updates and append them to a Redis Stream
+# - stream-worker: consume updates from the Redis Stream
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+UPDATE_STREAM = os.getenv('UPDATE_STREAM', 'updates')
+UPDATE_STREAM_GROUP = os.getenv('UPDATE_STREAM_GROUP', 'bot-workers')
+UPDATE_STREAM_MAXLEN = int(os.getenv('UPDATE_STREAM_MAXLEN', '100000'))
+# Pending entries idle longer than this are taken over from dead consumers
+STREAM_CLAIM_IDLE_MS = int(os.getenv('STREAM_CLAIM_IDLE_MS', '60000'))
+# Entries delivered this many times without success are dropped
+STREAM_MAX_DELIVERIES = int(os.getenv('STREAM_MAX_DELIVERIES', '5'))
+
+# Redis topology for persistent storage:
+# - REDIS_HOST/REDIS_PORT: a single node (default)
+# - REDIS_CLUSTER=1: REDIS_HOST/REDIS_PORT is a seed node of a Redis Cluster
+# - REDIS_SHARDS=host1:port,host2:port: client-side consistent hashing over several nodes
+REDIS_HOST = os.getenv('REDIS_HOST', 'localhost')
+REDIS_PORT = int(os.getenv('REDIS_PORT', '6379'))
+REDIS_DB = int(os.getenv('REDIS_DB', '0'))
+REDIS_CLUSTER = os.getenv('REDIS_CLUSTER', '').lower() in ('1', 'true', 'yes')
+REDIS_SHARDS = [node.strip() for node in os.getenv('REDIS_SHARDS', '').split(',') if node.strip()]
+
+# Storage selection at startup:
+# - auto: use Redis, retrying REDIS_CONNECT_ATTEMPTS times before falling back to memory
+# - redis: wait for Redis as long as it takes
+# - memory: never connect to Redis
+STORAGE_MODE = os.getenv('STORAGE_MODE', 'auto')
+REDIS_CONNECT_ATTEMPTS = int(os.getenv('REDIS_CONNECT_ATTEMPTS', '10'))
+REDIS_CONNECT_TIMEOUT = float(os.getenv('REDIS_CONNECT_TIMEOUT', '2'))
+
+# Seconds allowed on SIGTERM/SIGINT for the whole shutdown: in-flight
+# updates finishing and buffered writes being flushed share one deadline
+SHUTDOWN_TIMEOUT = float(os.getenv('SHUTDOWN_TIMEOUT', '20'))
+# Set when a shutdown signal arrives; loops stop taking new updates
+shutdown_requested = threading.Event()
+
+def player_key(chat_id, kind='player'):
+    """
+    Build a Redis key for a player's data.
+    The chat id is wrapped in a hash tag ({...}) so every key of one player
+    lands on the same Redis Cluster slot and the same client-side shard.
+    """
+    return f'{kind}:{{{chat_id}}}'
+
+def legacy_player_key(chat_id):
+    """Key a player's state had before keys got a hash tag (player:<chat_id>)"""
+    return f'player:{chat_id}'
+
+def player_key_chat_id(key):
+    """Chat id of a player key, in the current or the legacy format"""
+    return key_hash_tag(key) if '{' in key else key.split(':', 1)[1]
+
+def player_id(chat_id, user_id):
+    """
+    Id of a player: the chat id in a private chat (where it equals the user id)
+    and 'chat_id:user_id' in a group, so every member of a group has their own
+    state. Both parts sit in one hash tag, so group members spread over slots
+    and shards instead of contending for one key.
+    """
+    return str(chat_id) if chat_id == user_id else f'{chat_id}:{user_id}'
+
+def player_chat(player):
+    """The chat a player plays in"""
+    return int(str(player).split(':', 1)[0])
+
+def is_group_player(player):
+    """Whether a player id belongs to a member of a group chat"""
+    return ':' in str(player)
+
+def key_hash_tag(key):
+    """Return the part of a key used for slot/shard selection (Redis Cluster rules)"""
+    start = key.find('{')
+    if start != -1:
+        end = key.find('}', start + 1)
+        if end > start + 1:
+            return key[start + 1:end]
+    return key
+
+class HashRing:
+    """Consistent-hash ring that maps keys to shard clients by hash tag"""
+    
+    def __init__(self, nodes, replicas=160):
+        # nodes: mapping of node name ("host:port") -> client
+        self.nodes = nodes
+        self.names = list(nodes)
+        self.points = []
+        for index, name in enumerate(self.names):
+            for replica in range(replicas):
+                self.points.append((self._hash(f'{name}#{replica}'), index))
+        self.points.sort()
+        self.hashes = [point for point, _ in self.points]
+    
+    @staticmethod
+    def _hash(value):
+        return int.from_bytes(hashlib.md5(value.encode('utf-8')).digest()[:8], 'big')
+    
+    def get_node(self, key):
+        position = bisect.bisect(self.hashes, self._hash(key_hash_tag(key))) % len(self.points)
+        return self.nodes[self.names[self.points[position][1]]]
+
+def connect_redis():
+    """
+    Connect to Redis according to the configured topology.
+    Returns (primary client, shard ring or None); the client is None if Redis is unavailable.
+    """
+    try:
+        if REDIS_CLUSTER:
+            from redis.cluster import RedisCluster
+            client = RedisCluster(
+                host=REDIS_HOST, port=REDIS_PORT, decode_responses=True, socket_connect_timeout=REDIS_CONNECT_TIMEOUT
+            )
+            client.ping()
+            print("Connected to Redis Cluster successfully")
+            return client, None
+        if REDIS_SHARDS:
+            shard_clients = {}
+            for node in REDIS_SHARDS:
+                host, _, port = node.partition(':')
+                shard_clients[node] = redis.Redis(
+                    host=host, port=int(port or 6379), db=REDIS_DB, decode_responses=True,
+                    socket_connect_timeout=REDIS_CONNECT_TIMEOUT
+                )
+                shard_clients[node].ping()
+            ring = HashRing(shard_clients)
+            print(f"Connected to {len(shard_clients)} Redis shards successfully")
+            # Keys that are not per-player (counters, queues) live on the first shard
+            return shard_clients[REDIS_SHARDS[0]], ring
+        client = redis.Redis(
+            host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB, decode_responses=True,
+            socket_connect_timeout=REDIS_CONNECT_TIMEOUT
+        )
+        client.ping()
+        print("Connected to Redis successfully")
+        return client, None
+    except Exception as e:
+        print(f"Redis not available: {e}")
+        return None, None
+
+# Redis connection for persistent storage (None means in-memory fallback).
+# Set by init_storage() when the bot starts, not at import time.
+redis_client, redis_ring = None, None
+storage_mode = 'starting'
+
+def init_storage():
+    """
+    Connect to Redis with retries and exponential backoff, so a Redis that
+    is still starting does not silently pin the bot to in-memory storage.
+    Returns the chosen storage mode ('redis' or 'memory').
+    """
+    global redis_client, redis_ring, storage_mode
+    if STORAGE_MODE == 'memory':
+        storage_mode = 'memory'
+        print("Using in-memory storage")
+        return storage_mode
+    
+    storage_mode = 'connecting'
+    attempt, delay = 0, 0.5
+    while True:
+        attempt += 1
+        client, ring = connect_redis()
+        if client:
+            redis_client, redis_ring = client, ring
+            storage_mode = 'redis'
+            return storage_mode
+        if STORAGE_MODE == 'auto' and attempt >= REDIS_CONNECT_ATTEMPTS:
+            print(f"Redis not available after {attempt} attempts, using in-memory storage")
+            storage_mode = 'memory'
+            return storage_mode
+        if shutdown_requested.wait(delay):
+            return storage_mode
+        delay = min(delay * 2, 5)
+
+def redis_for(key):
+    """Return the Redis client that owns the given key"""
+    if redis_ring:
+        return redis_ring.get_node(key)
+    return redis_client
+
+def redis_nodes():
+    """Return every Redis client that may hold player keys (for scans)"""
+    if redis_ring:
+        return list(redis_ring.nodes.values())
+    return [redis_client] if redis_client else []
+
+# Identical callbacks (same player, button and rendered message) within this window are dropped
+CALLBACK_DEBOUNCE_MS = int(os.getenv('CALLBACK_DEBOUNCE_MS', '1500'))
+
+# In-memory debounce map: callback key -> expiry time (monotonic seconds)
+recent_callbacks = {}
+recent_callbacks_lock = threading.Lock()
+
+# Player progress log. An update appends one entry to events:{id} with the
+# fields it changed and its progress events (reset, load, scene, item,
+# health); the player record is only rewritten, as a snapshot, every
+# EVENT_SNAPSHOT_EVERY entries, and snapshotid:{id} holds the id of the entry
+# it ends with. A read is the snapshot plus the entries after it. Without
+# Redis the log is an append-only file, compacted down to one snapshot per
+# player at snapshot time once it grows past EVENT_LOG_MAX_BYTES.
+EVENT_SNAPSHOT_EVERY = int(os.getenv('EVENT_SNAPSHOT_EVERY', '50'))
+EVENT_LOG_MAXLEN = int(os.getenv('EVENT_LOG_MAXLEN', '10000'))
+EVENT_LOG_PATH = os.getenv('EVENT_LOG_PATH', os.path.join('data', 'events.ndjson'))
+EVENT_LOG_MAX_BYTES = int(os.getenv('EVENT_LOG_MAX_BYTES', str(64 * 1024 * 1024)))
+
+# Entries each player is past their last snapshot in EVENT_LOG_PATH
+event_counts = {}
+event_log_lock = threading.Lock()
+# Size of the file after the last compaction; it is compacted again once it doubles
+event_log_compacted_size = 0
+
+def shown_message_digest(message):
+    """
+    Hash of what a message showed when its button was pressed (text,
+    keyboard and last edit time). The game edits one message in place, so
+    the same button pressed again after the message moved on hashes differently.
+    """
+    markup = message.reply_markup.to_json() if getattr(message, 'reply_markup', None) else ''
+    text = getattr(message, 'text', None) or getattr(message, 'caption', None) or ''
+    edited = getattr(message, 'edit_date', None) or getattr(message, 'date', None)
+    return hashlib.blake2b(f'{text}\0{markup}\0{edited}'.encode('utf-8'), digest_size=6).hexdigest()
+
+def is_duplicate_callback(call):
+    """
+    Check whether this button press repeats one seen within the debounce window:
+    the same button of the same rendered message, so navigating back to a
+    scene (main_menu, forest, main_menu) is not mistaken for a repeated tap.
+    Uses SET NX PX in Redis so replicas share the window, otherwise a local TTL map.
+    """
+    if CALLBACK_DEBOUNCE_MS <= 0:
+        return False
+    
+    player = player_id(call.message.chat.id, call.from_user.id)
+    key = f"{player_key(player, 'debounce')}:{call.message.message_id}:{shown_message_digest(call.message)}:{call.data}"
+    
+    if redis_client:
+        try:
+            return not redis_for(key).set(key, 1, nx=True, px=CALLBACK_DEBOUNCE_MS)
+        except Exception as e:
+            print(f"Error checking callback debounce in Redis: {e}")
+    
+    now = time.monotonic()
+    with recent_callbacks_lock:
+        expires_at = recent_callbacks.get(key)
+        if expires_at is not None and expires_at > now:
+            return True
+        # Drop expired entries once the map grows so it stays small
+        if len(recent_callbacks) > 1024:
+            for stale_key in [k for k, t in recent_callbacks.items() if t <= now]:
+                del recent_callbacks[stale_key]
+        recent_callbacks[key] = now + CALLBACK_DEBOUNCE_MS / 1000
+    return False
 
 def load_player_data():
     """Load player data from Redis if available"""
     global redis_client
     if redis_client:
         try:
-            # Get all keys with 'player:' prefix
-            player_keys = redis_client.keys('player:*')
+            # Walk every node that may hold 'player:{...}' keys
             player_states = {}
-            for key in player_keys:
-                try:
-                    data = redis_client.get(key)
-                    if data:
-                        player_states[key.replace('player:', '')] = json.loads(data)
-                except:
-                    continue
+            for node in redis_nodes():
+                for key in node.scan_iter(match='player:*', count=1000):
+                    try:
+                        data = node.get(key)
+                        if data:
+                            # A legacy key never replaces the current one
+                            chat_id = player_key_chat_id(key)
+                            if '{' in key or chat_id not in player_states:
+                                player_states[chat_id] = json.loads(data)
+                    except:
+                        continue
             return player_states
         except Exception as e:
             print(f"Error loading player data from Redis: {e}")
     return {}
 
-def save_player_data(chat_id, data):
-    """Save player data to Redis"""
-    global redis_client
-    if redis_client:
+# Two-level cache of player states: a small per-process L1 (LRU with TTL) in
+# front of Redis, which stays authoritative. Every commit publishes the chat
+# id on PLAYER_CACHE_CHANNEL and the other replicas drop their copy. Pub/sub
+# is used rather than keyspace notifications, which need notify-keyspace-events
+# configured on the server. The TTL bounds staleness if a message is missed.
+PLAYER_CACHE_SIZE = int(os.getenv('PLAYER_CACHE_SIZE', '10000'))
+PLAYER_CACHE_TTL = float(os.getenv('PLAYER_CACHE_TTL', '30'))
+PLAYER_CACHE_CHANNEL = 'cache:{game}:players'
+
+# chat id -> (expiry time, state, log entries past the snapshot), least recently used first
+player_cache = collections.OrderedDict()
+player_cache_lock = threading.Lock()
+# Bumped by every invalidation, so a read that raced one is not cached
+player_cache_generation = 0
+# The L1 is only used while this process listens for invalidations
+player_cache_active = threading.Event()
+
+def cache_origin():
+    """Identify this process in invalidation messages (after fork, too)"""
+    return f'{socket.gethostname()}-{os.getpid()}'
+
+def copy_player_state(state):
+    """Copy a state deep enough that changes to it do not leak into the cache"""
+    return dict(state, inventory=list(state['inventory']))
+
+def cache_get(chat_id):
+    """Return a copy of a cached state and its log length (see read_player_record), or None"""
+    if not player_cache_active.is_set():
+        return None
+    with player_cache_lock:
+        entry = player_cache.get(chat_id)
+        if entry is None:
+            return None
+        if entry[0] <= time.monotonic():
+            del player_cache[chat_id]
+            return None
+        player_cache.move_to_end(chat_id)
+        return copy_player_state(entry[1]), entry[2]
+
+def cache_put(chat_id, state, generation, log_length=None):
+    """Cache a state read or written at the given invalidation generation"""
+    if not player_cache_active.is_set():
+        return
+    with player_cache_lock:
+        if generation != player_cache_generation:
+            return
+        player_cache[chat_id] = (time.monotonic() + PLAYER_CACHE_TTL, copy_player_state(state), log_length)
+        player_cache.move_to_end(chat_id)
+        while len(player_cache) > PLAYER_CACHE_SIZE:
+            player_cache.popitem(last=False)
+
+def cache_invalidate(chat_id=None):
+    """Drop one cached player, or all of them"""
+    global player_cache_generation
+    with player_cache_lock:
+        player_cache_generation += 1
+        if chat_id is None:
+            player_cache.clear()
+        else:
+            player_cache.pop(chat_id, None)
+
+def listen_for_invalidations():
+    """Drop L1 entries that other replicas changed; the L1 is off while disconnected"""
+    while not shutdown_requested.is_set():
+        pubsub = None
         try:
-            redis_client.setex(f'player:{chat_id}', 86400, json.dumps(data, ensure_ascii=False))  # Expire after 24 hours
-            return True
+            pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(PLAYER_CACHE_CHANNEL)
+            # Anything cached before may have changed while nobody listened
+            cache_invalidate()
+            player_cache_active.set()
+            while not shutdown_requested.is_set():
+                message = pubsub.get_message(timeout=1.0)
+                if not message:
+                    continue
+                origin, _, chat_id = message['data'].partition(' ')
+                if origin != cache_origin():
+                    cache_invalidate(None if chat_id == '*' else chat_id)
         except Exception as e:
-            print(f"Error saving player data to Redis: {e}")
-            return False
-    return False
+            print(f"Player cache invalidation listener error: {e}")
+            time.sleep(1)
+        finally:
+            player_cache_active.clear()
+            cache_invalidate()
+            if pubsub:
+                try:
+                    pubsub.close()
+                except Exception:
+                    pass
+
+def start_player_cache():
+    """Enable the L1 cache once Redis is connected"""
+    player_cache_active.clear()
+    cache_invalidate()
+    if redis_client and PLAYER_CACHE_SIZE > 0:
+        threading.Thread(target=listen_for_invalidations, name='player-cache', daemon=True).start()
+
+def initial_player_state():
+    """Return the state of a player who just started the game"""
+    return {
+        'current_scene': 'start',
+        'inventory': [],
+        'health': 100,
+        'experience': 0
+    }
 
-def get_player_state(chat_id):
-    """Get or initialize player state"""
+# In-memory player states used without Redis: chat id -> state
+memory_players = {}
+
+# KEYS[1] = player, KEYS[2] = snapshot id, KEYS[3] = log. Returns nothing
+# for a new player, {snapshot} for a record that is not a log snapshot (set
+# by an import or the legacy key move) and {snapshot, entries after it} else
+READ_PLAYER_SCRIPT = """
+local state = redis.call('GET', KEYS[1])
+if not state then
+    return false
+end
+local last_id = redis.call('GET', KEYS[2])
+if not last_id then
+    return {state}
+end
+local tail = redis.call('XRANGE', KEYS[3], last_id, '+')
+if tail[1] and tail[1][1] == last_id then
+    table.remove(tail, 1)
+end
+return {state, tail}
+"""
+read_player_script = None
+
+def read_player_record(chat_id, cached=True):
+    """
+    Read a player's saved state (None for a new player), from the L1 cache
+    if possible. Returns (state, log entries past its snapshot); the count
+    is None when the state is not a log snapshot, so the next commit writes one.
+    """
+    global read_player_script
     str_chat_id = str(chat_id)
     
     if redis_client:
-        # Try to get from Redis
-        data = redis_client.get(f'player:{str_chat_id}')
-        if data:
-            return json.loads(data)
+        record = cache_get(str_chat_id) if cached else None
+        if record is not None:
+            return record
+        generation = player_cache_generation
+        key = player_key(str_chat_id)
+        if read_player_script is None:
+            read_player_script = redis_client.register_script(READ_PLAYER_SCRIPT)
+        keys = [key, player_key(str_chat_id, 'snapshotid'), player_key(str_chat_id, 'events')]
+        result = read_player_script(keys=keys, client=redis_for(key))
+        if result:
+            state = json.loads(result[0])
+            log_length = None
+            if len(result) > 1:
+                for _, entry in result[1]:
+                    apply_stream_entry(state, dict(zip(entry[::2], entry[1::2])))
+                log_length = len(result[1])
         else:
-            # Initialize new player state
-            new_state = {
-                'current_scene': 'start',
-                'inventory': [],
-                'health': 100,
-                'experience': 0
-            }
-            save_player_data(str_chat_id, new_state)
-            return new_state
-    else:
-        # Fallback to in-memory storage
-        if not hasattr(get_player_state, 'player_states'):
-            get_player_state.player_states = {}
-        if str_chat_id not in get_player_state.player_states:
-            get_player_state.player_states[str_chat_id] = {
-                'current_scene': 'start',
-                'inventory': [],
-                'health': 100,
-                'experience': 0
-            }
-        return get_player_state.player_states[str_chat_id]
-
-def update_player_state(chat_id, key, value):
-    """Update a specific field in player state"""
-    str_chat_id = str(chat_id)
-    player_state = get_player_state(str_chat_id)
-    player_state[key] = value
+            data = migrate_legacy_player(str_chat_id)
+            if not data:
+                return None, None
+            state, log_length = json.loads(data), None
+        cache_put(str_chat_id, state, generation, log_length)
+        return state, log_length
     
+    # Fallback to in-memory storage; hand out a copy so uncommitted changes stay local
+    state = memory_players.get(str_chat_id)
+    if state is None:
+        return None, None
+    return copy_player_state(state), event_counts.get(str_chat_id, 0)
+
+def read_player_state(chat_id, cached=True):
+    """Read a player's saved state (None for a new player), from the L1 cache if possible"""
+    return read_player_record(chat_id, cached)[0]
+
+def migrate_legacy_player(chat_id):
+    """
+    Move a state still stored under the legacy key to player_key(chat_id),
+    keeping its TTL; returns the JSON, or None if there is none. The legacy
+    key is deleted, so it is only read once per player.
+    """
+    legacy = legacy_player_key(chat_id)
+    # Legacy keys predate sharding: they are on the primary, not where the ring would put them
+    node = redis_client
+    data, ttl_ms = node.pipeline(transaction=False).get(legacy).pttl(legacy).execute()
+    if not data:
+        return None
+    key = player_key(chat_id)
+    if not redis_for(key).set(key, data, px=ttl_ms if ttl_ms > 0 else 86400 * 1000, nx=True):
+        # Written under the new key in the meantime: that state is newer
+        data = redis_for(key).get(key) or data
+    node.delete(legacy)
+    print(f"Moved player {chat_id} from {legacy} to {key}")
+    return data
+
+def get_player_state(chat_id):
+    """
+    Get a player's state, or the initial state of a new player.
+    Changes are made through PlayerContext.
+    """
+    state = read_player_state(chat_id)
+    return state if state is not None else initial_player_state()
+
+def state_changes(before, after):
+    """Return the fields of a player state that changed (new values) and the ones removed"""
+    changed = {key: value for key, value in after.items() if key not in before or before[key] != value}
+    return changed, [key for key in before if key not in after]
+
+def apply_log_entry(state, changed, removed=()):
+    """Apply one log entry (the changed fields with their new values, the removed ones) to a player state"""
+    state.update(changed)
+    for key in removed:
+        state.pop(key, None)
+
+def apply_stream_entry(state, entry):
+    """Apply an entry of an events:{id} stream, whose fields hold JSON"""
+    apply_log_entry(state, json.loads(entry['s']), json.loads(entry['d']))
+
+def log_to_file(chat_id, changed, removed, events, snapshot=None):
+    """
+    Append a player's log entry, or their new snapshot, to EVENT_LOG_PATH
+    (used without Redis). At snapshot time a file that outgrew
+    EVENT_LOG_MAX_BYTES is compacted.
+    """
+    if snapshot is not None:
+        record = {'c': chat_id, 'state': snapshot}
+    else:
+        record = {'c': chat_id, 's': changed}
+        if removed:
+            record['d'] = removed
+    if events:
+        record['e'] = events
+    with event_log_lock:
+        os.makedirs(os.path.dirname(EVENT_LOG_PATH) or '.', exist_ok=True)
+        with open(EVENT_LOG_PATH, 'a', encoding='utf-8') as log_file:
+            log_file.write(json.dumps(record, ensure_ascii=False) + '\n')
+            size = log_file.tell()
+        if snapshot is not None and size > max(EVENT_LOG_MAX_BYTES, 2 * event_log_compacted_size):
+            compact_event_log()
+
+def compact_event_log():
+    """
+    Replace EVENT_LOG_PATH with one snapshot line per player, taken from the
+    in-memory states (called with event_log_lock held). A commit that raced
+    the rewrite appends its entry afterwards, and applying it again is harmless.
+    """
+    global event_log_compacted_size
+    started = time.monotonic()
+    temporary = EVENT_LOG_PATH + '.tmp'
+    with open(temporary, 'w', encoding='utf-8') as log_file:
+        for chat_id, state in list(memory_players.items()):
+            log_file.write(json.dumps({'c': chat_id, 'state': state}, ensure_ascii=False) + '\n')
+        event_log_compacted_size = log_file.tell()
+    os.replace(temporary, EVENT_LOG_PATH)
+    event_counts.clear()
+    print(f"Compacted {EVENT_LOG_PATH} to {len(memory_players)} players in {time.monotonic() - started:.2f}s")
+
+def load_event_log():
+    """Rebuild the in-memory player states from EVENT_LOG_PATH when starting without Redis"""
+    if not os.path.exists(EVENT_LOG_PATH):
+        return
+    with event_log_lock, open(EVENT_LOG_PATH, encoding='utf-8') as log_file:
+        for line in log_file:
+            try:
+                record = json.loads(line)
+                chat_id = record['c']
+                if 'state' in record:
+                    memory_players[chat_id] = record['state']
+                    event_counts[chat_id] = 0
+                elif chat_id in memory_players:
+                    apply_log_entry(memory_players[chat_id], record['s'], record.get('d', ()))
+                    event_counts[chat_id] += 1
+            except (ValueError, KeyError, TypeError):
+                # A line cut short by a crash, or from an older log format
+                continue
+    print(f"Loaded {len(memory_players)} players from {EVENT_LOG_PATH}")
+
+# Aggregated game analytics. Counters of one update are collected per thread
+# and written in a single pipeline at its end. Redis keys share the {game}
+# hash tag, so the pipeline goes to one node (and one cluster slot):
+# - stats:{game}:players, stats:{game}:players:<scene>: unique players (HyperLogLog)
+# - stats:{game}:scenes/edges/items/deaths: hashes of counters by scene,
+#   'scene>choice' edge, item and scene where health dropped to 0
+STATS_PREFIX = 'stats:{game}'
+STATS_COUNTERS = ('scenes', 'edges', 'items', 'deaths')
+pending_stats = threading.local()
+
+# In-memory analytics used without Redis
+memory_stats = {name: collections.Counter() for name in STATS_COUNTERS}
+memory_unique_players = collections.defaultdict(set)
+memory_stats_lock = threading.Lock()
+
+def pending_stat_ops():
+    """Return the analytics operations collected for the current update"""
+    if not hasattr(pending_stats, 'ops'):
+        pending_stats.ops = []
+    return pending_stats.ops
+
+def count_stat(counter, field):
+    """Add one to a counter of the current update (written by flush_stats)"""
+    pending_stat_ops().append(('count', counter, field))
+
+def count_scene_visit(chat_id, scene_id):
+    """Count a scene visit and the player among the unique visitors"""
+    ops = pending_stat_ops()
+    ops.append(('unique', 'players', str(chat_id)))
+    ops.append(('unique', f'players:{scene_id}', str(chat_id)))
+    ops.append(('count', 'scenes', scene_id))
+
+def flush_stats(pipe=None):
+    """
+    Write the counters of the current update in one pipelined round trip,
+    or queue them on a pipeline the caller executes.
+    """
+    ops = pending_stat_ops()
+    if not ops:
+        return
+    pending_stats.ops = []
+    if redis_client:
+        try:
+            target = pipe or redis_client.pipeline(transaction=False)
+            for op, name, value in ops:
+                if op == 'count':
+                    target.hincrby(f'{STATS_PREFIX}:{name}', value, 1)
+                else:
+                    target.pfadd(f'{STATS_PREFIX}:{name}', value)
+            if pipe is None:
+                target.execute()
+        except Exception as e:
+            print(f"Error writing stats: {e}")
+        return
+    with memory_stats_lock:
+        for op, name, value in ops:
+            if op == 'count':
+                memory_stats[name][value] += 1
+            else:
+                memory_unique_players[name].add(value)
+
+def read_stats(scene_ids):
+    """
+    Return the analytics: unique players overall and per scene, plus the
+    scenes/edges/items/deaths counters.
+    """
+    if redis_client:
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.pfcount(f'{STATS_PREFIX}:players')
+        for scene_id in scene_ids:
+            pipe.pfcount(f'{STATS_PREFIX}:players:{scene_id}')
+        for name in STATS_COUNTERS:
+            pipe.hgetall(f'{STATS_PREFIX}:{name}')
+        results = pipe.execute()
+        stats = {
+            'players': results[0],
+            'scene_players': dict(zip(scene_ids, results[1:1 + len(scene_ids)]))
+        }
+        for name, counts in zip(STATS_COUNTERS, results[1 + len(scene_ids):]):
+            stats[name] = {field: int(count) for field, count in counts.items()}
+        return stats
+    with memory_stats_lock:
+        stats = {
+            'players': len(memory_unique_players['players']),
+            'scene_players': {scene_id: len(memory_unique_players[f'players:{scene_id}']) for scene_id in scene_ids}
+        }
+        for name in STATS_COUNTERS:
+            stats[name] = dict(memory_stats[name])
+        return stats
+
+# Leaderboard of the best experience a player reached in one run. A sorted
+# set updated with ZADD GT whenever experience grows, so /top reads the top
+# entries and a rank in O(log N) instead of scanning player records; names
+# are kept in a hash next to it.
+LEADERBOARD_KEY = 'leaderboard:{game}'
+LEADERBOARD_NAMES_KEY = 'leaderboard:{game}:names'
+LEADERBOARD_SIZE = int(os.getenv('LEADERBOARD_SIZE', '10'))
+# The rendered top list is reused for this many seconds
+LEADERBOARD_CACHE_SECONDS = float(os.getenv('LEADERBOARD_CACHE_SECONDS', '5'))
+
+# In-memory leaderboard used without Redis: chat id -> (best experience, name)
+memory_leaderboard = {}
+memory_leaderboard_lock = threading.Lock()
+# Rendered top list per locale: (story it was rendered with, text, expiry time)
+leaderboard_cache = {}
+
+def update_leaderboard(chat_id, name, experience, pipe=None):
+    """
+    Record a player's experience; the leaderboard keeps the best value.
+    With a pipeline the writes are queued for the caller to execute.
+    """
+    member = str(chat_id)
+    if redis_client:
+        try:
+            target = pipe or redis_client.pipeline(transaction=False)
+            target.zadd(LEADERBOARD_KEY, {member: experience}, gt=True)
+            if name:
+                target.hset(LEADERBOARD_NAMES_KEY, member, name)
+            if pipe is None:
+                target.execute()
+        except Exception as e:
+            print(f"Error updating leaderboard: {e}")
+        return
+    with memory_leaderboard_lock:
+        best, known_name = memory_leaderboard.get(member, (0, None))
+        memory_leaderboard[member] = (max(best, experience), name or known_name)
+
+def top_players(count):
+    """Return [(chat id, name, experience)] of the best players"""
+    if redis_client:
+        entries = redis_client.zrevrange(LEADERBOARD_KEY, 0, count - 1, withscores=True)
+        if not entries:
+            return []
+        names = redis_client.hmget(LEADERBOARD_NAMES_KEY, [member for member, _ in entries])
+        return [(member, name, int(score)) for (member, score), name in zip(entries, names)]
+    with memory_leaderboard_lock:
+        # Sorting is fine for the single-process fallback
+        best = sorted(memory_leaderboard.items(), key=lambda entry: -entry[1][0])[:count]
+    return [(member, name, experience) for member, (experience, name) in best]
+
+def player_rank(chat_id):
+    """Return (1-based rank, experience) of a player, or None if not ranked"""
+    member = str(chat_id)
+    if redis_client:
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.zrevrank(LEADERBOARD_KEY, member)
+        pipe.zscore(LEADERBOARD_KEY, member)
+        rank, score = pipe.execute()
+        return (rank + 1, int(score)) if rank is not None else None
+    with memory_leaderboard_lock:
+        if member not in memory_leaderboard:
+            return None
+        experience = memory_leaderboard[member][0]
+        return 1 + sum(1 for best, _ in memory_leaderboard.values() if best > experience), experience
+
+# Players of each group chat (chatplayers:{chat_id} -> user ids), so a
+# group's players are found without scanning
+CHAT_INDEX_TTL = 86400
+
+# In-memory chat index used without Redis: chat id -> user ids
+memory_chat_players = {}
+
+def index_chat_player(player, pipe=None):
+    """
+    Add a group player to their chat's index and keep the index alive for
+    CHAT_INDEX_TTL more, or queue that on a pipeline the caller executes
+    """
+    chat_id, user_id = str(player).split(':', 1)
     if redis_client:
-        save_player_data(str_chat_id, player_state)
+        key = player_key(chat_id, 'chatplayers')
+        target = pipe or redis_for(key).pipeline(transaction=False)
+        target.sadd(key, user_id).expire(key, CHAT_INDEX_TTL)
+        if pipe is None:
+            target.execute()
+        return
+    with memory_leaderboard_lock:
+        memory_chat_players.setdefault(chat_id, set()).add(user_id)
+
+def chat_players(chat_id):
+    """Return the player ids of a group chat"""
+    if redis_client:
+        key = player_key(chat_id, 'chatplayers')
+        user_ids = redis_for(key).smembers(key)
+    else:
+        with memory_leaderboard_lock:
+            user_ids = set(memory_chat_players.get(str(chat_id), ()))
+    return [f'{chat_id}:{user_id}' for user_id in sorted(user_ids)]
+
+def chat_leaderboard(chat_id, count):
+    """Return [(player id, name, experience)] of a group chat's best players"""
+    players = chat_players(chat_id)
+    if not players:
+        return []
+    if redis_client:
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.zmscore(LEADERBOARD_KEY, players)
+        pipe.hmget(LEADERBOARD_NAMES_KEY, players)
+        scores, names = pipe.execute()
+        entries = [(player, name, int(score)) for player, score, name in zip(players, scores, names) if score is not None]
     else:
-        # Update in-memory storage
-        if hasattr(get_player_state, 'player_states'):
-            get_player_state.player_states[str_chat_id] = player_state
+        with memory_leaderboard_lock:
+            entries = [
+                (player, memory_leaderboard[player][1], memory_leaderboard[player][0])
+                for player in players if player in memory_leaderboard
+            ]
+    return sorted(entries, key=lambda entry: -entry[2])[:count]
+
+# Chats that blocked the bot (found by broadcasts); a player is taken off
+# the set again by the next update they send
+BLOCKED_KEY = 'blocked:{game}'
+
+# Updates of one player are handled one at a time, so two of them cannot
+# both read the state and overwrite each other's changes. Threads of a
+# process (telebot's workers, the timer thread) share striped locks. When
+# one player can be changed from several processes, a Redis lock (lock:{id})
+# that expires after PLAYER_LOCK_TIMEOUT is held as well: stream workers get
+# a player's updates in any process, and with BOT_WORKERS a chat's updates
+# go to one worker but its timers fire in whichever worker pops them.
+PLAYER_LOCK_TIMEOUT = float(os.getenv('PLAYER_LOCK_TIMEOUT', '10'))
+SHARED_PLAYER_LOCKS = BOT_MODE == 'stream-worker' or BOT_WORKERS > 1
+player_lock_stripes = [threading.Lock() for _ in range(256)]
+# Parties ('party:<id>') are locked the same way, but with stripes of their
+# own: a member's update takes its party's lock while holding its player
+# lock, so the two must never be the same lock
+party_lock_stripes = [threading.Lock() for _ in range(64)]
+
+# KEYS[1] = lock; ARGV[1] = token. Deletes the lock only if it is still ours
+RELEASE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+release_lock_script = None
+
+@contextlib.contextmanager
+def player_lock(player):
+    """Hold the lock of one player (raises TimeoutError if another update keeps it too long)"""
+    global release_lock_script
+    stripes = party_lock_stripes if str(player).startswith('party:') else player_lock_stripes
+    stripe = stripes[zlib.crc32(str(player).encode('utf-8')) % len(stripes)]
+    if not stripe.acquire(timeout=PLAYER_LOCK_TIMEOUT):
+        raise TimeoutError(f"Player {player} is locked")
+    try:
+        if not (SHARED_PLAYER_LOCKS and redis_client):
+            yield
+            return
+        key = player_key(player, 'lock')
+        client = redis_for(key)
+        token = secrets.token_hex(8)
+        deadline = time.monotonic() + PLAYER_LOCK_TIMEOUT
+        while not client.set(key, token, nx=True, px=int(PLAYER_LOCK_TIMEOUT * 1000)):
+            if time.monotonic() >= deadline:
+                raise TimeoutError(f"Player {player} is locked by another worker")
+            time.sleep(0.01)
+        try:
+            yield
+        finally:
+            if release_lock_script is None:
+                release_lock_script = redis_client.register_script(RELEASE_LOCK_SCRIPT)
+            release_lock_script(keys=[key], args=[token], client=client)
+    finally:
+        stripe.release()
+
+def one_update_per_player(player_of):
+    """Decorate a handler so it runs under the lock of the player player_of(update) returns"""
+    def decorate(handler):
+        @functools.wraps(handler)
+        def locked(update):
+            try:
+                with player_lock(player_of(update)):
+                    return handler(update)
+            except TimeoutError as e:
+                # Left unconfirmed: a stream entry is delivered again later
+                print(f"Error in {handler.__name__}: {e}")
+                mark_update_failed()
+        return locked
+    return decorate
+
+# KEYS[1] = player, KEYS[2] = snapshot id, KEYS[3] = log; ARGV[1], ARGV[2],
+# ARGV[3] = changed fields, removed fields and progress events (JSON),
+# ARGV[4] = log length cap, ARGV[5] = TTL, ARGV[6] = the whole state when a
+# snapshot is due, or ''. Appends one entry and returns its id; the player
+# record and its snapshot id are only rewritten with a snapshot
+LOG_UPDATE_SCRIPT = """
+local id = redis.call('XADD', KEYS[3], 'MAXLEN', '~', ARGV[4], '*', 's', ARGV[1], 'd', ARGV[2], 'e', ARGV[3])
+if ARGV[6] ~= '' then
+    redis.call('SET', KEYS[1], ARGV[6], 'EX', ARGV[5])
+    redis.call('SET', KEYS[2], id, 'EX', ARGV[5])
+else
+    redis.call('EXPIRE', KEYS[1], ARGV[5])
+    redis.call('EXPIRE', KEYS[2], ARGV[5])
+end
+redis.call('EXPIRE', KEYS[3], ARGV[5])
+return id
+"""
+log_update_script = None
 
-def add_to_inventory(chat_id, item):
-    """Add an item to player's inventory"""
-    str_chat_id = str(chat_id)
-    player_state = get_player_state(str_chat_id)
+class PlayerContext:
+    """
+    A player's state for the duration of one update: read once when the
+    update starts, changed in memory while it is handled and written back by
+    commit() as one log entry (with the progress events), together with the
+    analytics counters and the leaderboard entry.
+    """
     
-    if item not in player_state['inventory']:
-        player_state['inventory'].append(item)
-        
+    def __init__(self, chat_id):
+        # A chat id, or chat_id:user_id for a member of a group (see player_id)
+        self.chat_id = str(chat_id)
+        # Another process may have just changed the player; its invalidation
+        # could still be on the way, so a shared lock means a fresh read
+        saved, self.log_length = read_player_record(self.chat_id, cached=not SHARED_PLAYER_LOCKS)
+        self.state = saved if saved is not None else initial_player_state()
+        # What the log holds so far; commit() logs the difference
+        self.saved = copy_player_state(saved) if saved is not None else {}
+        # A player without a saved state is stored by the first commit
+        self.changed = self.new = saved is None
+        self.events = []
+        self.leaderboard = None
+        self.timers = []
+        # Progress a reset replaced, written to the autosave slot by commit()
+        self.autosave = None
+    
+    def set(self, key, value):
+        """Change one field of the state"""
+        if self.state.get(key) != value:
+            self.state[key] = value
+            self.changed = True
+    
+    def record(self, event_type, value=''):
+        """Add a progress event (reset, load, scene, item, health) to the player's log"""
+        self.events.append((event_type, value))
+    
+    def reset(self):
+        """Start the game over"""
+        # Keep the render fingerprint so re-rendering the same screen stays a
+        # no-op, the message a group member plays in, the language and the
+        # random generator (a new game continues its sequence)
+        kept = {key: self.state[key] for key in ('last_render', 'message_id', 'locale', 'rng') if key in self.state}
+        if self.autosave is None and has_progress(self.state):
+            self.autosave = progress_state(self.state)
+        self.state = initial_player_state()
+        self.state.update(kept)
+        self.changed = True
+        self.record('reset')
+    
+    def add_item(self, item):
+        """Add an item to the inventory; returns False if the player already has it"""
+        if item in self.state['inventory']:
+            return False
+        self.state['inventory'].append(item)
+        self.changed = True
+        self.record('item', item)
+        return True
+    
+    def add_experience(self, points, name):
+        """Award experience and queue the player's leaderboard entry"""
+        self.set('experience', self.state.get('experience', 0) + points)
+        self.leaderboard = (name, self.state['experience'])
+    
+    def schedule(self, timer_id, delay):
+        """Fire a story timer for this player after delay seconds (once per timer)"""
+        self.timers.append((timer_id, delay))
+    
+    def roll(self, table):
+        """Draw a value from a WeightedTable with the player's own generator (seeded on first use)"""
+        rng = self.state.get('rng')
+        if rng is None:
+            rng = secrets.randbits(64)
+        rng, value = next_random(rng)
+        self.set('rng', rng)
+        return table.values[bisect.bisect_right(table.cumulative, value % table.total)]
+    
+    def commit(self):
+        """
+        Write everything the update changed in one round trip: the log entry
+        (or a snapshot), timers, the counters and the leaderboard entry share
+        one pipeline (with sharding, game-wide keys may need a second one on their node).
+        """
+        global log_update_script
+        logged = self.changed or self.events
+        changed, removed = state_changes(self.saved, self.state) if logged else ({}, [])
+        # A snapshot is due every EVENT_SNAPSHOT_EVERY entries, and at once for
+        # a record that is not a log snapshot yet
+        snapshot = self.log_length is None or self.log_length + 1 >= EVENT_SNAPSHOT_EVERY
+        events = [list(event) for event in self.events]
         if redis_client:
-            save_player_data(str_chat_id, player_state)
+            key = player_key(self.chat_id)
+            client = redis_for(key)
+            pipe = client.pipeline(transaction=not REDIS_CLUSTER)
+            if logged:
+                keys = [key, player_key(self.chat_id, 'snapshotid'), player_key(self.chat_id, 'events')]
+                args = [
+                    json.dumps(changed, ensure_ascii=False), json.dumps(removed), json.dumps(events, ensure_ascii=False),
+                    EVENT_LOG_MAXLEN, 86400,  # Expire after 24 hours
+                    json.dumps(self.state, ensure_ascii=False) if snapshot else ''
+                ]
+                if REDIS_CLUSTER:
+                    # Cluster pipelines cannot load scripts
+                    pipe.eval(LOG_UPDATE_SCRIPT, len(keys), *keys, *args)
+                else:
+                    if log_update_script is None:
+                        log_update_script = redis_client.register_script(LOG_UPDATE_SCRIPT)
+                    log_update_script(keys=keys, args=args, client=pipe)
+            shared = pipe if redis_ring is None or client is redis_client else redis_client.pipeline(transaction=False)
+            if self.changed:
+                shared.srem(BLOCKED_KEY, player_chat(self.chat_id))
+                if PLAYER_CACHE_SIZE > 0:
+                    # Other replicas drop their cached copy of this player
+                    shared.publish(PLAYER_CACHE_CHANNEL, f'{cache_origin()} {self.chat_id}')
+            if self.leaderboard:
+                update_leaderboard(self.chat_id, *self.leaderboard, pipe=shared)
+            for timer_id, delay in self.timers:
+                schedule_timer(self.chat_id, timer_id, delay, pipe=shared)
+            if self.changed and is_group_player(self.chat_id):
+                # The chat index lives as long as its players are active
+                index_key = player_key(player_chat(self.chat_id), 'chatplayers')
+                index_chat_player(self.chat_id, pipe=pipe if redis_for(index_key) is client else None)
+            flush_stats(shared)
+            generation = player_cache_generation
+            pipe.execute()
+            if shared is not pipe:
+                shared.execute()
         else:
-            # Update in-memory storage
-            if hasattr(get_player_state, 'player_states'):
-                get_player_state.player_states[str_chat_id] = player_state
-        
-        return True
-    return False
+            if self.changed:
+                memory_players[self.chat_id] = self.state
+            if logged:
+                log_to_file(self.chat_id, changed, removed, events, copy_player_state(self.state) if snapshot else None)
+            if self.leaderboard:
+                update_leaderboard(self.chat_id, *self.leaderboard)
+            for timer_id, delay in self.timers:
+                schedule_timer(self.chat_id, timer_id, delay)
+            flush_stats()
+        
+        if logged:
+            self.log_length = 0 if snapshot else self.log_length + 1
+            self.saved = copy_player_state(self.state)
+            if redis_client:
+                cache_put(self.chat_id, self.state, generation, self.log_length)
+            else:
+                event_counts[self.chat_id] = self.log_length
+        if self.new and is_group_player(self.chat_id) and not redis_client:
+            index_chat_player(self.chat_id)
+        if self.autosave:
+            write_save(self.chat_id, AUTOSAVE_SLOT, self.autosave)
+            self.autosave = None
+        self.changed = self.new = False
+        self.events = []
+        self.leaderboard = None
+        self.timers = []
+
+# Save slots: /save copies a player's progress into a numbered slot, and a
+# reset (/start, /restart, the main menu, /load) first copies it into the
+# autosave slot 0. A slot is a list (saves:{id}:<slot>) of checkpoints: the
+# first holds the whole progress, each later one only the fields that changed
+# since the one before, so unchanged fields are shared with the earlier
+# checkpoints. A restore is one LRANGE that folds the list; a list that
+# reaches SAVE_CHAIN_LENGTH checkpoints starts over with a full one.
+SAVE_SLOTS = int(os.getenv('SAVE_SLOTS', '3'))
+SAVE_CHAIN_LENGTH = int(os.getenv('SAVE_CHAIN_LENGTH', '20'))
+# Saves outlive the player record, which expires after a day
+SAVE_TTL_DAYS = int(os.getenv('SAVE_TTL_DAYS', '30'))
+AUTOSAVE_SLOT = 0
+# Fields of a player state that belong to the session, not to the progress
+SESSION_FIELDS = frozenset({'last_render', 'message_id', 'locale', 'party'})
+
+# In-memory saves used without Redis: (player, slot) -> checkpoints
+memory_saves = {}
+memory_saves_lock = threading.Lock()
+
+# KEYS[1] = save slot list; ARGV = checkpoint count the new checkpoint was
+# computed from, 1 to start the list over, checkpoint, TTL in seconds.
+# Returns 0 (and writes nothing) if the list changed since it was read.
+APPEND_SAVE_SCRIPT = """
+if redis.call('LLEN', KEYS[1]) ~= tonumber(ARGV[1]) then
+    return 0
+end
+if ARGV[2] == '1' then
+    redis.call('DEL', KEYS[1])
+end
+redis.call('RPUSH', KEYS[1], ARGV[3])
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+return 1
+"""
+append_save_script = None
 
-def reset_player_state(chat_id):
-    """Reset player state to initial values"""
-    str_chat_id = str(chat_id)
-    new_state = {
-        'current_scene': 'start',
-        'inventory': [],
-        'health': 100,
-        'experience': 0
-    }
-    
+def saves_key(player, slot):
+    """Redis key of a player's save slot"""
+    return f"{player_key(player, 'saves')}:{slot}"
+
+def progress_state(state):
+    """The part of a player state a save keeps"""
+    progress = {key: value for key, value in state.items() if key not in SESSION_FIELDS}
+    progress['inventory'] = list(progress.get('inventory', ()))
+    return progress
+
+def has_progress(state):
+    """Whether a player state differs from a new game (a fresh game is not worth an autosave)"""
+    return any(state.get(key) != value for key, value in initial_player_state().items())
+
+def pack_checkpoint(previous, progress):
+    """
+    Encode the fields of progress that differ from previous (and the ones it
+    dropped) as compact JSON, or as zlib + base85 when that is shorter
+    """
+    checkpoint = {'s': {key: value for key, value in progress.items() if key not in previous or previous[key] != value}}
+    removed = [key for key in previous if key not in progress]
+    if removed:
+        checkpoint['d'] = removed
+    data = json.dumps(checkpoint, ensure_ascii=False, separators=(',', ':'))
+    # JSON starts with '{', so the prefix tells the two encodings apart
+    packed = 'z' + base64.b85encode(zlib.compress(data.encode('utf-8'), 9)).decode('ascii')
+    return packed if len(packed) < len(data) else data
+
+def unpack_checkpoint(packed):
+    """Decode a checkpoint written by pack_checkpoint"""
+    if packed.startswith('z'):
+        return json.loads(zlib.decompress(base64.b85decode(packed[1:])))
+    return json.loads(packed)
+
+def fold_checkpoints(checkpoints):
+    """Apply a slot's checkpoints in order; returns the saved progress (None for an empty slot)"""
+    if not checkpoints:
+        return None
+    progress = {}
+    for packed in checkpoints:
+        checkpoint = unpack_checkpoint(packed)
+        progress.update(checkpoint['s'])
+        for key in checkpoint.get('d', ()):
+            progress.pop(key, None)
+    return progress
+
+def read_saves(player, slots):
+    """Read save slots of a player in one round trip: {slot: (progress or None, checkpoint count)}"""
     if redis_client:
-        save_player_data(str_chat_id, new_state)
+        # Every slot of a player shares the hash tag, so one node answers
+        pipe = redis_for(saves_key(player, AUTOSAVE_SLOT)).pipeline(transaction=False)
+        for slot in slots:
+            pipe.lrange(saves_key(player, slot), 0, -1)
+        chains = pipe.execute()
     else:
-        # Update in-memory storage
-        if not hasattr(get_player_state, 'player_states'):
-            get_player_state.player_states = {}
-        get_player_state.player_states[str_chat_id] = new_state
-
-def get_inventory_message(inventory):
-    """Format inventory as a readable message"""
-    if not inventory:
-        return "Ваш инвентарь пуст."
+        with memory_saves_lock:
+            chains = [list(memory_saves.get((str(player), slot), ())) for slot in slots]
+    return {slot: (fold_checkpoints(chain), len(chain)) for slot, chain in zip(slots, chains)}
+
+def next_checkpoint(chain, progress):
+    """The checkpoint that adds progress to a slot's list, and whether it starts the list over"""
+    if not chain or len(chain) >= SAVE_CHAIN_LENGTH:
+        return pack_checkpoint({}, progress), True
+    return pack_checkpoint(fold_checkpoints(chain), progress), False
+
+def write_save(player, slot, state):
+    """Add a checkpoint of a player's progress to a slot: the difference from the slot's last one"""
+    global append_save_script
+    progress = dict(progress_state(state), saved_at=int(time.time()))
+    if not redis_client:
+        with memory_saves_lock:
+            chain = memory_saves.setdefault((str(player), slot), [])
+            checkpoint, restart = next_checkpoint(chain, progress)
+            if restart:
+                chain.clear()
+            chain.append(checkpoint)
+        return
+    if append_save_script is None:
+        append_save_script = redis_client.register_script(APPEND_SAVE_SCRIPT)
+    key = saves_key(player, slot)
+    node = redis_for(key)
+    # A checkpoint only holds the difference from the list it was computed
+    # from: if another writer got in between, read the list again
+    for _ in range(5):
+        chain = node.lrange(key, 0, -1)
+        checkpoint, restart = next_checkpoint(chain, progress)
+        args = [len(chain), int(restart), checkpoint, SAVE_TTL_DAYS * 86400]
+        if append_save_script(keys=[key], args=args, client=node):
+            return
+    raise RuntimeError(f"Save slot {slot} of {player} kept changing while being written")
+
+def restore_save(context, progress):
+    """Replace a player's progress with a saved one (the current one goes to the autosave slot)"""
+    context.reset()
+    progress = {key: value for key, value in progress.items() if key != 'saved_at'}
+    context.state.update(progress)
+    context.record('load', json.dumps(progress, ensure_ascii=False))
+
+# Parties: several players share one adventure and vote on every choice.
+# The shared state is stored once (party:{id}), the members and the message
+# each of them plays in are a hash (members:{id}) and each turn's votes are
+# tallied in a hash (votes:{id}:<round>) by a script, so one vote is one
+# round trip whatever the party size. Members only keep the party id.
+# Votes, joins, leaves and party timers hold the party's lock
+# (player_lock(party_target(id))), so the state and members a turn is
+# played from cannot change under it.
+PARTY_MAX_SIZE = int(os.getenv('PARTY_MAX_SIZE', '10'))
+
+# KEYS[1] = votes hash; ARGV = voter, choice, votes needed.
+# A voter may change their vote (so a split turn can still be settled).
+# Returns {decided, votes for the choice}; votes is -1 for a repeated vote
+# and decided is 1 for exactly one vote: the one reaching the majority.
+CAST_VOTE_SCRIPT = """
+local previous = redis.call('HGET', KEYS[1], 'voter:' .. ARGV[1])
+if previous == ARGV[2] then
+    return {0, -1}
+end
+if previous then
+    redis.call('HINCRBY', KEYS[1], 'choice:' .. previous, -1)
+end
+redis.call('HSET', KEYS[1], 'voter:' .. ARGV[1], ARGV[2])
+local votes = redis.call('HINCRBY', KEYS[1], 'choice:' .. ARGV[2], 1)
+redis.call('EXPIRE', KEYS[1], 86400)
+if votes >= tonumber(ARGV[3]) and redis.call('HSETNX', KEYS[1], 'winner', ARGV[2]) == 1 then
+    return {1, votes}
+end
+return {0, votes}
+"""
+cast_vote_script = None
+
+# KEYS[1] = votes hash; ARGV = member who left, votes needed by the rest.
+# Takes back the member's vote; returns the choice that has the majority
+# of the remaining members (once, like a deciding vote), or nil.
+WITHDRAW_VOTE_SCRIPT = """
+local previous = redis.call('HGET', KEYS[1], 'voter:' .. ARGV[1])
+if previous then
+    redis.call('HDEL', KEYS[1], 'voter:' .. ARGV[1])
+    redis.call('HINCRBY', KEYS[1], 'choice:' .. previous, -1)
+end
+if redis.call('HEXISTS', KEYS[1], 'winner') == 1 then
+    return false
+end
+local fields = redis.call('HGETALL', KEYS[1])
+for i = 1, #fields, 2 do
+    if string.sub(fields[i], 1, 7) == 'choice:' and tonumber(fields[i + 1]) >= tonumber(ARGV[2]) then
+        local choice = string.sub(fields[i], 8)
+        redis.call('HSET', KEYS[1], 'winner', choice)
+        return choice
+    end
+end
+return false
+"""
+withdraw_vote_script = None
+
+# In-memory parties used without Redis: party id -> {'state', 'members'},
+# and party id -> (round, votes) for the turn being voted on
+memory_parties = {}
+memory_votes = {}
+memory_parties_lock = threading.Lock()
+
+def party_target(party_id):
+    """The id a party uses where a chat id is expected (timers, analytics)"""
+    return f'party:{party_id}'
+
+def votes_key(party_id, round_number):
+    """Redis key of the vote tally for one turn of a party"""
+    return f"{player_key(party_id, 'votes')}:{round_number}"
+
+def create_party(chat_id, message_id, text, locale):
+    """Start a party with one member; it plays in the language of its founder. Returns its code"""
+    while True:
+        party_id = secrets.token_hex(3).upper()
+        state = initial_player_state()
+        state.update(round=0, text=text, locale=locale)
+        if redis_client:
+            key = player_key(party_id, 'party')
+            client = redis_for(key)
+            if not client.set(key, json.dumps(state, ensure_ascii=False), ex=86400, nx=True):
+                continue
+            members_key = player_key(party_id, 'members')
+            client.pipeline(transaction=not REDIS_CLUSTER).hset(members_key, chat_id, message_id).expire(
+                members_key, 86400
+            ).execute()
+            return party_id
+        with memory_parties_lock:
+            if party_id not in memory_parties:
+                memory_parties[party_id] = {'state': state, 'members': {str(chat_id): message_id}}
+                return party_id
+
+def load_party(party_id):
+    """Read a party's shared state and members in one round trip; (None, {}) if it is gone"""
+    if redis_client:
+        key = player_key(party_id, 'party')
+        state_json, members = redis_for(key).pipeline(transaction=False).get(key).hgetall(
+            player_key(party_id, 'members')
+        ).execute()
+        return (json.loads(state_json) if state_json else None), members
+    with memory_parties_lock:
+        party = memory_parties.get(party_id)
+        if not party:
+            return None, {}
+        return copy_player_state(party['state']), dict(party['members'])
+
+def add_party_member(party_id, chat_id, message_id):
+    """Add a member (or move them to a new message); returns the member count"""
+    if redis_client:
+        members_key = player_key(party_id, 'members')
+        _, count = redis_for(members_key).pipeline(transaction=not REDIS_CLUSTER).hset(
+            members_key, chat_id, message_id
+        ).hlen(members_key).execute()
+        return count
+    with memory_parties_lock:
+        party = memory_parties.get(party_id)
+        if not party:
+            return 0
+        party['members'][str(chat_id)] = message_id
+        return len(party['members'])
+
+def remove_party_member(party_id, chat_id):
+    """Remove a member; the party is deleted with its last member"""
+    if redis_client:
+        members_key = player_key(party_id, 'members')
+        client = redis_for(members_key)
+        _, count = client.pipeline(transaction=not REDIS_CLUSTER).hdel(members_key, chat_id).hlen(members_key).execute()
+        if not count:
+            client.delete(player_key(party_id, 'party'))
+        return
+    with memory_parties_lock:
+        party = memory_parties.get(party_id)
+        if party:
+            party['members'].pop(str(chat_id), None)
+            if not party['members']:
+                del memory_parties[party_id]
+                memory_votes.pop(party_id, None)
+
+def cast_vote(party_id, round_number, chat_id, choice, needed):
+    """Count one member's vote for a turn; returns (decided, votes for the choice)"""
+    global cast_vote_script
+    if redis_client:
+        if cast_vote_script is None:
+            cast_vote_script = redis_client.register_script(CAST_VOTE_SCRIPT)
+        key = votes_key(party_id, round_number)
+        decided, votes = cast_vote_script(keys=[key], args=[chat_id, choice, needed], client=redis_for(key))
+        return bool(decided), votes
+    with memory_parties_lock:
+        voted_round, votes = memory_votes.get(party_id, (None, None))
+        if voted_round != round_number:
+            votes = {}
+            memory_votes[party_id] = (round_number, votes)
+        previous = votes.get(f'voter:{chat_id}')
+        if previous == choice:
+            return False, -1
+        if previous:
+            votes[f'choice:{previous}'] -= 1
+        votes[f'voter:{chat_id}'] = choice
+        count = votes[f'choice:{choice}'] = votes.get(f'choice:{choice}', 0) + 1
+        if count >= needed and 'winner' not in votes:
+            votes['winner'] = choice
+            return True, count
+        return False, count
+
+def withdraw_vote(party_id, round_number, chat_id, needed):
+    """Take back the vote of a member who left; returns the choice the rest now decide on, or None"""
+    global withdraw_vote_script
+    if redis_client:
+        if withdraw_vote_script is None:
+            withdraw_vote_script = redis_client.register_script(WITHDRAW_VOTE_SCRIPT)
+        key = votes_key(party_id, round_number)
+        return withdraw_vote_script(keys=[key], args=[chat_id, needed], client=redis_for(key))
+    with memory_parties_lock:
+        voted_round, votes = memory_votes.get(party_id, (None, None))
+        if voted_round != round_number:
+            return None
+        previous = votes.pop(f'voter:{chat_id}', None)
+        if previous:
+            votes[f'choice:{previous}'] -= 1
+        if 'winner' in votes:
+            return None
+        for field, count in votes.items():
+            if field.startswith('choice:') and count >= needed:
+                votes['winner'] = field[len('choice:'):]
+                return votes['winner']
+        return None
+
+def leave_party(context, story):
+    """
+    Take a player out of their party, if they are in one; returns the party id.
+    Without their vote the others may now have a majority: then the turn is played.
+    """
+    party_id = context.state.pop('party', None)
+    if party_id:
+        context.changed = True
+        with player_lock(party_target(party_id)):
+            remove_party_member(party_id, context.chat_id)
+            party = PartyContext(party_id)
+            if party.state is not None and party.members:
+                choice = withdraw_vote(party_id, party.round, context.chat_id, len(party.members) // 2 + 1)
+                if choice:
+                    advance_party(story, party, choice, '')
+    return party_id
+
+class PartyContext(PlayerContext):
+    """
+    The shared state of a party, used in place of a PlayerContext when the
+    party's vote moves it on (or a timer fires for it). Party turns are not
+    added to any player's event log or the leaderboard.
+    """
     
-    items_list = "\n".join([f"- {item}" for item in inventory])
-    return f"Ваш инвентарь:\n{items_list}"
-
-def create_main_menu_keyboard():
-    """Create the main menu keyboard with choices"""
-    keyboard = types.InlineKeyboardMarkup()
+    def __init__(self, party_id):
+        self.party_id = party_id
+        self.chat_id = party_target(party_id)
+        self.state, self.members = load_party(party_id)
+        self.round = self.state['round'] if self.state else None
+        self.changed = False
+        self.events = []
+        self.leaderboard = None
+        self.timers = []
     
-    # Create buttons for main choices
-    btn1 = types.InlineKeyboardButton("Исследовать лесную тропу", callback_data='choice_forest')
-    btn2 = types.InlineKeyboardButton("Войти в руины древнего замка", callback_data='choice_castle')
-    btn3 = types.InlineKeyboardButton("Поговорить с деревенским старостой", callback_data='choice_village_head')
-    btn4 = types.InlineKeyboardButton("Проверить инвентарь", callback_data='check_inventory')
+    def record(self, event_type, value=''):
+        pass
     
-    keyboard.row(btn1)
-    keyboard.row(btn2)
-    keyboard.row(btn3)
-    keyboard.row(btn4)
+    def reset(self):
+        # The round and the text live on: the round numbers the vote tallies
+        kept = {key: self.state[key] for key in ('round', 'text', 'locale', 'rng') if key in self.state}
+        self.state = dict(initial_player_state(), **kept)
+        self.changed = True
     
-    return keyboard
+    def add_experience(self, points, name):
+        self.set('experience', self.state.get('experience', 0) + points)
+    
+    def commit(self):
+        """Write the shared state, timers and counters in one round trip; the finished turn's votes are dropped"""
+        if redis_client:
+            key = player_key(self.party_id, 'party')
+            client = redis_for(key)
+            pipe = client.pipeline(transaction=not REDIS_CLUSTER)
+            if self.changed:
+                pipe.setex(key, 86400, json.dumps(self.state, ensure_ascii=False))
+                pipe.expire(player_key(self.party_id, 'members'), 86400)
+            if self.state['round'] != self.round:
+                pipe.delete(votes_key(self.party_id, self.round))
+            shared = pipe if redis_ring is None or client is redis_client else redis_client.pipeline(transaction=False)
+            for timer_id, delay in self.timers:
+                schedule_timer(self.chat_id, timer_id, delay, pipe=shared)
+            flush_stats(shared)
+            pipe.execute()
+            if shared is not pipe:
+                shared.execute()
+        else:
+            with memory_parties_lock:
+                party = memory_parties.get(self.party_id)
+                if party and self.changed:
+                    party['state'] = self.state
+            for timer_id, delay in self.timers:
+                schedule_timer(self.chat_id, timer_id, delay)
+            flush_stats()
+        self.changed = False
+        self.round = self.state['round']
+        self.timers = []
+
+def open_context(target):
+    """Context of a player or, for 'party:<id>', of a party (None if the party is gone)"""
+    if target.startswith('party:'):
+        context = PartyContext(target.split(':', 1)[1])
+        return context if context.state else None
+    return PlayerContext(target)
+
+def ignore_unmodified(chat_id, result, error):
+    """Send callback for edits: an unchanged message is not an error"""
+    if error and 'message is not modified' not in str(error):
+        print(f"Error editing message in {chat_id}: {error}")
+
+def fan_out(members, text, reply_markup=None):
+    """Show a party's scene in every member's message through the send queue"""
+    for member, message_id in members.items():
+        outbound.submit(player_chat(member), text, message_id=int(message_id), reply_markup=reply_markup,
+                        on_done=ignore_unmodified)
+
+# Per-thread flag telling whether the update being handled hit an error
+update_status = threading.local()
+
+def mark_update_failed():
+    """Record that the current update was not fully handled"""
+    update_status.failed = True
+
+# Scene media (photos, audio, ...) is uploaded once per file content: the
+# file_id Telegram returns is cached in memory and in a Redis hash keyed by
+# the content hash, so every later message reuses it instead of the bytes.
+MEDIA_KEY = 'media:{game}'
+# Telegram limits media captions to this many characters; longer scene texts are shown without media
+MEDIA_CAPTION_LIMIT = 1024
+
+# Media type -> (send method, InputMedia class for edits, message attribute with the sent file)
+MEDIA_TYPES = {
+    'photo': ('send_photo', types.InputMediaPhoto, 'photo'),
+    'audio': ('send_audio', types.InputMediaAudio, 'audio'),
+    'animation': ('send_animation', types.InputMediaAnimation, 'animation'),
+    'video': ('send_video', types.InputMediaVideo, 'video')
+}
+# A media file of a scene and the hash of its content
+MediaAsset = collections.namedtuple('MediaAsset', 'type path digest')
+
+# Content hash -> Telegram file_id
+media_file_ids = {}
+
+def cached_file_id(asset):
+    """Return the file_id of an uploaded asset, or None if it was never uploaded"""
+    file_id = media_file_ids.get(asset.digest)
+    if file_id is None and redis_client:
+        try:
+            file_id = redis_client.hget(MEDIA_KEY, asset.digest)
+        except Exception as e:
+            print(f"Error reading media cache from Redis: {e}")
+        if file_id:
+            media_file_ids[asset.digest] = file_id
+    return file_id
+
+def remember_file_id(asset, message):
+    """Cache the file_id of an asset from the message it was uploaded with"""
+    sent = getattr(message, MEDIA_TYPES[asset.type][2], None)
+    if isinstance(sent, list):
+        # Photos come in several sizes; the last one is the original
+        sent = sent[-1] if sent else None
+    if sent is None:
+        return
+    media_file_ids[asset.digest] = sent.file_id
+    if redis_client:
+        try:
+            redis_client.hset(MEDIA_KEY, asset.digest, sent.file_id)
+        except Exception as e:
+            print(f"Error saving media cache to Redis: {e}")
 
-def create_back_to_menu_keyboard():
-    """Create a keyboard with just a back to main menu button"""
-    keyboard = types.InlineKeyboardMarkup()
-    btn = types.InlineKeyboardButton("← Вернуться в главное меню", callback_data='main_menu')
-    keyboard.row(btn)
-    return keyboard
+def forget_file_id(asset):
+    """Drop a file_id Telegram no longer accepts, so the asset is uploaded again"""
+    media_file_ids.pop(asset.digest, None)
+    if redis_client:
+        try:
+            redis_client.hdel(MEDIA_KEY, asset.digest)
+        except Exception as e:
+            print(f"Error removing media cache entry from Redis: {e}")
 
-def create_scene_forest_keyboard():
-    """Create keyboard for forest scene choices"""
-    keyboard = types.InlineKeyboardMarkup()
+def is_rejected_file_id(error):
+    """Whether a send failed because Telegram does not know the file_id (another bot, deleted file)"""
+    description = (error.description or '').lower()
+    return error.error_code == 400 and ('file identifier' in description or 'file_id' in description)
+
+def replace_message(call, send):
+    """
+    Show a scene in a new message and delete the old one: a text message
+    cannot be edited into a media message or back. Returns the new message.
+    """
+    sent = send()
+    try:
+        bot.delete_message(call.message.chat.id, call.message.message_id)
+    except Exception as e:
+        # Too old to delete (48 hours) or already gone; the old message just stays
+        print(f"Could not delete message {call.message.message_id}: {e}")
+    return sent
+
+def show_media(call, text, reply_markup, media):
+    """
+    Show a scene with its media: a media message is switched in place with
+    edit_message_media, a text message is replaced by a new media message.
+    The file is uploaded only if no file_id is cached for its content, or
+    if Telegram rejects the cached one. Returns the id of the message showing the scene.
+    """
+    file_id = cached_file_id(media)
+    if file_id:
+        try:
+            return send_media(call, text, reply_markup, media, file_id)
+        except ApiTelegramException as e:
+            if not is_rejected_file_id(e):
+                raise
+            print(f"Cached file_id of {media.path} was rejected ({e.description}), uploading it again")
+            forget_file_id(media)
+    return send_media(call, text, reply_markup, media, None)
+
+def send_media(call, text, reply_markup, media, file_id):
+    """Show a scene with its media by file_id, or by uploading the file when file_id is None"""
+    chat_id = call.message.chat.id
+    send_method, input_media, _ = MEDIA_TYPES[media.type]
+    source = file_id or open(media.path, 'rb')
+    try:
+        if getattr(call.message, 'content_type', 'text') in MEDIA_TYPES:
+            result = bot.edit_message_media(
+                input_media(source, caption=text), chat_id, call.message.message_id, reply_markup=reply_markup
+            )
+            message_id = call.message.message_id
+        else:
+            result = replace_message(call, lambda: getattr(bot, send_method)(
+                chat_id, source, caption=text, reply_markup=reply_markup
+            ))
+            message_id = result.message_id
+    finally:
+        if not file_id:
+            source.close()
+    if not file_id and isinstance(result, types.Message):
+        remember_file_id(media, result)
+    return message_id
+
+def render_fingerprint(message_id, text, reply_markup=None, media=None):
+    """Compact hash of a rendered message (text plus keyboard and media)"""
+    markup_json = reply_markup.to_json() if reply_markup else ''
+    if media:
+        markup_json += f'\0{media.digest}'
+    digest = hashlib.blake2b(f'{text}\0{markup_json}'.encode('utf-8'), digest_size=8).hexdigest()
+    return f'{message_id}:{digest}'
+
+def render_scene(call, context, text, reply_markup=None, media=None):
+    """
+    Show a scene by editing the callback message (or by replacing it, when
+    the scene switches between text and media).
+    The edit is skipped when the message already shows the same text and keyboard,
+    which saves an API call that Telegram would reject with "message is not modified".
+    Returns True if an edit was sent.
+    """
+    chat_id = call.message.chat.id
+    message_id = call.message.message_id
+    if media and len(text) > MEDIA_CAPTION_LIMIT:
+        media = None
+    fingerprint = render_fingerprint(message_id, text, reply_markup, media)
     
-    btn1 = types.InlineKeyboardButton("Продолжить по тропе", callback_data='forest_path_continue')
-    btn2 = types.InlineKeyboardButton("Свернуть в сторону ручья", callback_data='forest_stream')
-    btn3 = types.InlineKeyboardButton("Искать ягоды", callback_data='forest_berries')
+    if context.state.get('last_render') == fingerprint:
+        return False
     
-    keyboard.row(btn1)
-    keyboard.row(btn2, btn3)
+    try:
+        if media:
+            message_id = show_media(call, text, reply_markup, media)
+        elif getattr(call.message, 'content_type', 'text') in MEDIA_TYPES:
+            message_id = replace_message(
+                call, lambda: bot.send_message(chat_id, text, reply_markup=reply_markup)
+            ).message_id
+        else:
+            bot.edit_message_text(text, chat_id, message_id, reply_markup=reply_markup)
+    except ApiTelegramException as e:
+        # The message already matches (e.g. the fingerprint was lost on restart)
+        if 'message is not modified' not in e.description:
+            mark_update_failed()
+            raise
+    except Exception:
+        mark_update_failed()
+        raise
     
+    if message_id != call.message.message_id:
+        # The scene moved to a new message; a group member plays in that one now
+        if is_group_player(context.chat_id):
+            context.set('message_id', message_id)
+        fingerprint = render_fingerprint(message_id, text, reply_markup, media)
+    context.set('last_render', fingerprint)
+    return True
+
+# Story content is loaded from STORY_PATH, compiled into an immutable Story
+# and swapped atomically on file change (checked every STORY_RELOAD_INTERVAL
+# seconds, 0 disables) or on SIGHUP. Handlers take one reference to the
+# current story per update, so updates in flight finish on the old version.
+STORY_PATH = os.getenv('STORY_PATH', story_graph.DEFAULT_STORY)
+STORY_RELOAD_INTERVAL = float(os.getenv('STORY_RELOAD_INTERVAL', '5'))
+
+# The story is written in one language (its "locale" field, Russian by
+# default); STORY_LOCALES_DIR holds a catalog per other language
+# (<locale>.json: source text -> translation). At load every translatable
+# string gets an id in one flat table, each catalog becomes an array indexed
+# by those ids, and a Story with its own prebuilt keyboards is compiled per
+# locale. Players get the locale of their Telegram language_code.
+STORY_LOCALES_DIR = os.getenv('STORY_LOCALES_DIR', os.path.join(os.path.dirname(STORY_PATH), 'locales'))
+DEFAULT_STORY_LOCALE = 'ru'
+
+# Choices accepted from any scene: returning to the menu is always safe
+ALWAYS_ALLOWED_CHOICES = frozenset({'main_menu'})
+
+# Placeholders a scene text may use
+SCENE_TEXT_FIELDS = frozenset({'grant_note', 'health_change', 'inventory', 'monster', 'roll'})
+
+# What happens in a scene: text to show, item to grant, health and experience
+# change and story timers to start
+SceneOutcome = collections.namedtuple('SceneOutcome', 'text fields grant grant_notes health experience schedule')
+# A compiled scene; with 'requires' set, the outcome depends on having that item
+Scene = collections.namedtuple('Scene', 'id reset requires outcome without_item keyboard media encounter')
+Story = collections.namedtuple(
+    'Story',
+    'version mtime start_scene scenes choices transitions callback_version choice_list messages rare_items '
+    'timers locale item_names locales'
+)
+# An event that fires some time after a scene starts it: a health change
+# and/or an item, announced with a message. A repeating timer starts again
+# while the player is injured.
+TimedEvent = collections.namedtuple('TimedEvent', 'id delay health grant message repeat')
+# Started whenever a player loses health, if the story defines it
+REGEN_TIMER = 'regen'
+
+def compile_outcome(scene_id, data):
+    """Compile the text and effects of a scene (or one branch of it)"""
+    fields = frozenset(name for _, name, _, _ in string.Formatter().parse(data['text']) if name)
+    unknown = fields - SCENE_TEXT_FIELDS
+    if unknown:
+        raise ValueError(f"Scene '{scene_id}' uses unknown placeholders: {', '.join(sorted(unknown))}")
+    if 'grant_note' in fields and len(data.get('grant_notes', ())) != 2:
+        raise ValueError(f"Scene '{scene_id}' uses {{grant_note}} without two grant_notes")
+    return SceneOutcome(
+        text=data['text'],
+        fields=fields,
+        grant=data.get('grant'),
+        grant_notes=tuple(data.get('grant_notes', ())),
+        health=int(data.get('health', 0)),
+        experience=int(data.get('experience', 0)),
+        schedule=tuple(data.get('schedule', ()))
+    )
+
+# Encounters are rolled with a generator per player whose state (one 64-bit
+# integer) is kept in the player record, so the same seed and choices replay
+# the same fights. Every random table (monsters, loot, dice sums) is compiled
+# into cumulative weights: a draw is one generator step and a binary search.
+MASK64 = (1 << 64) - 1
+DICE_PATTERN = re.compile(r'^(\d+)d(\d+)([+-]\d+)?$')
+
+# Values with cumulative integer weights; a draw r in [0, total) picks bisect_right(cumulative, r)
+WeightedTable = collections.namedtuple('WeightedTable', 'values cumulative total')
+Monster = collections.namedtuple('Monster', 'name defense damage experience loot')
+# A fight: a monster from a table, an attack roll (plus bonuses for carried
+# items) against its defense, then the win outcome with loot or the lose
+# outcome with the monster's damage
+Encounter = collections.namedtuple('Encounter', 'monsters attack bonuses win lose')
+
+def next_random(state):
+    """One splitmix64 step: returns (next state, 64-bit random number)"""
+    state = (state + 0x9E3779B97F4A7C15) & MASK64
+    value = ((state ^ (state >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+    value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & MASK64
+    return state, value ^ (value >> 31)
+
+def weighted_table(entries, name):
+    """Build a WeightedTable from (value, weight) pairs"""
+    values, cumulative, total = [], [], 0
+    for value, weight in entries:
+        if weight < 0 or weight != int(weight):
+            raise ValueError(f"Table '{name}' has a weight that is not a whole number >= 0: {weight}")
+        if weight:
+            total += int(weight)
+            values.append(value)
+            cumulative.append(total)
+    if not total:
+        raise ValueError(f"Table '{name}' is empty")
+    return WeightedTable(tuple(values), tuple(cumulative), total)
+
+def dice_table(expression):
+    """Exact distribution of a roll like '2d8+4' as a table of sums"""
+    match = DICE_PATTERN.match(expression.replace(' ', ''))
+    if not match or not 1 <= int(match.group(1)) <= 20 or not 2 <= int(match.group(2)) <= 100:
+        raise ValueError(f"Bad dice expression: '{expression}' (expected NdM+K with N <= 20, M <= 100)")
+    count, sides, modifier = int(match.group(1)), int(match.group(2)), int(match.group(3) or 0)
+    ways = {0: 1}
+    for _ in range(count):
+        rolled = collections.Counter()
+        for total, combinations in ways.items():
+            for face in range(1, sides + 1):
+                rolled[total + face] += combinations
+        ways = rolled
+    return weighted_table(sorted((total + modifier, count) for total, count in ways.items()), expression)
+
+def compile_monsters(data):
+    """Compile the monster tables, with their loot tables and damage dice"""
+    loot = {
+        name: weighted_table([(entry.get('item'), entry['weight']) for entry in entries], f'loot {name}')
+        for name, entries in data.get('loot', {}).items()
+    }
+    monsters = {}
+    for name, entries in data.get('monsters', {}).items():
+        table = []
+        for entry in entries:
+            if entry.get('loot') and entry['loot'] not in loot:
+                raise ValueError(f"Monster '{entry['name']}' drops from unknown loot table '{entry['loot']}'")
+            monster = Monster(
+                name=entry['name'],
+                defense=int(entry['defense']),
+                damage=dice_table(entry['damage']),
+                experience=int(entry.get('experience', 0)),
+                loot=loot.get(entry.get('loot'))
+            )
+            table.append((monster, entry.get('weight', 1)))
+        monsters[name] = weighted_table(table, f'monsters {name}')
+    return monsters
+
+def compile_encounter(scene_id, data, monsters):
+    """Compile the fight of an encounter scene"""
+    if data['monsters'] not in monsters:
+        raise ValueError(f"Scene '{scene_id}' uses unknown monster table '{data['monsters']}'")
+    return Encounter(
+        monsters=monsters[data['monsters']],
+        attack=dice_table(data.get('attack', '1d20')),
+        bonuses=MappingProxyType({item: int(bonus) for item, bonus in data.get('bonuses', {}).items()}),
+        win=compile_outcome(scene_id, data['win']),
+        lose=compile_outcome(scene_id, data['lose'])
+    )
+
+# Content hashes of media files by (path, size, mtime), so reloads and locales hash a file once
+media_digests = {}
+
+def compile_media(scene_id, data, base_dir):
+    """Hash a scene's media file; None (text only) if the file is missing"""
+    media_type = data.get('type', 'photo')
+    if media_type not in MEDIA_TYPES:
+        raise ValueError(f"Scene '{scene_id}' has media of unknown type '{media_type}'")
+    path = os.path.join(base_dir, data['file'])
+    try:
+        stat = os.stat(path)
+        signature = (path, stat.st_size, stat.st_mtime)
+        if signature not in media_digests:
+            with open(path, 'rb') as media_file:
+                media_digests[signature] = hashlib.sha256(media_file.read()).hexdigest()
+    except OSError as e:
+        print(f"Warning: scene '{scene_id}' is shown without media: {e}")
+        return None
+    return MediaAsset(media_type, path, media_digests[signature])
+
+def compile_story_media(data, base_dir=None):
+    """Media of every scene that has some: {scene id: MediaAsset}"""
+    base_dir = base_dir or os.path.dirname(os.path.abspath(STORY_PATH))
+    media = {
+        scene_id: compile_media(scene_id, scene['media'], base_dir)
+        for scene_id, scene in data['scenes'].items() if 'media' in scene
+    }
+    return {scene_id: asset for scene_id, asset in media.items() if asset}
+
+def compile_timer(timer_id, data):
+    """Compile a story timer"""
+    fields = {name for _, name, _, _ in string.Formatter().parse(data.get('message', '')) if name}
+    if fields - {'health'}:
+        raise ValueError(f"Timer '{timer_id}' uses unknown placeholders: {', '.join(sorted(fields - {'health'}))}")
+    return TimedEvent(
+        id=timer_id,
+        delay=float(data['delay']),
+        health=int(data.get('health', 0)),
+        grant=data.get('grant'),
+        message=data.get('message', ''),
+        repeat=bool(data.get('repeat_while_injured'))
+    )
+
+def pack_callback(version, choice_id, nonce=None):
+    """Pack a story version, choice id and optional nonce into callback_data"""
+    packed = struct.pack('>HH', version, choice_id)
+    if nonce is not None:
+        if not 0 <= nonce <= MAX_CALLBACK_NONCE:
+            raise ValueError(f"Callback nonce out of range: {nonce}")
+        packed += nonce.to_bytes(max(1, (nonce.bit_length() + 7) // 8), 'big')
+    return base64.urlsafe_b64encode(packed).rstrip(b'=').decode('ascii')
+
+def build_keyboard(rows, version, choice_ids):
+    """Build an inline keyboard whose buttons carry compact callback data"""
+    keyboard = types.InlineKeyboardMarkup()
+    for row in rows:
+        keyboard.row(*[
+            types.InlineKeyboardButton(button['text'], callback_data=pack_callback(version, choice_ids[button['choice']]))
+            for button in row
+        ])
     return keyboard
 
-def create_scene_castle_keyboard():
-    """Create keyboard for castle scene choices"""
-    keyboard = types.InlineKeyboardMarkup()
+def compile_story(data, mtime=None, locale=None, item_names=None, locales=None, media=None):
+    """
+    Validate story data and compile it into an immutable Story:
+    scenes with prebuilt keyboards, the choice -> scene table and the
+    frozen set of allowed (scene, choice) transitions.
+    """
+    index = story_graph.build_index(data)
+    if index['dead_buttons']:
+        raise ValueError(f"Buttons lead nowhere: {', '.join(index['dead_buttons'])}")
+    missing_scenes = sorted(set(data['choices'].values()) - set(data['scenes']))
+    if missing_scenes:
+        raise ValueError(f"Choices lead to missing scenes: {', '.join(missing_scenes)}")
+    if index['unreachable']:
+        print(f"Warning: unreachable scenes: {', '.join(index['unreachable'])}")
     
-    btn1 = types.InlineKeyboardButton("Подняться по лестнице", callback_data='castle_stairs')
-    btn2 = types.InlineKeyboardButton("Обыскать зал", callback_data='castle_hall_search')
-    btn3 = types.InlineKeyboardButton("Проверить подозрительную дверь", callback_data='castle_door')
+    callback_version = int(index['version'][:4], 16)
+    choice_list = tuple(index['choices'])
+    choice_ids = {choice: choice_id for choice_id, choice in enumerate(choice_list)}
     
-    keyboard.row(btn1)
-    keyboard.row(btn2, btn3)
+    timers = {timer_id: compile_timer(timer_id, timer) for timer_id, timer in data.get('timers', {}).items()}
+    if media is None:
+        media = compile_story_media(data)
+    monsters = compile_monsters(data)
     
-    return keyboard
-
-def create_scene_village_head_keyboard():
-    """Create keyboard for village head scene choices"""
-    keyboard = types.InlineKeyboardMarkup()
+    scenes = {}
+    for scene_id, scene in data['scenes'].items():
+        rows = story_graph.scene_buttons(data, scene)
+        encounter = None
+        if 'requires' in scene:
+            outcome = compile_outcome(scene_id, scene['with_item'])
+            without_item = compile_outcome(scene_id, scene['without_item'])
+        elif 'encounter' in scene:
+            encounter = compile_encounter(scene_id, scene['encounter'], monsters)
+            # The win and lose branches take the places of the item branches
+            outcome, without_item = encounter.win, encounter.lose
+        else:
+            outcome = compile_outcome(scene_id, scene)
+            without_item = None
+        unknown_timers = {timer for branch in (outcome, without_item) if branch for timer in branch.schedule} - set(timers)
+        if unknown_timers:
+            raise ValueError(f"Scene '{scene_id}' starts unknown timers: {', '.join(sorted(unknown_timers))}")
+        scenes[scene_id] = Scene(
+            id=scene_id,
+            reset=bool(scene.get('reset')),
+            requires=scene.get('requires'),
+            outcome=outcome,
+            without_item=without_item,
+            keyboard=build_keyboard(rows, callback_version, choice_ids),
+            media=media.get(scene_id),
+            encounter=encounter
+        )
     
-    btn1 = types.InlineKeyboardButton("Спросить о местных легендах", callback_data='village_legends')
-    btn2 = types.InlineKeyboardButton("Попросить совет", callback_data='village_advice')
-    btn3 = types.InlineKeyboardButton("Предложить помощь", callback_data='village_help')
+    return Story(
+        version=index['version'],
+        mtime=mtime,
+        start_scene=data['start_scene'],
+        scenes=MappingProxyType(scenes),
+        choices=MappingProxyType(dict(data['choices'])),
+        transitions=frozenset(
+            (scene, choice) for scene, choices in index['edges'].items() for choice in choices
+        ),
+        callback_version=callback_version,
+        choice_list=choice_list,
+        messages=MappingProxyType(dict(data['messages'])),
+        rare_items=MappingProxyType({item: int(points) for item, points in data.get('rare_items', {}).items()}),
+        timers=MappingProxyType(timers),
+        locale=locale or data.get('locale', DEFAULT_STORY_LOCALE),
+        item_names=MappingProxyType(item_names or {}),
+        locales=locales if locales is not None else MappingProxyType({})
+    )
+
+def story_items(data):
+    """Names of the items a story grants or checks (inventory entries, shown translated)"""
+    items = dict.fromkeys(data.get('rare_items', ()))
+    for scene in data['scenes'].values():
+        if 'requires' in scene:
+            items[scene['requires']] = None
+        for outcome in story_graph.scene_outcomes(scene):
+            if 'grant' in outcome:
+                items[outcome['grant']] = None
+    for timer in data.get('timers', {}).values():
+        if 'grant' in timer:
+            items[timer['grant']] = None
+    for entries in data.get('loot', {}).values():
+        for entry in entries:
+            if entry.get('item'):
+                items[entry['item']] = None
+    return list(items)
+
+def translate_story_data(data, translate):
+    """
+    Copy story data with translate(text) applied to every text shown to
+    players. With translate=None, collect those texts instead; returns
+    (data, texts). Item names in grant/requires stay as they are: they are
+    the inventory entries.
+    """
+    data = json.loads(json.dumps(data))
+    texts = {}
     
-    keyboard.row(btn1)
-    keyboard.row(btn2, btn3)
+    def text(value):
+        if translate is None:
+            texts[value] = None
+            return value
+        return translate(value)
     
-    return keyboard
+    def buttons(rows):
+        for row in rows:
+            for button in row:
+                button['text'] = text(button['text'])
+    
+    data['messages'] = {name: text(message) for name, message in data['messages'].items()}
+    for rows in data.get('keyboards', {}).values():
+        buttons(rows)
+    for scene in data['scenes'].values():
+        for outcome in story_graph.scene_outcomes(scene):
+            outcome['text'] = text(outcome['text'])
+            if 'grant_notes' in outcome:
+                outcome['grant_notes'] = [text(note) for note in outcome['grant_notes']]
+        buttons(scene.get('buttons', ()))
+    for timer in data.get('timers', {}).values():
+        if timer.get('message'):
+            timer['message'] = text(timer['message'])
+    for monsters in data.get('monsters', {}).values():
+        for monster in monsters:
+            monster['name'] = text(monster['name'])
+    return data, list(texts)
+
+def load_catalogs(directory):
+    """Read the translation catalogs: {locale: {source text: translation}}"""
+    catalogs = {}
+    if not os.path.isdir(directory):
+        return catalogs
+    for name in sorted(os.listdir(directory)):
+        if name.endswith('.json'):
+            with open(os.path.join(directory, name), encoding='utf-8') as catalog_file:
+                catalogs[name[:-len('.json')]] = json.load(catalog_file)
+    return catalogs
+
+def compile_stories(data, mtime, catalogs, base_dir=None):
+    """
+    Compile the story in its own language and in every catalog's language.
+    Returns the source-language Story; story.locales maps every locale code
+    to its Story, source language first (shared by all Story objects of one
+    version).
+    """
+    source_locale = data.get('locale', DEFAULT_STORY_LOCALE)
+    _, texts = translate_story_data(data, None)
+    # One flat table of source strings; a catalog compiles to an array aligned with it
+    strings = texts + [item for item in story_items(data) if item not in set(texts)]
+    string_ids = {string: string_id for string_id, string in enumerate(strings)}
+    
+    locales = {}
+    proxy = MappingProxyType(locales)
+    # Media files are the same in every language
+    media = compile_story_media(data, base_dir)
+    locales[source_locale] = compile_story(data, mtime, source_locale, locales=proxy, media=media)
+    for locale, catalog in catalogs.items():
+        if locale == source_locale:
+            continue
+        table = tuple(catalog.get(string, string) for string in strings)
+        missing = sum(1 for string in strings if string not in catalog)
+        if missing:
+            print(f"Warning: locale '{locale}' has no translation for {missing} of {len(strings)} strings")
+        translated, _ = translate_story_data(data, lambda text: table[string_ids[text]])
+        item_names = {item: table[string_ids[item]] for item in story_items(data)}
+        try:
+            locales[locale] = compile_story(translated, mtime, locale, item_names, proxy, media)
+        except ValueError as e:
+            raise ValueError(f"Locale '{locale}': {e}")
+    return locales[source_locale]
 
-def create_puzzle_solution_keyboard():
-    """Create keyboard for puzzle solution"""
-    keyboard = types.InlineKeyboardMarkup()
+def localize(story, language_code):
+    """
+    The same story version in a player's language (from a Telegram
+    language_code such as 'en' or 'en-US'); the story's own language if
+    there is no catalog for it
+    """
+    localized = story.locales.get((language_code or '')[:2].lower())
+    # The source-language Story is the first one compiled
+    return localized or next(iter(story.locales.values()), story)
+
+def story_files_mtime(path=None):
+    """Latest modification time of the story file and its catalogs"""
+    mtimes = [os.path.getmtime(path or STORY_PATH)]
+    if os.path.isdir(STORY_LOCALES_DIR):
+        mtimes.extend(
+            os.path.getmtime(os.path.join(STORY_LOCALES_DIR, name))
+            for name in os.listdir(STORY_LOCALES_DIR) if name.endswith('.json')
+        )
+    return max(mtimes)
+
+def load_story(path=None):
+    """Load and compile the story file in every locale"""
+    path = path or STORY_PATH
+    mtime = story_files_mtime(path)
+    return compile_stories(
+        story_graph.load_story_data(path), mtime, load_catalogs(STORY_LOCALES_DIR), os.path.dirname(os.path.abspath(path))
+    )
+
+current_story = load_story()
+story_reload_lock = threading.Lock()
+
+def reload_story(reason='manual'):
+    """Compile the story file again and swap it in; keeps the old story if it is invalid"""
+    global current_story
+    with story_reload_lock:
+        try:
+            story = load_story()
+        except Exception as e:
+            print(f"Story reload ({reason}) failed, keeping version {current_story.version}: {e}")
+            return False
+        previous, current_story = current_story, story
+    print(f"Story reloaded ({reason}): version {previous.version} -> {story.version}")
+    return True
+
+def watch_story_file():
+    """Reload the story whenever its file changes"""
+    last_mtime = current_story.mtime
+    while True:
+        time.sleep(STORY_RELOAD_INTERVAL)
+        try:
+            mtime = story_files_mtime()
+        except OSError:
+            continue
+        if mtime != last_mtime:
+            last_mtime = mtime
+            reload_story('file changed')
+
+def start_story_reloading():
+    """Start the story file watcher and reload the story on SIGHUP"""
+    if STORY_RELOAD_INTERVAL > 0:
+        threading.Thread(target=watch_story_file, name='story-watcher', daemon=True).start()
+    if hasattr(signal, 'SIGHUP') and threading.current_thread() is threading.main_thread():
+        # Compile outside the signal handler, which may interrupt a handler
+        signal.signal(signal.SIGHUP, lambda signum, frame: threading.Thread(
+            target=reload_story, args=('SIGHUP',), daemon=True
+        ).start())
+
+def is_transition_allowed(story, current_scene, choice):
+    """Check a button press against the story graph in O(1)"""
+    return choice in ALWAYS_ALLOWED_CHOICES or (current_scene, choice) in story.transitions
+
+# Compact callback_data: base64url of 2 bytes story graph version, 2 bytes
+# choice id and an optional nonce of up to 4 bytes (at most 11 characters).
+# Buttons from another story version no longer decode; buttons sent before
+# the packing carry the plain choice name, which is still accepted.
+MAX_CALLBACK_NONCE = 0xFFFFFFFF
+
+def decode_callback(story, data):
+    """
+    Unpack callback_data into (choice, nonce).
+    Returns (None, None) for malformed data or buttons from another story version.
+    """
+    if not data:
+        return None, None
+    if data in story.choices:
+        # A legacy button: the transition check still applies to it
+        return data, None
+    try:
+        packed = base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+    except (binascii.Error, ValueError):
+        return None, None
+    if not 4 <= len(packed) <= 8:
+        return None, None
+    version, choice_id = struct.unpack_from('>HH', packed)
+    if version != story.callback_version or choice_id >= len(story.choice_list):
+        return None, None
+    nonce = int.from_bytes(packed[4:], 'big') if len(packed) > 4 else None
+    return story.choice_list[choice_id], nonce
+
+def get_inventory_message(story, inventory):
+    """Format inventory as a readable message"""
+    if not inventory:
+        return story.messages['inventory_empty']
     
-    btn1 = types.InlineKeyboardButton("17", callback_data='puzzle_wrong')
-    btn2 = types.InlineKeyboardButton("23", callback_data='puzzle_correct')
-    btn3 = types.InlineKeyboardButton("31", callback_data='puzzle_wrong')
+    items_list = "\n".join([f"- {story.item_names.get(item, item)}" for item in inventory])
+    return f"{story.messages['inventory_header']}\n{items_list}"
+
+# Outbound messages that are not replies to an update (timers, broadcasts)
+# go through a queue drained under Telegram's limits: about 30 messages per
+# second per bot and one per second per chat
+SEND_RATE = float(os.getenv('SEND_RATE', '25'))
+SEND_WORKERS = int(os.getenv('SEND_WORKERS', '4'))
+SEND_QUEUE_SIZE = int(os.getenv('SEND_QUEUE_SIZE', '10000'))
+SEND_CHAT_INTERVAL = float(os.getenv('SEND_CHAT_INTERVAL', '1'))
+
+class TokenBucket:
+    """Allows `rate` operations per second on average, in bursts of up to `capacity`"""
     
-    keyboard.row(btn1, btn2, btn3)
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
     
-    return keyboard
-
-def create_battle_choice_keyboard():
-    """Create keyboard for battle choices"""
-    keyboard = types.InlineKeyboardMarkup()
+    def acquire(self):
+        """Block until a token is available and take it"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+class RateLimitedSender:
+    """
+    A bounded queue of outbound API calls drained by a few threads under a
+    shared token bucket and a minimum interval per chat. Calls rejected with
+    429 Too Many Requests are retried after the delay Telegram asks for.
+    `send(chat_id, *args, **kwargs)` does the actual call (bot.send_message
+    by default), so tests and dry runs can pass a fake.
+    """
     
-    btn1 = types.InlineKeyboardButton("Сражаться", callback_data='battle_fight')
-    btn2 = types.InlineKeyboardButton("Бежать", callback_data='battle_run')
+    def __init__(self, send, rate=SEND_RATE, workers=SEND_WORKERS, queue_size=SEND_QUEUE_SIZE,
+                 chat_interval=SEND_CHAT_INTERVAL):
+        self.send = send
+        self.bucket = TokenBucket(rate)
+        self.workers = workers
+        self.chat_interval = chat_interval
+        self.queue = Queue(maxsize=queue_size)
+        self.last_sent = {}
+        self.last_sent_lock = threading.Lock()
+        self.threads = []
+        self.running = False
     
-    keyboard.row(btn1, btn2)
+    def start(self):
+        """Start the sender threads (again after a fork, which does not copy threads)"""
+        if any(thread.is_alive() for thread in self.threads):
+            return self
+        self.running = True
+        self.threads = [
+            threading.Thread(target=self.run, name=f'sender-{index}', daemon=True) for index in range(self.workers)
+        ]
+        for thread in self.threads:
+            thread.start()
+        return self
     
-    return keyboard
+    def submit(self, chat_id, *args, on_done=None, **kwargs):
+        """
+        Queue a call; blocks while the queue is full. on_done(chat_id, result,
+        error) is called from a sender thread when the call finished or failed.
+        """
+        self.start()
+        self.queue.put((chat_id, args, kwargs, on_done))
+    
+    def run(self):
+        while self.running:
+            try:
+                chat_id, args, kwargs, on_done = self.queue.get(timeout=0.5)
+            except Empty:
+                continue
+            try:
+                self.deliver(chat_id, args, kwargs, on_done)
+            finally:
+                self.queue.task_done()
+    
+    def deliver(self, chat_id, args, kwargs, on_done):
+        result, error = None, None
+        for attempt in range(3):
+            self.wait_for_chat(chat_id)
+            self.bucket.acquire()
+            try:
+                result, error = self.send(chat_id, *args, **kwargs), None
+                break
+            except ApiTelegramException as e:
+                error = e
+                if e.error_code != 429:
+                    break
+                retry_after = (e.result_json or {}).get('parameters', {}).get('retry_after', 1)
+                time.sleep(retry_after)
+            except Exception as e:
+                error = e
+                break
+        if error and not on_done:
+            print(f"Error sending to {chat_id}: {error}")
+        if on_done:
+            try:
+                on_done(chat_id, result, error)
+            except Exception as e:
+                print(f"Error in send callback for {chat_id}: {e}")
+    
+    def wait_for_chat(self, chat_id):
+        """Keep at least chat_interval seconds between calls to one chat"""
+        while True:
+            with self.last_sent_lock:
+                now = time.monotonic()
+                wait = self.last_sent.get(chat_id, 0) + self.chat_interval - now
+                if wait <= 0:
+                    self.last_sent[chat_id] = now
+                    # Forget chats that are quiet long enough
+                    if len(self.last_sent) > 10000:
+                        self.last_sent = {c: t for c, t in self.last_sent.items() if t > now - self.chat_interval}
+                    return
+            time.sleep(wait)
+    
+    def flush(self, timeout):
+        """Wait until the queued calls are done; returns False on timeout"""
+        deadline = time.monotonic() + timeout
+        while self.queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.05)
+        return not self.queue.unfinished_tasks
+    
+    def close(self, timeout=SHUTDOWN_TIMEOUT):
+        """Deliver what is queued (within the timeout) and stop the threads"""
+        if not self.running:
+            return
+        if not self.flush(timeout):
+            print(f"Sender stopped with {self.queue.unfinished_tasks} messages not sent")
+        self.running = False
+        for thread in self.threads:
+            thread.join(1)
+
+def send_outbound(chat_id, text, message_id=None, **kwargs):
+    """Send a message, or edit message_id in place when it is given"""
+    if message_id is None:
+        return bot.send_message(chat_id, text, **kwargs)
+    return bot.edit_message_text(text, chat_id, message_id, **kwargs)
+
+outbound = RateLimitedSender(send_outbound)
+
+# Timer wheel: due story timers live in one sorted set scored by the time
+# they fire (members are 'timer:chat_id', so a player has at most one pending
+# timer of each kind). Workers pop due batches atomically, so every replica
+# can run one and the cost follows the number of due timers, not players.
+TIMER_KEY = 'timers:{game}'
+TIMER_BATCH = int(os.getenv('TIMER_BATCH', '100'))
+TIMER_POLL_INTERVAL = float(os.getenv('TIMER_POLL_INTERVAL', '1'))
+
+POP_DUE_TIMERS_SCRIPT = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+if #due > 0 then
+    redis.call('ZREM', KEYS[1], unpack(due))
+end
+return due
+"""
+pop_due_timers_script = None
+
+# In-memory timers used without Redis: member -> due time, plus a heap by due time
+memory_timers = {}
+memory_timer_heap = []
+memory_timers_lock = threading.Lock()
+
+def schedule_timer(chat_id, timer_id, delay, pipe=None):
+    """Fire a timer for a player after delay seconds, unless one is pending already"""
+    member, due = f'{timer_id}:{chat_id}', time.time() + delay
+    if redis_client:
+        (pipe or redis_client).zadd(TIMER_KEY, {member: due}, nx=True)
+        return
+    with memory_timers_lock:
+        if member not in memory_timers:
+            memory_timers[member] = due
+            heapq.heappush(memory_timer_heap, (due, member))
+
+def pop_due_timers(now, limit):
+    """Take up to limit due timers off the wheel; returns [(timer id, chat id)]"""
+    global pop_due_timers_script
+    if redis_client:
+        if pop_due_timers_script is None:
+            pop_due_timers_script = redis_client.register_script(POP_DUE_TIMERS_SCRIPT)
+        members = pop_due_timers_script(keys=[TIMER_KEY], args=[now, limit])
+    else:
+        members = []
+        with memory_timers_lock:
+            while memory_timer_heap and memory_timer_heap[0][0] <= now and len(members) < limit:
+                _, member = heapq.heappop(memory_timer_heap)
+                members.append(member)
+                del memory_timers[member]
+    return [tuple(member.split(':', 1)) for member in members]
+
+def fire_timer(story, timer_id, chat_id):
+    """
+    Apply a due timer to the player and announce it, under the same player
+    lock and fresh read as an update of that player, whichever process
+    fires it. A player kept locked too long gets the timer on a later pass.
+    """
+    timer = story.timers.get(timer_id)
+    if not timer:
+        # Removed from the story since it was started
+        return
+    try:
+        with player_lock(chat_id):
+            apply_timer(story, timer_id, chat_id)
+    except TimeoutError as e:
+        print(f"Timer {timer_id} for {chat_id} postponed: {e}")
+        schedule_timer(chat_id, timer_id, TIMER_POLL_INTERVAL)
+
+def apply_timer(story, timer_id, chat_id):
+    """Fire a timer for a player whose lock is held"""
+    context = open_context(chat_id)
+    if context is None:
+        return
+    state = context.state
+    timer = localize(story, state.get('locale')).timers[timer_id]
+    changed = not timer.health and not timer.grant
+    if timer.health:
+        health = max(0, min(100, state['health'] + timer.health))
+        if health != state['health']:
+            context.set('health', health)
+            context.record('health', health)
+            changed = True
+    if timer.grant and context.add_item(timer.grant):
+        count_stat('items', timer.grant)
+        changed = True
+    if timer.repeat and state['health'] < 100:
+        context.schedule(timer_id, timer.delay)
+    context.commit()
+    if changed and timer.message:
+        message = timer.message.format(health=state['health'])
+        if isinstance(context, PartyContext):
+            for member in context.members:
+                outbound.submit(player_chat(member), message)
+        else:
+            # A group member gets the news as a reply to their game message
+            outbound.submit(player_chat(chat_id), message, reply_to_message_id=state.get('message_id'))
+
+def run_timer_worker():
+    """Fire due timers until shutdown"""
+    while not shutdown_requested.is_set():
+        try:
+            story = current_story
+            due = pop_due_timers(time.time(), TIMER_BATCH)
+            for timer_id, chat_id in due:
+                try:
+                    fire_timer(story, timer_id, chat_id)
+                except Exception as e:
+                    print(f"Error firing timer {timer_id} for {chat_id}: {e}")
+                finally:
+                    flush_stats()
+            if len(due) < TIMER_BATCH:
+                shutdown_requested.wait(TIMER_POLL_INTERVAL)
+        except Exception as e:
+            print(f"Error in timer worker: {e}")
+            shutdown_requested.wait(TIMER_POLL_INTERVAL)
+
+def start_background_workers():
+    """Start the outbound sender and the timer worker; the sender is flushed on shutdown"""
+    outbound.start()
+    register_shutdown_hook(outbound.close)
+    threading.Thread(target=run_timer_worker, name='timer-worker', daemon=True).start()
+
+def message_player(message):
+    """Player id of the sender of a message"""
+    return player_id(message.chat.id, message.from_user.id)
+
+def send_to_player(message, text, reply_markup=None):
+    """
+    Answer a player's message. In a group the answer is a reply to the
+    sender (in their forum topic, if any), so each member gets their own message.
+    """
+    if message.chat.id == message.from_user.id:
+        return bot.send_message(message.chat.id, text, reply_markup=reply_markup)
+    return bot.reply_to(message, text, reply_markup=reply_markup)
+
+def remember_locale(context, story):
+    """Keep a player's language in their state for messages sent outside an update (timers)"""
+    # No entry means the story's own language, which is compiled first
+    if context.state.get('locale', next(iter(story.locales), story.locale)) != story.locale:
+        context.set('locale', story.locale)
+
+def claim_message(context, sent):
+    """Remember the message a group member plays in; presses by others on it are refused"""
+    if is_group_player(context.chat_id):
+        context.set('message_id', sent.message_id)
+
+def render_leaderboard(story):
+    """Render the top players, reusing the text for LEADERBOARD_CACHE_SECONDS"""
+    cached_story, text, expires_at = leaderboard_cache.get(story.locale, (None, None, 0))
+    if cached_story is story and time.monotonic() < expires_at:
+        return text
+    
+    entries = top_players(LEADERBOARD_SIZE)
+    if entries:
+        lines = [story.messages['leaderboard_header']]
+        lines.extend(
+            f"{place}. {name or story.messages['leaderboard_unnamed'].format(chat_id=member)} — {experience}"
+            for place, (member, name, experience) in enumerate(entries, 1)
+        )
+        text = "\n".join(lines)
+    else:
+        text = story.messages['leaderboard_empty']
+    leaderboard_cache[story.locale] = (story, text, time.monotonic() + LEADERBOARD_CACHE_SECONDS)
+    return text
 
 @bot.message_handler(commands=['start'])
+@one_update_per_player(message_player)
 def start_command(message):
     """
     Handle the /start command
     Resets player state and sends welcome message
     """
+    story = localize(current_story, message.from_user.language_code)
     try:
-        # Reset player state
-        reset_player_state(message.chat.id)
-        
-        # Create welcome message
-        welcome_msg = (
-            "Добро пожаловать в Eldoria! 🌲🏰\n\n"
-            "Вы — смелый искатель приключений, который выбросился на берег в странной деревне после кораблекрушения. "
-            "Ваше путешествие начинается сейчас. Что вы делаете?\n\n"
-            "Ваше здоровье: 100%"
-        )
+        # Reset player state; a new game of one's own leaves the party
+        context = PlayerContext(message_player(message))
+        leave_party(context, story)
+        context.reset()
+        remember_locale(context, story)
         
         # Send welcome message with main menu keyboard
-        bot.send_message(
-            message.chat.id,
-            welcome_msg,
-            reply_markup=create_main_menu_keyboard()
+        start_scene = story.scenes[story.start_scene]
+        sent = send_to_player(
+            message,
+            start_scene.outcome.text,
+            reply_markup=start_scene.keyboard
         )
+        claim_message(context, sent)
+        count_scene_visit(context.chat_id, story.start_scene)
+        context.commit()
         
-        print(f"Started game for user: {message.from_user.username} (ID: {message.chat.id})")
+        print(f"Started game for user: {message.from_user.username} (ID: {context.chat_id})")
         
     except Exception as e:
         print(f"Error in start_command: {e}")
-        bot.reply_to(message, "Произошла ошибка. Попробуйте еще раз.")
+        mark_update_failed()
+        bot.reply_to(message, story.messages['error'])
+    finally:
+        flush_stats()
 
 @bot.message_handler(commands=['restart'])
+@one_update_per_player(message_player)
 def restart_command(message):
     """
     Handle the /restart command
     Resets player state and sends welcome message again
     """
+    story = localize(current_story, message.from_user.language_code)
     try:
-        # Reset player state
-        reset_player_state(message.chat.id)
-        
-        # Create restart message
-        restart_msg = (
-            "Игра перезапущена! 🔄\n\n"
-            "Вы снова в загадочной деревне после кораблекрушения. Что вы делаете?\n\n"
-            "Ваше здоровье: 100%"
-        )
+        # Reset player state; a new game of one's own leaves the party
+        context = PlayerContext(message_player(message))
+        leave_party(context, story)
+        context.reset()
+        remember_locale(context, story)
         
         # Send restart message with main menu keyboard
-        bot.send_message(
-            message.chat.id,
-            restart_msg,
-            reply_markup=create_main_menu_keyboard()
+        sent = send_to_player(
+            message,
+            story.messages['restart'],
+            reply_markup=story.scenes[story.start_scene].keyboard
         )
+        claim_message(context, sent)
+        count_scene_visit(context.chat_id, story.start_scene)
+        context.commit()
         
-        print(f"Restarted game for user: {message.from_user.username} (ID: {message.chat.id})")
+        print(f"Restarted game for user: {message.from_user.username} (ID: {context.chat_id})")
         
     except Exception as e:
         print(f"Error in restart_command: {e}")
-        bot.reply_to(message, "Произошла ошибка. Попробуйте еще раз.")
+        mark_update_failed()
+        bot.reply_to(message, story.messages['error'])
+    finally:
+        flush_stats()
 
-@bot.message_handler(func=lambda message: True)
-def handle_all_messages(message):
+@bot.message_handler(commands=['top'])
+def top_command(message):
     """
-    Handle all other messages that are not commands
+    Handle the /top command
+    Shows the best players and the sender's own place
     """
+    story = localize(current_story, message.from_user.language_code)
     try:
-        bot.reply_to(message, "Пожалуйста, используйте кнопки для выбора.")
+        text = render_leaderboard(story)
+        player = message_player(message)
+        if is_group_player(player):
+            # The group's own ranking, from the chat index
+            entries = chat_leaderboard(message.chat.id, LEADERBOARD_SIZE)
+            if entries:
+                text += "\n\n" + story.messages['leaderboard_chat_header'] + "\n" + "\n".join(
+                    f"{place}. {name or story.messages['leaderboard_unnamed'].format(chat_id=member)} — {experience}"
+                    for place, (member, name, experience) in enumerate(entries, 1)
+                )
+        rank = player_rank(player)
+        if rank:
+            text += "\n\n" + story.messages['leaderboard_rank'].format(rank=rank[0], experience=rank[1])
+        else:
+            text += "\n\n" + story.messages['leaderboard_unranked']
+        send_to_player(message, text)
     except Exception as e:
-        print(f"Error handling message: {e}")
+        print(f"Error in top_command: {e}")
+        mark_update_failed()
+        bot.reply_to(message, story.messages['error'])
 
-@bot.callback_query_handler(func=lambda call: True)
-def handle_callback(call):
+@bot.message_handler(commands=['party'])
+@one_update_per_player(message_player)
+def party_command(message):
     """
-    Main callback handler for all inline keyboard button presses
+    Handle the /party command
+    Starts a party with the sender as its first member
     """
+    story = localize(current_story, message.from_user.language_code)
     try:
-        # Acknowledge the callback
-        bot.answer_callback_query(call.id)
-        
-        # Get player state
-        player_state = get_player_state(call.message.chat.id)
+        context = PlayerContext(message_player(message))
+        party_id = context.state.get('party')
+        if party_id:
+            send_to_player(message, story.messages['party_already'].format(code=party_id))
+            return
         
-        # Update current scene based on callback data
-        if call.data.startswith('choice_'):
-            player_state['current_scene'] = call.data
+        start_scene = story.scenes[story.start_scene]
+        sent = send_to_player(message, start_scene.outcome.text, reply_markup=start_scene.keyboard)
+        party_id = create_party(context.chat_id, sent.message_id, start_scene.outcome.text, story.locale)
+        context.set('party', party_id)
+        context.commit()
+        send_to_player(message, story.messages['party_created'].format(code=party_id))
         
-        # Handle different callback actions
-        if call.data == 'choice_forest':
-            scene_forest(call)
-        elif call.data == 'choice_castle':
-            scene_castle(call)
-        elif call.data == 'choice_village_head':
-            scene_village_head(call)
-        elif call.data == 'check_inventory':
-            scene_check_inventory(call)
-        elif call.data == 'main_menu':
-            scene_main_menu(call)
-        elif call.data == 'forest_path_continue':
-            scene_forest_path_continue(call)
-        elif call.data == 'forest_stream':
-            scene_forest_stream(call)
-        elif call.data == 'forest_berries':
-            scene_forest_berries(call)
-        elif call.data == 'castle_stairs':
-            scene_castle_stairs(call)
-        elif call.data == 'castle_hall_search':
-            scene_castle_hall_search(call)
-        elif call.data == 'castle_door':
-            scene_castle_door(call)
-        elif call.data == 'village_legends':
-            scene_village_legends(call)
-        elif call.data == 'village_advice':
-            scene_village_advice(call)
-        elif call.data == 'village_help':
-            scene_village_help(call)
-        elif call.data == 'puzzle_correct':
-            scene_puzzle_correct(call)
-        elif call.data == 'puzzle_wrong':
-            scene_puzzle_wrong(call)
-        elif call.data == 'battle_fight':
-            scene_battle_fight(call)
-        elif call.data == 'battle_run':
-            scene_battle_run(call)
-        else:
-            # Unknown callback
-            bot.edit_message_text(
-                "Неизвестный выбор. Пожалуйста, вернитесь в главное меню.",
-                call.message.chat.id,
-                call.message.message_id,
-                reply_markup=create_back_to_menu_keyboard()
-            )
+        print(f"Party {party_id} started by user: {message.from_user.username} (ID: {context.chat_id})")
         
     except Exception as e:
-        print(f"Error in callback handler: {e}")
-        try:
-            bot.answer_callback_query(call.id, "Произошла ошибка. Попробуйте еще раз.")
-        except:
-            pass
+        print(f"Error in party_command: {e}")
+        mark_update_failed()
+        bot.reply_to(message, story.messages['error'])
 
-def scene_main_menu(call):
-    """Return to main menu scene"""
-    try:
-        reset_player_state(call.message.chat.id)
-        
-        msg = (
-            "Вы вернулись в главное меню! 🏡\n\n"
-            "Добро пожаловать в Eldoria! Вы — смелый искатель приключений, который выбросился на берег в странной деревне после кораблекрушения. "
-            "Ваше путешествие начинается сейчас. Что вы делаете?\n\n"
-            "Ваше здоровье: 100%"
-        )
-        
-        bot.edit_message_text(
-            msg,
-            call.message.chat.id,
-            call.message.message_id,
-            reply_markup=create_main_menu_keyboard()
-        )
-    except Exception as e:
-        print(f"Error in scene_main_menu: {e}")
-
-def scene_forest(call):
-    """Forest scene - first level choice"""
+@bot.message_handler(commands=['join'])
+@one_update_per_player(message_player)
+def join_command(message):
+    """
+    Handle the /join CODE command
+    Adds the sender to a party and shows them the party's current scene
+    """
+    story = localize(current_story, message.from_user.language_code)
     try:
-        msg = (
-            "Вы покидаете деревню и входите в густой лес. Деревья здесь высокие и мрачные, "
-            "а между ними пробиваются солнечные лучи. Воздух наполнен ароматом мха и влажной листвы. "
-            "Вы видите тропинку, ведущую вглубь леса, и слышите звуки животных.\n\n"
-            "Что вы хотите сделать?"
-        )
+        args = message.text.split(maxsplit=1)
+        if len(args) < 2:
+            send_to_player(message, story.messages['party_join_usage'])
+            return
+        code = args[1].strip().upper()
+        
+        context = PlayerContext(message_player(message))
+        if context.state.get('party'):
+            send_to_player(message, story.messages['party_already'].format(code=context.state['party']))
+            return
+        state, members = load_party(code)
+        if state is None:
+            send_to_player(message, story.messages['party_not_found'])
+            return
+        if len(members) >= PARTY_MAX_SIZE:
+            send_to_player(message, story.messages['party_full'].format(size=len(members)))
+            return
+        
+        # The party's scene, with buttons in the party's language
+        party_story = localize(story, state.get('locale'))
+        scene = party_story.scenes.get(state['current_scene'], party_story.scenes[party_story.start_scene])
+        send_to_player(message, story.messages['party_joined'].format(code=code, members=len(members) + 1))
+        sent = send_to_player(message, state.get('text') or scene.outcome.text, reply_markup=scene.keyboard)
+        with player_lock(party_target(code)):
+            added = add_party_member(code, context.chat_id, sent.message_id)
+        if not added:
+            send_to_player(message, story.messages['party_not_found'])
+            return
+        context.set('party', code)
+        context.commit()
+        
+        print(f"User {message.from_user.username} (ID: {context.chat_id}) joined party {code}")
         
-        bot.edit_message_text(
-            msg,
-            call.message.chat.id,
-            call.message.message_id,
-            reply_markup=create_scene_forest_keyboard()
-        )
     except Exception as e:
-        print(f"Error in scene_forest: {e}")
+        print(f"Error in join_command: {e}")
+        mark_update_failed()
+        bot.reply_to(message, story.messages['error'])
 
-def scene_forest_path_continue(call):
-    """Continue along the forest path"""
+@bot.message_handler(commands=['leave'])
+@one_update_per_player(message_player)
+def leave_command(message):
+    """
+    Handle the /leave command
+    Takes the sender out of their party
+    """
+    story = localize(current_story, message.from_user.language_code)
     try:
-        msg = (
-            "Вы продолжаете идти по тропе, и вскоре замечаете странный камень с вырезанными символами. "
-            "На камне написано: 'Только храбрец может пройти дальше. Ответь на загадку: "
-            "Какое число является следующим в последовательности: 2, 3, 5, 11, 13, ?'\n\n"
-            "Выберите правильный ответ:"
-        )
-        
-        bot.edit_message_text(
-            msg,
-            call.message.chat.id,
-            call.message.message_id,
-            reply_markup=create_puzzle_solution_keyboard()
-        )
+        context = PlayerContext(message_player(message))
+        if not leave_party(context, story):
+            send_to_player(message, story.messages['party_none'])
+            return
+        context.commit()
+        send_to_player(message, story.messages['party_left'])
     except Exception as e:
-        print(f"Error in scene_forest_path_continue: {e}")
-
-def scene_forest_stream(call):
-    """Go to the stream in the forest"""
+        print(f"Error in leave_command: {e}")
+        mark_update_failed()
+        bot.reply_to(message, story.messages['error'])
+
+def command_slot(message, default=None):
+    """The save slot given after a command (default if none); None if it is not a valid slot"""
+    args = message.text.split(maxsplit=1)
+    if len(args) < 2:
+        return default
+    slot = args[1].strip()
+    if not slot.isdigit() or int(slot) > SAVE_SLOTS:
+        return None
+    return int(slot)
+
+def render_slots(story, saves):
+    """Describe a player's save slots"""
+    lines = [story.messages['slots_header']]
+    for slot, (progress, _) in sorted(saves.items()):
+        name = story.messages['slot_autosave'] if slot == AUTOSAVE_SLOT else str(slot)
+        if progress is None:
+            lines.append(story.messages['slot_empty'].format(slot=name))
+            continue
+        lines.append(story.messages['slot_entry'].format(
+            slot=name,
+            health=progress.get('health', 100),
+            experience=progress.get('experience', 0),
+            items=len(progress.get('inventory', ())),
+            saved_at=time.strftime('%d.%m.%Y %H:%M UTC', time.gmtime(progress.get('saved_at', 0)))
+        ))
+    lines.append(story.messages['slots_hint'])
+    return "\n".join(lines)
+
+@bot.message_handler(commands=['save'])
+@one_update_per_player(message_player)
+def save_command(message):
+    """
+    Handle the /save [N] command
+    Saves the sender's progress into slot N (1 by default)
+    """
+    story = localize(current_story, message.from_user.language_code)
     try:
-        # Add a potion to inventory
-        success = add_to_inventory(call.message.chat.id, 'Зелье здоровья')
-        
-        msg = (
-            "Вы находите красивый ручей с кристально чистой водой. Вода светится мягким голубым светом. "
-            "Рядом с ручьем вы замечаете бутылочку с таинственным зельем. "
-            f"{'Вы добавляете зелье в инвентарь.' if success else 'У вас уже есть это зелье.'}\n\n"
-            "Что вы делаете дальше?"
-        )
-        
-        # Create new keyboard with different choices
-        keyboard = types.InlineKeyboardMarkup()
-        btn1 = types.InlineKeyboardButton("Выпить зелье", callback_data='drink_potion')
-        btn2 = types.InlineKeyboardButton("Продолжить путь", callback_data='continue_after_stream')
-        btn3 = types.InlineKeyboardButton("Вернуться в деревню", callback_data='main_menu')
-        
-        keyboard.row(btn1)
-        keyboard.row(btn2, btn3)
+        slot = command_slot(message, default=1)
+        if not slot:
+            send_to_player(message, story.messages['save_usage'].format(slots=SAVE_SLOTS))
+            return
+        context = PlayerContext(message_player(message))
+        if context.state.get('party'):
+            send_to_player(message, story.messages['save_party'])
+            return
+        write_save(context.chat_id, slot, context.state)
+        send_to_player(message, story.messages['save_done'].format(slot=slot))
+        
+        print(f"User {message.from_user.username} (ID: {context.chat_id}) saved to slot {slot}")
         
-        bot.edit_message_text(
-            msg,
-            call.message.chat.id,
-            call.message.message_id,
-            reply_markup=keyboard
-        )
     except Exception as e:
-        print(f"Error in scene_forest_stream: {e}")
+        print(f"Error in save_command: {e}")
+        mark_update_failed()
+        bot.reply_to(message, story.messages['error'])
 
-def scene_forest_berries(call):
-    """Look for berries in the forest"""
+@bot.message_handler(commands=['load'])
+@one_update_per_player(message_player)
+def load_command(message):
+    """
+    Handle the /load N command
+    Restores the progress saved in slot N and shows its scene
+    """
+    story = localize(current_story, message.from_user.language_code)
     try:
-        # Add berries to inventory
-        success = add_to_inventory(call.message.chat.id, 'Ягоды')
-        
-        msg = (
-            "Вы находите куст со странными светящимися ягодами. Они имеют фиолетовый цвет и издают мягкий свет. "
-            f"{'Вы добавляете ягоды в инвентарь.' if success else 'У вас уже есть эти ягоды.'}\n\n"
-            "Вдалеке вы слышите рычание. Кажется, что-то движется в кустах..."
-        )
-        
-        # Create new keyboard with encounter choices
-        keyboard = types.InlineKeyboardMarkup()
-        btn1 = types.InlineKeyboardButton("Приготовиться к бою", callback_data='prepare_battle')
-        btn2 = types.InlineKeyboardButton("Спрятаться", callback_data='hide_from_beast')
-        btn3 = types.InlineKeyboardButton("Вернуться в деревню", callback_data='main_menu')
+        slot = command_slot(message)
+        if slot is None:
+            send_to_player(message, story.messages['load_usage'].format(slots=SAVE_SLOTS))
+            return
+        context = PlayerContext(message_player(message))
+        progress, _ = read_saves(context.chat_id, [slot])[slot]
+        if progress is None:
+            send_to_player(message, story.messages['slot_missing'].format(slot=slot))
+            return
+        
+        # Loading a game of one's own leaves the party, like /start
+        leave_party(context, story)
+        scene_id = progress.get('current_scene')
+        if scene_id not in story.scenes:
+            # The scene was removed from the story since the save
+            scene_id = progress['current_scene'] = story.start_scene
+        restore_save(context, progress)
+        remember_locale(context, story)
+        
+        sent = send_to_player(
+            message,
+            story.messages['save_loaded'].format(
+                slot=slot, health=context.state['health'], experience=context.state.get('experience', 0)
+            ),
+            reply_markup=story.scenes[scene_id].keyboard
+        )
+        claim_message(context, sent)
+        context.commit()
+        
+        print(f"User {message.from_user.username} (ID: {context.chat_id}) loaded slot {slot}")
         
-        keyboard.row(btn1, btn2)
-        keyboard.row(btn3)
-        
-        bot.edit_message_text(
-            msg,
-            call.message.chat.id,
-            call.message.message_id,
-            reply_markup=keyboard
-        )
     except Exception as e:
-        print(f"Error in scene_forest_berries: {e}")
+        print(f"Error in load_command: {e}")
+        mark_update_failed()
+        bot.reply_to(message, story.messages['error'])
 
-def scene_castle(call):
-    """Castle scene - first level choice"""
+@bot.message_handler(commands=['slots'])
+def slots_command(message):
+    """
+    Handle the /slots command
+    Lists the sender's save slots
+    """
+    story = localize(current_story, message.from_user.language_code)
     try:
-        msg = (
-            "Вы подходите к руинам древнего замка. Стены покрыты мхом и лишайником, "
-            "а башни частично разрушены временем. Ворота приоткрыты, и изнутри доносится странный шум. "
-            "Вы чувствуете, что внутри может скрываться что-то ценное.\n\n"
-            "Куда вы пойдете?"
-        )
-        
-        bot.edit_message_text(
-            msg,
-            call.message.chat.id,
-            call.message.message_id,
-            reply_markup=create_scene_castle_keyboard()
-        )
+        saves = read_saves(message_player(message), range(SAVE_SLOTS + 1))
+        send_to_player(message, render_slots(story, saves))
     except Exception as e:
-        print(f"Error in scene_castle: {e}")
+        print(f"Error in slots_command: {e}")
+        mark_update_failed()
+        bot.reply_to(message, story.messages['error'])
 
-def scene_castle_stairs(call):
-    """Go up the stairs in the castle"""
+@bot.message_handler(func=lambda message: True)
+def handle_all_messages(message):
+    """
+    Handle all other messages that are not commands
+    """
+    # In a group every message of the chat may arrive here (privacy mode
+    # off); answering them all would flood the chat
+    if message.chat.type != 'private':
+        return
     try:
-        # Add a sword to inventory
-        success = add_to_inventory(call.message.chat.id, 'Меч')
-        
-        msg = (
-            "Вы поднимаетесь по витиеватой каменной лестнице. На стене висит старый меч в ножнах. "
-            f"{'Вы берете меч и добавляете его в инвентарь.' if success else 'У вас уже есть меч.'}\n\n"
-            "На верхней площадке вы видите дверь с символами. Из-за двери доносится таинственный свет."
-        )
-        
-        # Create new keyboard with choices
-        keyboard = types.InlineKeyboardMarkup()
-        btn1 = types.InlineKeyboardButton("Открыть дверь", callback_data='open_mystery_door')
-        btn2 = types.InlineKeyboardButton("Осмотреть комнату", callback_data='inspect_room')
-        btn3 = types.InlineKeyboardButton("Спуститься вниз", callback_data='go_downstairs')
-        
-        keyboard.row(btn1)
-        keyboard.row(btn2, btn3)
-        
-        bot.edit_message_text(
-            msg,
-            call.message.chat.id,
-            call.message.message_id,
-            reply_markup=keyboard
-        )
+        bot.reply_to(message, localize(current_story, message.from_user.language_code).messages['use_buttons'])
     except Exception as e:
-        print(f"Error in scene_castle_stairs: {e}")
+        print(f"Error handling message: {e}")
 
-def scene_castle_hall_search(call):
-    """Search the hall in the castle"""
-    try:
-        # Add treasure to inventory
-        success = add_to_inventory(call.message.chat.id, 'Сокровище')
-        
-        msg = (
-            "Вы обыскиваете большой зал. На полу лежит пыльный ковер, а на стенах висят старые гобелены. "
-            "В углу вы замечаете сундук с золотыми украшениями. "
-            f"{'Вы открываете сундук и находите сокровище!' if success else 'Вы уже нашли сокровище ранее.'}\n\n"
-            "Внезапно вы слышите шаги в коридоре. Кто-то идет!"
-        )
-        
-        # Create new keyboard with choices
-        keyboard = types.InlineKeyboardMarkup()
-        btn1 = types.InlineKeyboardButton("Спрятаться", callback_data='hide_in_castle')
-        btn2 = types.InlineKeyboardButton("Пойти навстречу", callback_data='meet_guardian')
-        btn3 = types.InlineKeyboardButton("Вернуться в деревню", callback_data='main_menu')
-        
-        keyboard.row(btn1, btn2)
-        keyboard.row(btn3)
-        
-        bot.edit_message_text(
-            msg,
-            call.message.chat.id,
-            call.message.message_id,
-            reply_markup=keyboard
-        )
-    except Exception as e:
-        print(f"Error in scene_castle_hall_search: {e}")
+def callback_player(call):
+    """Player id of the member who pressed a button"""
+    return player_id(call.message.chat.id, call.from_user.id)
 
-def scene_castle_door(call):
-    """Check the suspicious door in the castle"""
+@bot.callback_query_handler(func=lambda call: True)
+@one_update_per_player(callback_player)
+def handle_callback(call):
+    """
+    Main callback handler for all inline keyboard button presses
+    """
+    # Drop repeated taps before touching state or the API
+    if is_duplicate_callback(call):
+        # Still answered, or the client shows a spinner until Telegram gives up
+        try:
+            bot.answer_callback_query(call.id)
+        except Exception as e:
+            print(f"Error answering repeated callback: {e}")
+        return
+    
+    # The whole update runs on the story version that was current when it
+    # arrived, in the player's language
+    story = localize(current_story, call.from_user.language_code)
     try:
-        msg = (
-            "Вы подходите к подозрительной двери. Она выглядит новее остальных в замке, "
-            "и на ней висит замок с символами. Когда вы прикасаетесь к двери, она медленно открывается, "
-            "и вы видите комнату с алтарем посередине. На алтаре лежит свиток.\n\n"
-            "Что вы делаете?"
-        )
+        chat_id = callback_player(call)
+        choice, _ = decode_callback(story, call.data)
+        # One read of the player's state per update, one write at the end
+        context = PlayerContext(chat_id)
+        if context.state.get('party'):
+            play_party_turn(call, story, context, choice)
+            return
+        
+        remember_locale(context, story)
+        
+        # In a group, each member plays in their own message
+        if is_group_player(chat_id) and context.state.get('message_id') != call.message.message_id:
+            bot.answer_callback_query(call.id, story.messages['not_your_message'])
+            return
+        current_scene = context.state.get('current_scene', story.start_scene)
+        
+        # Reject stale, forged or outdated buttons before any state write or edit
+        if choice is None or not is_transition_allowed(story, current_scene, choice):
+            bot.answer_callback_query(call.id, story.messages['stale_button'])
+            return
         
-        # Create new keyboard with choices
-        keyboard = types.InlineKeyboardMarkup()
-        btn1 = types.InlineKeyboardButton("Взять свиток", callback_data='take_scroll')
-        btn2 = types.InlineKeyboardButton("Осмотреть алтарь", callback_data='examine_altar')
-        btn3 = types.InlineKeyboardButton("Уйти", callback_data='leave_door')
+        # Acknowledge the callback
+        bot.answer_callback_query(call.id)
         
-        keyboard.row(btn1, btn2)
-        keyboard.row(btn3)
+        scene_id = story.choices[choice]
+        play_scene(call, story, context, scene_id)
         
-        bot.edit_message_text(
-            msg,
-            call.message.chat.id,
-            call.message.message_id,
-            reply_markup=keyboard
-        )
-    except Exception as e:
-        print(f"Error in scene_castle_door: {e}")
-
-def scene_village_head(call):
-    """Village head scene - first level choice"""
-    try:
-        msg = (
-            "Вы подходите к домику деревенского старосты. Это пожилой мужчина с седой бородой и добрыми глазами. "
-            "Он сидит на лавочке перед домом и курит трубку. Увидев вас, он улыбается и машет рукой.\n\n"
-            "'Ах, путешественник! Расскажи, что привело тебя в нашу деревню?'"
-        )
+        # Remember where the player is so the next click can be validated
+        context.set('current_scene', scene_id)
+        context.record('scene', scene_id)
+        count_stat('edges', f'{current_scene}>{choice}')
+        count_scene_visit(chat_id, scene_id)
+        context.commit()
         
-        bot.edit_message_text(
-            msg,
-            call.message.chat.id,
-            call.message.message_id,
-            reply_markup=create_scene_village_head_keyboard()
-        )
     except Exception as e:
-        print(f"Error in scene_village_head: {e}")
+        print(f"Error in callback handler: {e}")
+        mark_update_failed()
+        # Nothing of a failed update is written, its counters included
+        pending_stat_ops().clear()
+        try:
+            bot.answer_callback_query(call.id, story.messages['error'])
+        except:
+            pass
+    finally:
+        flush_stats()
 
-def scene_village_legends(call):
-    """Ask about local legends"""
+def play_scene(call, story, context, scene_id):
+    """
+    Show a scene: apply its effects to the player context and render its
+    text and keyboard
+    """
     try:
-        msg = (
-            "Староста задумчиво курит трубку: 'В наших краях ходят легенды о Древнем Хранителе, "
-            "который охраняет сокровища в развалинах замка. Говорят, что тот, кто сможет решить его загадки, "
-            "получит великую силу.'\n\n"
-            "Он протягивает вам старую карту: 'Возьми, может пригодиться.'"
-        )
-        
-        # Add map to inventory
-        success = add_to_inventory(call.message.chat.id, 'Карта')
-        
-        # Create new keyboard with choices
-        keyboard = types.InlineKeyboardMarkup()
-        btn1 = types.InlineKeyboardButton("Исследовать лес", callback_data='choice_forest')
-        btn2 = types.InlineKeyboardButton("Посетить замок", callback_data='choice_castle')
-        btn3 = types.InlineKeyboardButton("Поблагодарить старосту", callback_data='thank_village_head')
-        
-        keyboard.row(btn1, btn2)
-        keyboard.row(btn3)
-        
-        bot.edit_message_text(
+        msg = apply_scene(story, context, scene_id, call.from_user.first_name)
+        scene = story.scenes[scene_id]
+        render_scene(
+            call,
+            context,
             msg,
-            call.message.chat.id,
-            call.message.message_id,
-            reply_markup=keyboard
+            reply_markup=scene.keyboard,
+            media=scene.media
         )
     except Exception as e:
-        print(f"Error in scene_village_legends: {e}")
+        # The scene was not shown: the caller must not commit the update
+        print(f"Error in scene {scene_id}: {e}")
+        raise
 
-def scene_village_advice(call):
-    """Ask for advice"""
-    try:
-        msg = (
-            "Староста серьезно смотрит на вас: 'Если хочешь выжить в этих краях, запомни: "
-            "в лесу опасайся светящихся ягод, в замке не доверяй дверям, которые слишком легко открываются, "
-            "а в общении с духами всегда будь вежлив.'\n\n"
-            "Он дает вам небольшой амулет: 'Этот талисман защитит тебя от злых духов.'"
-        )
-        
-        # Add amulet to inventory
-        success = add_to_inventory(call.message.chat.id, 'Амулет защиты')
-        
-        # Create new keyboard with choices
-        keyboard = types.InlineKeyboardMarkup()
-        btn1 = types.InlineKeyboardButton("Исследовать местность", callback_data='explore_outskirts')
-        btn2 = types.InlineKeyboardButton("Проверить инвентарь", callback_data='check_inventory')
-        btn3 = types.InlineKeyboardButton("Поблагодарить старосту", callback_data='thank_village_head')
-        
-        keyboard.row(btn1)
-        keyboard.row(btn2, btn3)
-        
-        bot.edit_message_text(
-            msg,
-            call.message.chat.id,
-            call.message.message_id,
-            reply_markup=keyboard
-        )
-    except Exception as e:
-        print(f"Error in scene_village_advice: {e}")
+def play_party_turn(call, story, context, choice):
+    """
+    Count a party member's vote; the vote that reaches the majority moves the
+    party to the chosen scene and shows it in every member's message
+    """
+    with player_lock(party_target(context.state['party'])):
+        party = PartyContext(context.state['party'])
+        member = party.state is not None and context.chat_id in party.members
+        if member:
+            play_party_vote(call, story, context, party, choice)
+    if not member:
+        # The party is gone (or expired) while the player still pointed to it
+        leave_party(context, story)
+        context.commit()
+        bot.answer_callback_query(call.id, story.messages['stale_button'])
+
+def play_party_vote(call, story, context, party, choice):
+    """Count a member's vote in a party whose lock is held"""
+    current_scene = party.state.get('current_scene', story.start_scene)
+    if choice is None or not is_transition_allowed(story, current_scene, choice):
+        bot.answer_callback_query(call.id, story.messages['stale_button'])
+        return
+    
+    needed = len(party.members) // 2 + 1
+    decided, votes = cast_vote(party.party_id, party.round, context.chat_id, choice, needed)
+    if votes < 0:
+        bot.answer_callback_query(call.id, story.messages['party_voted'])
+        return
+    if not decided:
+        bot.answer_callback_query(call.id, story.messages['party_vote'].format(votes=votes, needed=needed))
+        return
+    bot.answer_callback_query(call.id)
+    advance_party(story, party, choice, call.from_user.first_name)
+
+def advance_party(story, party, choice, name):
+    """
+    Play the choice a party decided on and show the new scene in every
+    member's message (with the party's lock held)
+    """
+    party_story = localize(story, party.state.get('locale'))
+    current_scene = party.state.get('current_scene', story.start_scene)
+    if not is_transition_allowed(party_story, current_scene, choice):
+        return
+    scene_id = party_story.choices[choice]
+    text = apply_scene(party_story, party, scene_id, name)
+    party.set('current_scene', scene_id)
+    party.set('text', text)
+    party.set('round', party.round + 1)
+    count_stat('edges', f'{current_scene}>{choice}')
+    count_scene_visit(party.chat_id, scene_id)
+    party.commit()
+    fan_out(party.members, text, party_story.scenes[scene_id].keyboard)
+
+def apply_scene(story, context, scene_id, name):
+    """
+    Apply the effects of a scene (reset, item, health, experience, timers)
+    to a player or party context and return the text to show
+    """
+    scene = story.scenes[scene_id]
+    
+    if scene.reset:
+        context.reset()
+    player_state = context.state
+    
+    # Scenes with a required item play out differently without it
+    outcome = scene.outcome
+    values = {}
+    if scene.requires and scene.requires not in player_state['inventory']:
+        outcome = scene.without_item
+    elif scene.encounter:
+        outcome, values = run_encounter(story, context, scene.encounter)
+    
+    experience = outcome.experience
+    if outcome.grant:
+        success = context.add_item(outcome.grant)
+        if success:
+            count_stat('items', outcome.grant)
+            # Rare finds are worth experience the first time they are found
+            experience += story.rare_items.get(outcome.grant, 0)
+        if outcome.grant_notes:
+            values['grant_note'] = outcome.grant_notes[0 if success else 1]
+    
+    if outcome.health:
+        old_health = player_state['health']
+        context.set('health', max(0, min(100, old_health + outcome.health)))
+        values['health_change'] = abs(player_state['health'] - old_health)
+        context.record('health', player_state['health'])
+        if outcome.health < 0 and REGEN_TIMER in story.timers:
+            context.schedule(REGEN_TIMER, story.timers[REGEN_TIMER].delay)
+        if player_state['health'] == 0 and old_health > 0:
+            count_stat('deaths', scene_id)
+    
+    if experience:
+        context.add_experience(experience, name)
+    
+    for timer_id in outcome.schedule:
+        context.schedule(timer_id, story.timers[timer_id].delay)
+    
+    if 'inventory' in outcome.fields:
+        values['inventory'] = get_inventory_message(story, player_state['inventory'])
+    
+    return outcome.text.format(**values) if outcome.fields else outcome.text
 
-def scene_village_help(call):
-    """Offer help to the village"""
-    try:
-        msg = (
-            "Староста радостно улыбается: 'Ты готов помочь? В лесу завелась стая голодных волков, "
-            "они стали нападать на скот. Если ты справишься с ними, весь урожай этого года будет твоим.'\n\n"
-            "Вы соглашаетесь на задание и направляетесь в лес..."
-        )
-        
-        # Create new keyboard with choices
-        keyboard = types.InlineKeyboardMarkup()
-        btn1 = types.InlineKeyboardButton("Идти в лес", callback_data='go_to_wolves')
-        btn2 = types.InlineKeyboardButton("Отказаться от задания", callback_data='decline_quest')
-        
-        keyboard.row(btn1, btn2)
-        
-        bot.edit_message_text(
-            msg,
-            call.message.chat.id,
-            call.message.message_id,
-            reply_markup=keyboard
-        )
-    except Exception as e:
-        print(f"Error in scene_village_help: {e}")
+def run_encounter(story, context, encounter):
+    """
+    Roll a fight with the player's generator. Returns the outcome to apply
+    (the win with the monster's experience and a loot item, or the lose with
+    the monster's damage) and the values for its text.
+    """
+    inventory = context.state['inventory']
+    monster = context.roll(encounter.monsters)
+    attack = context.roll(encounter.attack) + sum(
+        bonus for item, bonus in encounter.bonuses.items() if item in inventory
+    )
+    values = {'monster': monster.name, 'roll': attack, 'grant_note': ''}
+    if attack < monster.defense:
+        return encounter.lose._replace(health=encounter.lose.health - context.roll(monster.damage)), values
+    
+    loot = context.roll(monster.loot) if monster.loot else None
+    item_name = story.item_names.get(loot, loot)
+    return encounter.win._replace(
+        grant=loot,
+        grant_notes=tuple(note.format(item=item_name) for note in encounter.win.grant_notes) if loot else (),
+        experience=encounter.win.experience + monster.experience
+    ), values
+
+def update_chat_id(raw_update):
+    """Extract the chat id from a raw update dict (None if the update has no chat)"""
+    for field in ('message', 'edited_message', 'channel_post', 'edited_channel_post'):
+        if field in raw_update:
+            return raw_update[field]['chat']['id']
+    callback_query = raw_update.get('callback_query')
+    if callback_query:
+        if 'message' in callback_query:
+            return callback_query['message']['chat']['id']
+        return callback_query['from']['id']
+    for field in ('my_chat_member', 'chat_member', 'chat_join_request'):
+        if field in raw_update:
+            return raw_update[field]['chat']['id']
+    return None
+
+def update_partition(raw_update, partitions):
+    """Pick a worker for an update; all updates of one chat go to the same worker"""
+    chat_id = update_chat_id(raw_update)
+    return abs(int(chat_id)) % partitions if chat_id is not None else 0
+
+def process_raw_update(raw_update):
+    """Run the registered handlers for one raw update in the calling thread"""
+    bot.process_new_updates([types.Update.de_json(raw_update)])
+
+def run_update_worker(index, queue):
+    """
+    Worker process: handle updates of its chat partition one at a time,
+    which keeps per-player ordering. Shutdown signals are left to the front
+    process, which stops the worker with a sentinel once its queue is drained.
+    """
+    global redis_client, redis_ring, EVENT_LOG_PATH
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    # Workers are spawned, not forked, so nothing of the parent is shared
+    redis_client, redis_ring = None, None
+    init_storage()
+    if not redis_client:
+        # In memory mode each worker logs (and compacts) only its own players
+        root, extension = os.path.splitext(EVENT_LOG_PATH)
+        EVENT_LOG_PATH = f'{root}.{index}{extension}'
+        load_event_log()
+    start_player_cache()
+    bot.threaded = False
+    start_story_reloading()
+    # Each worker sends its own notifications and fires timers (in memory
+    # mode the timers of its players are only in its own heap). With Redis a
+    # timer may belong to another worker's chat, hence SHARED_PLAYER_LOCKS
+    start_background_workers()
+    print(f"Worker {index} started (pid {os.getpid()})")
+    
+    while True:
+        item = queue.get()
+        if not isinstance(item, str):
+            # The stop sentinel carries the front's deadline as wall-clock time
+            shutdown_deadline(item - time.time())
+            break
+        try:
+            process_raw_update(json.loads(item))
+        except Exception as e:
+            print(f"Error in worker {index}: {e}")
+    shutdown_requested.set()
+    finish_shutdown()
+    print(f"Worker {index} stopped")
 
-def scene_check_inventory(call):
-    """Check player inventory"""
+def run_partitioned_polling(workers):
+    """
+    Front process: long-poll Telegram and fan raw updates out to worker
+    processes by chat id hash. A worker that dies is started again on its
+    queue. On shutdown the workers drain their queues before the handled
+    updates are confirmed to Telegram.
+    """
+    import multiprocessing
+    
+    # Spawned workers start clean: forking would copy the locks of this
+    # process's threads (health server, story watcher) in whatever state they are
+    spawn = multiprocessing.get_context('spawn')
+    queues = [None] * workers
+    started_at = [0.0] * workers
+    
+    def start_worker(index):
+        if queues[index] is not None:
+            # A worker killed inside get() keeps the queue's lock: the updates
+            # still queued are lost and the new worker gets a new queue
+            queues[index].cancel_join_thread()
+        queues[index] = spawn.Queue(maxsize=WORKER_QUEUE_SIZE)
+        process = spawn.Process(target=run_update_worker, args=(index, queues[index]), name=f'bot-worker-{index}')
+        process.start()
+        started_at[index] = time.monotonic()
+        return process
+    
+    def hand_over(index, item):
+        """Queue an update for a worker; False if shutdown came first"""
+        while not shutdown_requested.is_set():
+            if not processes[index].is_alive():
+                exit_code = processes[index].exitcode
+                if time.monotonic() - started_at[index] < WORKER_MIN_UPTIME:
+                    # Dying right after a start: restarting would only loop
+                    print(f"Worker {index} keeps dying (exit code {exit_code}), shutting down")
+                    shutdown_requested.set()
+                    return False
+                print(f"Worker {index} died (exit code {exit_code}), starting it again")
+                processes[index] = start_worker(index)
+            try:
+                queues[index].put(item, timeout=1)
+                return True
+            except Full:
+                continue
+        return False
+    
+    processes = [start_worker(index) for index in range(workers)]
+    
+    offset = None
     try:
-        player_state = get_player_state(call.message.chat.id)
-        inventory_msg = get_inventory_message(player_state['inventory'])
-        
-        msg = f"{inventory_msg}\n\nЧто вы хотите сделать дальше?"
-        
-        bot.edit_message_text(
-            msg,
-            call.message.chat.id,
-            call.message.message_id,
-            reply_markup=create_back_to_menu_keyboard()
-        )
-    except Exception as e:
-        print(f"Error in scene_check_inventory: {e}")
-
-def scene_puzzle_correct(call):
-    """Correct answer to the puzzle"""
+        while not shutdown_requested.is_set():
+            try:
+                raw_updates = apihelper.get_updates(BOT_TOKEN, offset, 100, 10, None, 5)
+            except Exception as e:
+                print(f"Error polling updates: {e}")
+                time.sleep(3)
+                continue
+            for raw_update in raw_updates:
+                if not hand_over(update_partition(raw_update, workers), json.dumps(raw_update, ensure_ascii=False)):
+                    break
+                # Only updates a worker got are confirmed; the rest come again after a restart
+                offset = raw_update['update_id'] + 1
+    finally:
+        deadline = shutdown_deadline()
+        drained = True
+        for queue in queues:
+            try:
+                queue.put(time.time() + deadline - time.monotonic(), timeout=max(0, deadline - time.monotonic()))
+            except Exception:
+                drained = False
+        for process in processes:
+            process.join(max(0, deadline - time.monotonic()))
+            if process.is_alive():
+                print(f"Worker {process.name} did not finish in time, terminating")
+                process.terminate()
+                process.join()
+                drained = False
+        if drained and offset:
+            confirm_updates(offset)
+
+def run_stream_ingest():
+    """
+    Ingest mode: long-poll Telegram and append raw updates to a Redis Stream.
+    The polling offset only advances after the updates are stored, so a crash
+    here makes Telegram deliver them again.
+    """
+    last_id_key = f'{UPDATE_STREAM}:last_update_id'
+    last_update_id = int(redis_client.get(last_id_key) or 0)
+    offset = last_update_id + 1 if last_update_id else None
+    last_report = time.monotonic()
+    
+    while not shutdown_requested.is_set():
+        try:
+            raw_updates = apihelper.get_updates(BOT_TOKEN, offset, 100, 10, None, 5)
+        except Exception as e:
+            print(f"Error polling updates: {e}")
+            time.sleep(3)
+            continue
+        
+        # Skip updates stored before a restart but not yet confirmed to Telegram
+        raw_updates = [u for u in raw_updates if u['update_id'] > last_update_id]
+        if raw_updates:
+            try:
+                pipe = redis_client.pipeline(transaction=False)
+                for raw_update in raw_updates:
+                    pipe.xadd(
+                        UPDATE_STREAM,
+                        {'update': json.dumps(raw_update, ensure_ascii=False)},
+                        maxlen=UPDATE_STREAM_MAXLEN,
+                        approximate=True
+                    )
+                last_update_id = raw_updates[-1]['update_id']
+                pipe.set(last_id_key, last_update_id)
+                pipe.execute()
+                offset = last_update_id + 1
+            except Exception as e:
+                print(f"Error appending updates to stream: {e}")
+                time.sleep(1)
+                continue
+        
+        # Report the backlog so lagging consumers are visible
+        if time.monotonic() - last_report >= 60:
+            last_report = time.monotonic()
+            try:
+                length = redis_client.xlen(UPDATE_STREAM)
+                pending = redis_client.xpending(UPDATE_STREAM, UPDATE_STREAM_GROUP)['pending']
+                print(f"Update stream: {length} entries, {pending} pending")
+            except Exception as e:
+                print(f"Error reading stream stats: {e}")
+
+def ensure_stream_group():
+    """Create the consumer group (and the stream) if they do not exist yet"""
     try:
-        # Add treasure to inventory
-        success = add_to_inventory(call.message.chat.id, 'Ключ от сокровищницы')
-        
-        msg = (
-            "Правильный ответ! Камень начинает светиться, и вы слышите щелчок. "
-            f"Из земли под вами появляется ключ. {'Вы добавляете ключ в инвентарь.' if success else 'У вас уже есть этот ключ.'}\n\n"
-            "Теперь вы можете открыть любую дверь в замке!"
-        )
-        
-        # Create new keyboard with choices
-        keyboard = types.InlineKeyboardMarkup()
-        btn1 = types.InlineKeyboardButton("Вернуться в деревню", callback_data='main_menu')
-        btn2 = types.InlineKeyboardButton("Проверить инвентарь", callback_data='check_inventory')
-        
-        keyboard.row(btn1, btn2)
-        
-        bot.edit_message_text(
-            msg,
-            call.message.chat.id,
-            call.message.message_id,
-            reply_markup=keyboard
-        )
-    except Exception as e:
-        print(f"Error in scene_puzzle_correct: {e}")
-
-def scene_puzzle_wrong(call):
-    """Wrong answer to the puzzle"""
+        redis_client.xgroup_create(UPDATE_STREAM, UPDATE_STREAM_GROUP, id='0', mkstream=True)
+    except redis.ResponseError as e:
+        if 'BUSYGROUP' not in str(e):
+            raise
+
+def handle_stream_entry(consumer, entry_id, fields):
+    """Handle one stream entry and acknowledge it if the update was handled"""
+    update_status.failed = False
     try:
-        msg = (
-            "Неправильный ответ! Камень начинает вибрировать, и вы чувствуете, как земля под вами начинает дрожать. "
-            "Вы спешите прочь от места, где стоял камень. Внезапно из-под земли вырастает стена из колючих кустов, "
-            "блокирующая дальнейший путь по тропе."
-        )
-        
-        bot.edit_message_text(
-            msg,
-            call.message.chat.id,
-            call.message.message_id,
-            reply_markup=create_back_to_menu_keyboard()
-        )
+        process_raw_update(json.loads(fields['update']))
     except Exception as e:
-        print(f"Error in scene_puzzle_wrong: {e}")
-
-def scene_battle_fight(call):
-    """Fight in battle"""
-    try:
-        player_state = get_player_state(call.message.chat.id)
-        
-        # Check if player has a sword
-        has_sword = 'Меч' in player_state['inventory']
-        
-        if has_sword:
-            msg = (
-                "Вы достаете меч и принимаете боевую стойку. Из кустов выходит огромный медведь! "
-                "Вы уверенно атакуете, и после ожесточенной битвы побеждаете зверя. "
-                "На его теле вы находите ценный амулет."
-            )
-            
-            # Add bear_amulet to inventory
-            success = add_to_inventory(call.message.chat.id, 'Амулет медведя')
+        print(f"Error in stream consumer {consumer}: {e}")
+        mark_update_failed()
+    
+    if not update_status.failed:
+        redis_client.xack(UPDATE_STREAM, UPDATE_STREAM_GROUP, entry_id)
+
+def claim_stale_entries(consumer):
+    """Take over entries left pending by consumers that died or stalled"""
+    stale = redis_client.xpending_range(
+        UPDATE_STREAM, UPDATE_STREAM_GROUP, min='-', max='+', count=100, idle=STREAM_CLAIM_IDLE_MS
+    )
+    retry_ids = []
+    for entry in stale:
+        if entry['times_delivered'] >= STREAM_MAX_DELIVERIES:
+            print(f"Dropping update {entry['message_id']} after {entry['times_delivered']} deliveries")
+            redis_client.xack(UPDATE_STREAM, UPDATE_STREAM_GROUP, entry['message_id'])
         else:
-            msg = (
-                "Вы пытаетесь сражаться, но у вас нет оружия! Медведь оказывается сильнее, "
-                "и вы получаете серьезные раны. С трудом убегая, вы возвращаетесь в деревню, чтобы восстановиться."
-            )
-            
-            # Decrease health
-            player_state['health'] = max(0, player_state['health'] - 30)
-        
-        bot.edit_message_text(
-            msg,
-            call.message.chat.id,
-            call.message.message_id,
-            reply_markup=create_back_to_menu_keyboard()
-        )
-    except Exception as e:
-        print(f"Error in scene_battle_fight: {e}")
-
-def scene_battle_run(call):
-    """Run from battle"""
-    try:
-        msg = (
-            "Вы быстро убегаете от зверя. К счастью, он не преследует вас дальше. "
-            "Вы возвращаетесь в деревню, тяжело дыша, но целы и невредимы."
-        )
-        
-        bot.edit_message_text(
-            msg,
-            call.message.chat.id,
-            call.message.message_id,
-            reply_markup=create_back_to_menu_keyboard()
-        )
-    except Exception as e:
-        print(f"Error in scene_battle_run: {e}")
-
-# Additional scenes for continuity
-def scene_drink_potion(call):
-    """Drink the potion found at the stream"""
-    try:
-        player_state = get_player_state(call.message.chat.id)
-        
-        # Increase health
-        old_health = player_state['health']
-        player_state['health'] = min(100, player_state['health'] + 20)
-        health_increase = player_state['health'] - old_health
-        
-        msg = f"Вы выпиваете зелье. Ваше здоровье восстанавливается на {health_increase}%."
-        
-        bot.edit_message_text(
-            msg,
-            call.message.chat.id,
-            call.message.message_id,
-            reply_markup=create_back_to_menu_keyboard()
-        )
-    except Exception as e:
-        print(f"Error in scene_drink_potion: {e}")
-
-def scene_continue_after_stream(call):
-    """Continue journey after finding the stream"""
-    try:
-        msg = (
-            "Вы продолжаете путь по лесу и вскоре находите заброшенную часовню. "
-            "Внутри вы видите алтарь с таинственным светом. На алтаре лежит свиток с заклинанием."
-        )
-        
-        # Add scroll to inventory
-        success = add_to_inventory(call.message.chat.id, 'Свиток заклинаний')
-        
-        bot.edit_message_text(
-            msg,
-            call.message.chat.id,
-            call.message.message_id,
-            reply_markup=create_back_to_menu_keyboard()
-        )
-    except Exception as e:
-        print(f"Error in scene_continue_after_stream: {e}")
-
-def scene_prepare_battle(call):
-    """Prepare for battle with the beast"""
-    try:
-        msg = (
-            "Вы готовитесь к бою. Из кустов выходит гигантский волк! Он оскалил зубы и готовится к атаке. "
-            "Теперь вы должны принять решение: сражаться или бежать?"
-        )
-        
-        bot.edit_message_text(
-            msg,
-            call.message.chat.id,
-            call.message.message_id,
-            reply_markup=create_battle_choice_keyboard()
-        )
-    except Exception as e:
-        print(f"Error in scene_prepare_battle: {e}")
-
-def scene_hide_from_beast(call):
-    """Hide from the beast"""
-    try:
-        msg = (
-            "Вы быстро прячетесь за деревом. Зверь несколько минут ищет вас, но затем уходит. "
-            "Вы благополучно возвращаетесь в деревню."
-        )
-        
-        bot.edit_message_text(
-            msg,
-            call.message.chat.id,
-            call.message.message_id,
-            reply_markup=create_back_to_menu_keyboard()
-        )
-    except Exception as e:
-        print(f"Error in scene_hide_from_beast: {e}")
+            retry_ids.append(entry['message_id'])
+    if not retry_ids:
+        return []
+    claimed = redis_client.xclaim(UPDATE_STREAM, UPDATE_STREAM_GROUP, consumer, STREAM_CLAIM_IDLE_MS, retry_ids)
+    # Before Redis 7 an entry trimmed from the stream comes back as
+    # (None, None). Its id stays pending, with one more delivery, so it is
+    # acknowledged above once it reaches STREAM_MAX_DELIVERIES.
+    return [(entry_id, fields) for entry_id, fields in claimed if entry_id is not None]
+
+def retry_stale_entries(consumer):
+    """Handle the entries claim_stale_entries took over"""
+    for entry_id, fields in claim_stale_entries(consumer):
+        if fields:
+            handle_stream_entry(consumer, entry_id, fields)
+        else:
+            # Trimmed from the stream, nothing left to retry
+            redis_client.xack(UPDATE_STREAM, UPDATE_STREAM_GROUP, entry_id)
 
-def scene_open_mystery_door(call):
-    """Open the mystery door in the castle"""
-    try:
-        player_state = get_player_state(call.message.chat.id)
-        
-        # Check if player has the key
-        has_key = 'Ключ от сокровищницы' in player_state['inventory']
-        
-        if has_key:
-            msg = (
-                "Вы используете найденный ключ, и дверь открывается! За ней находится сокровищница, "
-                "полная золота, драгоценных камней и магических артефактов. Вы нашли сокровища!"
-            )
+def run_stream_worker():
+    """
+    Stream worker mode: consume updates with XREADGROUP, acknowledge each one
+    after its handlers succeed and retry entries abandoned by other workers.
+    Start more workers to add consumers under load. On shutdown the entries
+    already read are finished and acknowledged before the loop exits.
+    """
+    consumer = f'{socket.gethostname()}-{os.getpid()}'
+    bot.threaded = False
+    ensure_stream_group()
+    print(f"Stream consumer {consumer} started")
+    
+    last_claim = 0
+    while not shutdown_requested.is_set():
+        try:
+            if time.monotonic() - last_claim >= STREAM_CLAIM_IDLE_MS / 1000:
+                last_claim = time.monotonic()
+                retry_stale_entries(consumer)
             
-            # Add treasure chest to inventory
-            success = add_to_inventory(call.message.chat.id, 'Сокровищница')
-        else:
-            msg = (
-                "Дверь заперта, и вы не можете найти способ открыть её. Вы возвращаетесь обратно."
+            response = redis_client.xreadgroup(
+                UPDATE_STREAM_GROUP, consumer, {UPDATE_STREAM: '>'}, count=10, block=2000
             )
-        
-        bot.edit_message_text(
-            msg,
-            call.message.chat.id,
-            call.message.message_id,
-            reply_markup=create_back_to_menu_keyboard()
-        )
-    except Exception as e:
-        print(f"Error in scene_open_mystery_door: {e}")
-
-def scene_inspect_room(call):
-    """Inspect the room in the castle"""
-    try:
-        msg = (
-            "Вы осматриваете комнату и находите старую книгу с заклинаниями. "
-            "На обложке написано 'Тайны Древнего Замка'. Вы добавляете книгу в инвентарь."
-        )
-        
-        # Add book to inventory
-        success = add_to_inventory(call.message.chat.id, 'Книга заклинаний')
-        
-        bot.edit_message_text(
-            msg,
-            call.message.chat.id,
-            call.message.message_id,
-            reply_markup=create_back_to_menu_keyboard()
-        )
-    except Exception as e:
-        print(f"Error in scene_inspect_room: {e}")
-
-def scene_go_downstairs(call):
-    """Go downstairs in the castle"""
-    try:
-        msg = (
-            "Вы спускаетесь по лестнице и попадаете в подземелье. Здесь темно и сыро. "
-            "На стенах горят факелы, отбрасывающие зловещие тени. "
-            "Вы слышите странные звуки из глубины подземелья."
-        )
-        
-        # Create new keyboard with choices
-        keyboard = types.InlineKeyboardMarkup()
-        btn1 = types.InlineKeyboardButton("Исследовать подземелье", callback_data='explore_dungeon')
-        btn2 = types.InlineKeyboardButton("Вернуться наверх", callback_data='go_upstairs')
-        
-        keyboard.row(btn1, btn2)
-        
-        bot.edit_message_text(
-            msg,
-            call.message.chat.id,
-            call.message.message_id,
-            reply_markup=keyboard
-        )
-    except Exception as e:
-        print(f"Error in scene_go_downstairs: {e}")
-
-def scene_hide_in_castle(call):
-    """Hide in the castle when hearing footsteps"""
-    try:
-        msg = (
-            "Вы быстро прячетесь за колонной. Проходит вооруженный стражник в старом доспехе. "
-            "Он осматривается, но не замечает вас. После того как он уходит, вы выходите из укрытия."
-        )
-        
-        bot.edit_message_text(
-            msg,
-            call.message.chat.id,
-            call.message.message_id,
-            reply_markup=create_back_to_menu_keyboard()
-        )
-    except Exception as e:
-        print(f"Error in scene_hide_in_castle: {e}")
-
-def scene_meet_guardian(call):
-    """Meet the guardian in the castle"""
-    try:
-        msg = (
-            "Вы решаете пойти навстречу. Перед вами появляется старый рыцарь в ржавом доспехе. "
-            "Это Древний Хранитель, о котором говорил староста! Он говорит: "
-            "'Ты проявил смелость, путешественник. Пройди испытание, и получишь награду.'"
-        )
-        
-        # Create new keyboard with choices
-        keyboard = types.InlineKeyboardMarkup()
-        btn1 = types.InlineKeyboardButton("Принять вызов", callback_data='accept_challenge')
-        btn2 = types.InlineKeyboardButton("Отказаться", callback_data='refuse_challenge')
-        
-        keyboard.row(btn1, btn2)
-        
-        bot.edit_message_text(
-            msg,
-            call.message.chat.id,
-            call.message.message_id,
-            reply_markup=keyboard
-        )
-    except Exception as e:
-        print(f"Error in scene_meet_guardian: {e}")
-
-def scene_take_scroll(call):
-    """Take the scroll from the altar"""
-    try:
-        # Add scroll to inventory
-        success = add_to_inventory(call.message.chat.id, 'Свиток древних знаний')
-        
-        msg = (
-            f"Вы берете свиток. На нем написаны древние символы, значение которых вам пока непонятно. "
-            f"{'Свиток добавлен в инвентарь.' if success else 'У вас уже есть этот свиток.'}"
-        )
-        
-        bot.edit_message_text(
-            msg,
-            call.message.chat.id,
-            call.message.message_id,
-            reply_markup=create_back_to_menu_keyboard()
-        )
-    except Exception as e:
-        print(f"Error in scene_take_scroll: {e}")
-
-def scene_examine_altar(call):
-    """Examine the altar"""
-    try:
-        msg = (
-            "Вы внимательно осматриваете алтарь. Он сделан из черного камня с серебряными вставками. "
-            "В центре находится круглое углубление, похоже, для какого-то артефакта. "
-            "На боковой стороне вы замечаете надпись: 'Только истинный герой может активировать меня.'"
-        )
-        
-        bot.edit_message_text(
-            msg,
-            call.message.chat.id,
-            call.message.message_id,
-            reply_markup=create_back_to_menu_keyboard()
-        )
-    except Exception as e:
-        print(f"Error in scene_examine_altar: {e}")
-
-def scene_leave_door(call):
-    """Leave the mysterious door"""
-    try:
-        msg = (
-            "Вы решаете не рисковать и покидаете комнату. Возвращаясь в замок, "
-            "вы чувствуете, что могли упустить важную возможность."
-        )
-        
-        bot.edit_message_text(
-            msg,
-            call.message.chat.id,
-            call.message.message_id,
-            reply_markup=create_back_to_menu_keyboard()
-        )
-    except Exception as e:
-        print(f"Error in scene_leave_door: {e}")
-
-def scene_thank_village_head(call):
-    """Thank the village head"""
-    try:
-        msg = (
-            "Староста тепло улыбается: 'Спасибо тебе, путешественник. Моя дверь всегда открыта для тебя. "
-            "Если понадобится помощь, обращайся.'\n\n"
-            "Вы чувствуете, что в деревне вас теперь принимают как своего."
-        )
-        
-        bot.edit_message_text(
-            msg,
-            call.message.chat.id,
-            call.message.message_id,
-            reply_markup=create_back_to_menu_keyboard()
-        )
-    except Exception as e:
-        print(f"Error in scene_thank_village_head: {e}")
-
-def scene_explore_outskirts(call):
-    """Explore outskirts after talking to village head"""
-    try:
-        msg = (
-            "Вы исследуете окрестности деревни и находите старую руину с таинственными символами. "
-            "Внутри вы видите алтарь, похожий на тот, что был в замке. "
-            "Кажется, эти два места связаны между собой."
-        )
-        
-        bot.edit_message_text(
-            msg,
-            call.message.chat.id,
-            call.message.message_id,
-            reply_markup=create_back_to_menu_keyboard()
-        )
-    except Exception as e:
-        print(f"Error in scene_explore_outskirts: {e}")
-
-def scene_go_to_wolves(call):
-    """Go to fight wolves for the village quest"""
-    try:
-        msg = (
-            "Вы отправляетесь в лес на поиски стаи волков. Вскоре вы находите их логово. "
-            "Перед вами пятеро крупных волков, которые замечают вас и начинают рычать. "
-            "Вам предстоит тяжелый бой..."
-        )
-        
-        # Create new keyboard with battle choices
-        bot.edit_message_text(
-            msg,
-            call.message.chat.id,
-            call.message.message_id,
-            reply_markup=create_battle_choice_keyboard()
-        )
-    except Exception as e:
-        print(f"Error in scene_go_to_wolves: {e}")
-
-def scene_decline_quest(call):
-    """Decline the village quest"""
-    try:
-        msg = (
-            "Вы вежливо отказываетесь от задания. Староста кивает: 'Я понимаю. "
-            "Но помни, что деревня всегда нуждается в храбрых людях.'\n\n"
-            "Вы возвращаетесь в главное меню."
-        )
-        
-        bot.edit_message_text(
-            msg,
-            call.message.chat.id,
-            call.message.message_id,
-            reply_markup=create_back_to_menu_keyboard()
-        )
-    except Exception as e:
-        print(f"Error in scene_decline_quest: {e}")
-
-def scene_explore_dungeon(call):
-    """Explore the dungeon"""
-    try:
-        msg = (
-            "Вы исследуете подземелье и находите несколько комнат. В одной из них лежит сундук, "
-            "в другой вы видите решетку, за которой слышится рычание. "
-            "Третья комната полностью пуста, но на полу вы замечаете странные символы."
-        )
-        
-        # Create new keyboard with choices
-        keyboard = types.InlineKeyboardMarkup()
-        btn1 = types.InlineKeyboardButton("Открыть сундук", callback_data='open_dungeon_chest')
-        btn2 = types.InlineKeyboardButton("Проверить решетку", callback_data='check_grate')
-        btn3 = types.InlineKeyboardButton("Изучить символы", callback_data='study_symbols')
-        
-        keyboard.row(btn1)
-        keyboard.row(btn2, btn3)
-        
-        bot.edit_message_text(
-            msg,
-            call.message.chat.id,
-            call.message.message_id,
-            reply_markup=keyboard
-        )
-    except Exception as e:
-        print(f"Error in scene_explore_dungeon: {e}")
-
-def scene_go_upstairs(call):
-    """Go upstairs from dungeon"""
-    try:
-        msg = (
-            "Вы поднимаетесь обратно наверх. Попав в главный зал замка, "
-            "вы чувствуете облегчение от покинутого мрачного подземелья."
-        )
-        
-        bot.edit_message_text(
-            msg,
-            call.message.chat.id,
-            call.message.message_id,
-            reply_markup=create_back_to_menu_keyboard()
-        )
-    except Exception as e:
-        print(f"Error in scene_go_upstairs: {e}")
-
-def scene_accept_challenge(call):
-    """Accept the guardian's challenge"""
-    try:
-        msg = (
-            "Древний Хранитель улыбается: 'Хорошо! Вот твое испытание: реши мою загадку, "
-            "и получишь величайшую награду.'\n\n"
-            "Загадка: 'Я могу быть разбит, но никогда не падаю. Я могу быть задан, но никогда не болен. Что я?'"
-        )
-        
-        # Create new keyboard with answer choices
-        keyboard = types.InlineKeyboardMarkup()
-        btn1 = types.InlineKeyboardButton("Сердце", callback_data='challenge_wrong')
-        btn2 = types.InlineKeyboardButton("Рекорд", callback_data='challenge_wrong')
-        btn3 = types.InlineKeyboardButton("Обещание", callback_data='challenge_correct')
-        
-        keyboard.row(btn1, btn2, btn3)
-        
-        bot.edit_message_text(
-            msg,
-            call.message.chat.id,
-            call.message.message_id,
-            reply_markup=keyboard
-        )
-    except Exception as e:
-        print(f"Error in scene_accept_challenge: {e}")
-
-def scene_refuse_challenge(call):
-    """Refuse the guardian's challenge"""
-    try:
-        msg = (
-            "Хранитель кивает: 'Ты выбрал безопасный путь, но возможно упустил великую возможность. "
-            "Мир не ждет героев, что боятся рисковать.'\n\n"
-            "Он исчезает в вихре теней, оставляя после себя лишь эхо смеха."
-        )
-        
-        bot.edit_message_text(
-            msg,
-            call.message.chat.id,
-            call.message.message_id,
-            reply_markup=create_back_to_menu_keyboard()
-        )
-    except Exception as e:
-        print(f"Error in scene_refuse_challenge: {e}")
-
-def scene_open_dungeon_chest(call):
-    """Open the dungeon chest"""
-    try:
-        # Add random treasure to inventory
-        success = add_to_inventory(call.message.chat.id, 'Драгоценный камень')
-        
-        msg = (
-            f"Вы открываете сундук и находите драгоценный камень, излучающий магический свет. "
-            f"{'Камень добавлен в инвентарь.' if success else 'У вас уже есть этот камень.'}"
-        )
-        
-        bot.edit_message_text(
-            msg,
-            call.message.chat.id,
-            call.message.message_id,
-            reply_markup=create_back_to_menu_keyboard()
-        )
-    except Exception as e:
-        print(f"Error in scene_open_dungeon_chest: {e}")
-
-def scene_check_grate(call):
-    """Check the grate in dungeon"""
-    try:
-        msg = (
-            "Вы подходите к решетке и видите за ней большую клетку. "
-            "Внутри сидит древний дракон, но он выглядит скорее усталым, чем злым. "
-            "Он говорит: 'Путешественник, если ты освободишь меня, я дам тебе мудрость веков.'"
-        )
-        
-        # Create new keyboard with choices
-        keyboard = types.InlineKeyboardMarkup()
-        btn1 = types.InlineKeyboardButton("Освободить дракона", callback_data='free_dragon')
-        btn2 = types.InlineKeyboardButton("Уйти", callback_data='leave_grate')
-        
-        keyboard.row(btn1, btn2)
-        
-        bot.edit_message_text(
-            msg,
-            call.message.chat.id,
-            call.message.message_id,
-            reply_markup=keyboard
-        )
-    except Exception as e:
-        print(f"Error in scene_check_grate: {e}")
-
-def scene_study_symbols(call):
-    """Study the symbols in dungeon"""
-    try:
-        msg = (
-            "Вы внимательно изучаете символы на полу. Они образуют магический круг. "
-            "Похоже, когда-то здесь происходили важные ритуалы. "
-            "Вы запоминаете расположение символов, возможно, это пригодится позже."
-        )
-        
-        # Add knowledge to inventory
-        success = add_to_inventory(call.message.chat.id, 'Знания о символах')
-        
-        bot.edit_message_text(
-            msg,
-            call.message.chat.id,
-            call.message.message_id,
-            reply_markup=create_back_to_menu_keyboard()
-        )
-    except Exception as e:
-        print(f"Error in scene_study_symbols: {e}")
-
-def scene_free_dragon(call):
-    """Free the dragon"""
-    try:
-        msg = (
-            "Вы находите механизм и открываете клетку. Дракон медленно поднимается и благодарит вас: "
-            "'Спасибо, храбрый путник. Я дарую тебе часть своей мудрости.'\n\n"
-            "Вы получаете артефакт древней магии!"
-        )
-        
-        # Add dragon artifact to inventory
-        success = add_to_inventory(call.message.chat.id, 'Артефакт дракона')
-        
-        bot.edit_message_text(
-            msg,
-            call.message.chat.id,
-            call.message.message_id,
-            reply_markup=create_back_to_menu_keyboard()
-        )
-    except Exception as e:
-        print(f"Error in scene_free_dragon: {e}")
-
-def scene_leave_grate(call):
-    """Leave the grate in dungeon"""
+            for _, entries in response:
+                for entry_id, fields in entries:
+                    handle_stream_entry(consumer, entry_id, fields)
+        except redis.ConnectionError as e:
+            print(f"Lost connection to Redis: {e}")
+            time.sleep(3)
+
+# Set once storage and the story are ready and updates are being received
+bot_ready = threading.Event()
+startup_seconds = None
+
+class HealthHandler(BaseHTTPRequestHandler):
+    """/healthz: the process is alive; /readyz: the bot is ready to handle updates"""
+    
+    def do_GET(self):
+        if self.path == '/healthz':
+            status, body = 200, {'alive': True}
+        elif self.path == '/readyz':
+            status = 200 if bot_ready.is_set() else 503
+            body = {
+                'ready': bot_ready.is_set(),
+                'storage': storage_mode,
+                'story_version': current_story.version,
+                'startup_seconds': startup_seconds
+            }
+        else:
+            status, body = 404, {'error': 'not found'}
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+    
+    def log_message(self, format, *args):
+        # Probes hit this every few seconds; keep them out of the log
+        pass
+
+def start_health_server():
+    """Serve the health and readiness probes in a background thread"""
+    if HEALTH_PORT <= 0:
+        return None
     try:
-        msg = (
-            "Вы решаете не связываться с драконом и покидаете эту часть подземелья. "
-            "За спиной слышится тяжелый вздох, но вы не оглядываетесь."
-        )
-        
-        bot.edit_message_text(
-            msg,
-            call.message.chat.id,
-            call.message.message_id,
-            reply_markup=create_back_to_menu_keyboard()
-        )
-    except Exception as e:
-        print(f"Error in scene_leave_grate: {e}")
+        server = ThreadingHTTPServer(('0.0.0.0', HEALTH_PORT), HealthHandler)
+    except OSError as e:
+        print(f"Health endpoint not started: {e}")
+        return None
+    threading.Thread(target=server.serve_forever, name='health-server', daemon=True).start()
+    print(f"Health endpoint listening on port {HEALTH_PORT}")
+    return server
+
+def mark_ready(storage_seconds):
+    """Flag the bot as ready and report how long the cold start took"""
+    global startup_seconds
+    startup_seconds = round(time.monotonic() - STARTED_AT, 3)
+    bot_ready.set()
+    print(f"Bot is ready in {startup_seconds:.2f}s (storage {storage_seconds:.2f}s, storage mode: {storage_mode})")
+
+# Flush callbacks run on shutdown after updates are drained, in registration order
+shutdown_hooks = []
+# Monotonic time by which the whole shutdown has to be done
+shutdown_deadline_at = None
+
+def register_shutdown_hook(hook):
+    """Run hook(seconds_left) on shutdown, before the storage connections are closed"""
+    shutdown_hooks.append(hook)
+
+def shutdown_deadline(timeout=SHUTDOWN_TIMEOUT):
+    """
+    The one deadline shared by every shutdown step, fixed the first time it
+    is asked for. Draining and the flush hooks only get what is left of it,
+    so together they stay within SHUTDOWN_TIMEOUT.
+    """
+    global shutdown_deadline_at
+    if shutdown_deadline_at is None:
+        shutdown_deadline_at = time.monotonic() + max(0, timeout)
+    return shutdown_deadline_at
 
-def scene_challenge_correct(call):
-    """Correct answer to the guardian's challenge"""
+def request_shutdown(signum, frame):
+    """
+    SIGTERM/SIGINT handler: stop taking new updates and let main() drain
+    the rest. A second signal stops waiting.
+    """
+    if shutdown_requested.is_set():
+        raise KeyboardInterrupt
+    print(f"Received {signal.Signals(signum).name}, shutting down (up to {SHUTDOWN_TIMEOUT:.0f}s)...")
+    shutdown_deadline()
+    shutdown_requested.set()
+    bot_ready.clear()
+    bot.stop_polling()
+
+def install_shutdown_handlers():
+    """Handle SIGTERM (docker stop, rolling restarts) and Ctrl+C gracefully"""
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, request_shutdown)
+        signal.signal(signal.SIGINT, request_shutdown)
+
+def drain_worker_pool(deadline):
+    """
+    Wait for the handler threads to finish the queued updates, then stop them.
+    Returns True if nothing was left behind.
+    """
+    pool = bot.worker_pool if bot.threaded else None
+    if not pool:
+        return True
+    while not pool.tasks.empty() and time.monotonic() < deadline:
+        time.sleep(0.1)
+    for worker in pool.workers:
+        worker.stop()
+    for worker in pool.workers:
+        worker.join(max(0, deadline - time.monotonic()))
+    left = pool.tasks.qsize() + sum(worker.is_alive() for worker in pool.workers)
+    if left:
+        print(f"Shutdown deadline reached with {left} updates still in progress")
+    return not left
+
+def confirm_updates(offset):
+    """
+    Confirm the handled updates to Telegram, so they are not delivered again
+    after a restart. Updates returned by this call stay unconfirmed.
+    """
     try:
-        msg = (
-            "Хранитель улыбается: 'Правильно! Обещание можно разбить, но нельзя упасть или заболеть. "
-            "Ты прошел испытание достойно!'\n\n"
-            "Он передает вам древний артефакт: 'Это Сердце Эльдории. Оно защитит тебя в пути.'"
-        )
-        
-        # Add heart artifact to inventory
-        success = add_to_inventory(call.message.chat.id, 'Сердце Эльдории')
-        
-        bot.edit_message_text(
-            msg,
-            call.message.chat.id,
-            call.message.message_id,
-            reply_markup=create_back_to_menu_keyboard()
-        )
+        apihelper.get_updates(BOT_TOKEN, offset, 1, 3, None, 1)
     except Exception as e:
-        print(f"Error in scene_challenge_correct: {e}")
+        print(f"Error confirming updates: {e}")
 
-def scene_challenge_wrong(call):
-    """Wrong answer to the guardian's challenge"""
-    try:
-        msg = (
-            "Хранитель качает головой: 'Неправильно, путешественник. Ты не готов к великим испытаниям.'\n\n"
-            "Он исчезает, оставляя вас одного в пустой комнате."
-        )
-        
-        bot.edit_message_text(
-            msg,
-            call.message.chat.id,
-            call.message.message_id,
-            reply_markup=create_back_to_menu_keyboard()
-        )
-    except Exception as e:
-        print(f"Error in scene_challenge_wrong: {e}")
+def close_storage():
+    """Close the Redis connection pools"""
+    global redis_client, redis_ring, storage_mode
+    for node in redis_nodes():
+        try:
+            node.close()
+        except Exception as e:
+            print(f"Error closing Redis connection: {e}")
+    redis_client, redis_ring = None, None
+    storage_mode = 'closed'
+
+def finish_shutdown():
+    """Run the flush hooks within the shutdown deadline, then close the storage connections"""
+    deadline = shutdown_deadline()
+    for hook in shutdown_hooks:
+        try:
+            hook(max(0, deadline - time.monotonic()))
+        except Exception as e:
+            print(f"Error in shutdown hook {getattr(hook, '__name__', hook)}: {e}")
+    close_storage()
 
 def main():
     """
     Main function to run the bot
-    Loads player data and starts polling
+    Connects storage, loads the story and starts polling
     """
     print("Starting Telegram RPG Adventure Bot...")
+    health_server = start_health_server()
+    install_shutdown_handlers()
+    
+    print(f"Token configured: {'Yes' if BOT_TOKEN != 'YOUR_BOT_TOKEN_HERE' else 'No (placeholder)'}")
+    if BOT_TOKEN == 'YOUR_BOT_TOKEN_HERE':
+        print("Set BOT_TOKEN or replace 'YOUR_BOT_TOKEN_HERE' with your actual bot token from @BotFather")
+    print(f"Story version {current_story.version} loaded from {STORY_PATH}")
     
-    print(f"Bot is ready! Token configured: {'Yes' if BOT_TOKEN != 'YOUR_BOT_TOKEN_HERE' else 'No (placeholder)'}")
-    print("Replace 'YOUR_BOT_TOKEN_HERE' with your actual bot token from @BotFather")
+    start_story_reloading()
     
-    # Start the bot with infinity polling
+    # Start the bot with infinity polling, or a polling front plus worker processes
     try:
-        bot.infinity_polling(timeout=10, long_polling_timeout=5)
+        storage_started = time.monotonic()
+        init_storage()
+        storage_seconds = time.monotonic() - storage_started
+        if shutdown_requested.is_set():
+            return
+        
+        if BOT_MODE in ('ingest', 'stream-worker') and not redis_client:
+            print(f"Mode '{BOT_MODE}' requires Redis")
+            return
+        # With worker processes the front only polls; the workers handle
+        # updates and run the sender and the timers
+        partitioned = BOT_MODE not in ('ingest', 'stream-worker') and BOT_WORKERS > 1
+        if not redis_client and not partitioned:
+            load_event_log()
+        if BOT_MODE != 'ingest' and not partitioned:
+            start_player_cache()
+            start_background_workers()
+        mark_ready(storage_seconds)
+        
+        if BOT_MODE == 'ingest':
+            print(f"Appending updates to Redis stream '{UPDATE_STREAM}'")
+            run_stream_ingest()
+        elif BOT_MODE == 'stream-worker':
+            run_stream_worker()
+        elif partitioned:
+            print(f"Running with {BOT_WORKERS} worker processes")
+            run_partitioned_polling(BOT_WORKERS)
+        else:
+            bot.infinity_polling(timeout=10, long_polling_timeout=5)
+            if drain_worker_pool(shutdown_deadline()) and bot.last_update_id:
+                confirm_updates(bot.last_update_id + 1)
     except KeyboardInterrupt:
         print("\nBot stopped by user")
     except Exception as e:
         print(f"Error running bot: {e}")
     finally:
+        bot_ready.clear()
+        finish_shutdown()
+        if health_server:
+            health_server.shutdown()
         print("Bot stopped.")
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,120 @@
+"""
+Tests of admin.py broadcasts against a fake send function and fakeredis:
+who gets the message, how failures are counted and how a rerun of a job
+resumes from its checkpoint.
+"""
+
+import io
+import json
+import os
+import sys
+import threading
+import unittest
+from contextlib import redirect_stderr
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telebot.apihelper import ApiTelegramException
+
+import admin
+import telegram_rpg_bot as rpg
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+
+def api_error(code, description):
+    return ApiTelegramException('sendMessage', None, {'error_code': code, 'description': description})
+
+
+class FakeSend:
+    """Records the chats it was called for; raises the error set for a chat"""
+
+    def __init__(self, errors=None):
+        self.errors = errors or {}
+        self.chats = []
+        self.lock = threading.Lock()
+
+    def __call__(self, chat_id, text):
+        with self.lock:
+            self.chats.append(chat_id)
+        if chat_id in self.errors:
+            raise self.errors[chat_id]
+        return True
+
+
+@unittest.skipIf(fakeredis is None, "fakeredis is not installed")
+class BroadcastTest(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = fakeredis.FakeRedis(decode_responses=True)
+        patcher = mock.patch.multiple(rpg, redis_client=self.redis, redis_ring=None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        for player in ('1', '2', '3', '4', '5', '-100:7', '-100:8'):
+            self.redis.set(rpg.player_key(player), json.dumps(rpg.initial_player_state()))
+
+    def broadcast(self, send, job='job', batch_size=1000):
+        with redirect_stderr(io.StringIO()):
+            return admin.run_broadcast('news', send, job, batch_size=batch_size, rate=1000, workers=2, progress_every=0)
+
+    def test_group_players_are_excluded(self):
+        send = FakeSend()
+        counts = self.broadcast(send)
+        self.assertEqual(sorted(send.chats), ['1', '2', '3', '4', '5'])
+        self.assertEqual(counts, {'sent': 5, 'blocked': 0, 'failed': 0, 'skipped': 0})
+
+    def test_legacy_key_player_is_messaged(self):
+        self.redis.set(rpg.legacy_player_key('6'), json.dumps(rpg.initial_player_state()))
+        send = FakeSend()
+        self.broadcast(send)
+        self.assertIn('6', send.chats)
+
+    def test_blocked_chat_is_remembered_and_skipped(self):
+        send = FakeSend({'2': api_error(403, 'Forbidden: bot was blocked by the user')})
+        counts = self.broadcast(send)
+        self.assertEqual(counts['blocked'], 1)
+        self.assertEqual(self.redis.smembers(rpg.BLOCKED_KEY), {'2'})
+
+        # A new job does not message the blocked chat again
+        send = FakeSend()
+        counts = self.broadcast(send, job='next')
+        self.assertNotIn('2', send.chats)
+        self.assertEqual(counts, {'sent': 4, 'blocked': 0, 'failed': 0, 'skipped': 1})
+
+    def test_message_error_is_a_failure(self):
+        send = FakeSend({'3': api_error(400, 'Bad Request: message is too long')})
+        counts = self.broadcast(send)
+        self.assertEqual(counts, {'sent': 4, 'blocked': 0, 'failed': 1, 'skipped': 0})
+        self.assertFalse(self.redis.exists(rpg.BLOCKED_KEY))
+
+    def test_gone_chat_is_blocked(self):
+        send = FakeSend({'4': api_error(400, 'Bad Request: chat not found')})
+        self.assertEqual(self.broadcast(send)['blocked'], 1)
+
+    def test_finished_job_is_not_sent_again(self):
+        self.broadcast(FakeSend())
+        send = FakeSend()
+        counts = self.broadcast(send)
+        self.assertEqual(send.chats, [])
+        self.assertEqual(counts['sent'], 5)
+
+    def test_rerun_resumes_from_cursor(self):
+        # An interrupted run: the first SCAN batch was sent and checkpointed
+        cursor, keys = self.redis.scan(0, match='player:*', count=3)
+        self.assertNotEqual(cursor, 0)
+        first = {rpg.player_key_chat_id(key) for key in keys} - {'-100:7', '-100:8'}
+        self.redis.hset('broadcast:{game}:job', mapping={'sent': len(first), 'cursor:0': cursor})
+
+        send = FakeSend()
+        counts = self.broadcast(send)
+        self.assertEqual(sorted(send.chats), sorted({'1', '2', '3', '4', '5'} - first))
+        self.assertEqual(counts['sent'], 5)
+        self.assertEqual(self.redis.hget('broadcast:{game}:job', 'done:0'), '1')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+"""
+Tests of the compact callback_data codec: packed buttons decode back to
+their choice, stay within Telegram's limit and reject stale or broken data.
+"""
+
+import base64
+import os
+import struct
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import telegram_rpg_bot as rpg
+
+# Telegram rejects buttons whose callback_data is longer than this (in bytes)
+CALLBACK_DATA_LIMIT = 64
+
+
+def pack(story, choice, nonce=None):
+    return rpg.pack_callback(story.callback_version, story.choice_list.index(choice), nonce)
+
+
+class CallbackCodecTest(unittest.TestCase):
+
+    def setUp(self):
+        self.story = rpg.current_story
+
+    def test_round_trip(self):
+        for choice in self.story.choice_list:
+            self.assertEqual(rpg.decode_callback(self.story, pack(self.story, choice)), (choice, None))
+        for nonce in (0, 1, 255, 256, rpg.MAX_CALLBACK_NONCE):
+            self.assertEqual(rpg.decode_callback(self.story, pack(self.story, 'main_menu', nonce)), ('main_menu', nonce))
+
+    def test_keyboards_carry_packed_choices(self):
+        keyboard = self.story.scenes['start'].keyboard.keyboard
+        choices = [rpg.decode_callback(self.story, button.callback_data)[0] for row in keyboard for button in row]
+        self.assertTrue(choices)
+        self.assertNotIn(None, choices)
+
+    def test_within_telegram_limit(self):
+        longest = rpg.pack_callback(0xFFFF, 0xFFFF, rpg.MAX_CALLBACK_NONCE)
+        self.assertLessEqual(len(longest.encode('utf-8')), CALLBACK_DATA_LIMIT)
+        for scene in self.story.scenes.values():
+            for row in scene.keyboard.keyboard:
+                for button in row:
+                    self.assertLessEqual(len(button.callback_data.encode('utf-8')), CALLBACK_DATA_LIMIT)
+
+    def test_unknown_version(self):
+        data = rpg.pack_callback((self.story.callback_version + 1) % 0x10000, 0)
+        self.assertEqual(rpg.decode_callback(self.story, data), (None, None))
+
+    def test_unknown_choice_id(self):
+        data = rpg.pack_callback(self.story.callback_version, len(self.story.choice_list))
+        self.assertEqual(rpg.decode_callback(self.story, data), (None, None))
+
+    def test_bad_nonce(self):
+        for nonce in (-1, rpg.MAX_CALLBACK_NONCE + 1):
+            with self.assertRaises(ValueError):
+                rpg.pack_callback(self.story.callback_version, 0, nonce)
+        # More than 4 nonce bytes never decode
+        packed = struct.pack('>HH', self.story.callback_version, 0) + b'\x01' * 5
+        data = base64.urlsafe_b64encode(packed).rstrip(b'=').decode('ascii')
+        self.assertEqual(rpg.decode_callback(self.story, data), (None, None))
+
+    def test_malformed_data(self):
+        for data in ('!!', 'a', 'AAA', '', None, 'not base64 at all'):
+            self.assertEqual(rpg.decode_callback(self.story, data), (None, None))
+
+    def test_legacy_choice_name(self):
+        # Buttons sent before the packing carry the choice name itself
+        self.assertEqual(rpg.decode_callback(self.story, 'choice_forest'), ('choice_forest', None))
+        self.assertEqual(rpg.decode_callback(self.story, 'no_such_choice'), (None, None))
+
+
+if __name__ == '__main__':
+    unittest.main()
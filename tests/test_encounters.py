@@ -0,0 +1,134 @@
+"""
+Tests of the seeded encounter rolls: the generator, the weighted tables and
+the battle_fight encounter, which must play out the same way for the same
+seed and inventory.
+"""
+
+import collections
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import telegram_rpg_bot as rpg
+
+SWORD = 'Меч'
+
+
+class EncounterTestCase(unittest.TestCase):
+    """Player contexts on the in-memory store with a fixed seed"""
+
+    def setUp(self):
+        patcher = mock.patch.multiple(rpg, redis_client=None, memory_players={})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def context(self, seed, inventory=()):
+        context = rpg.PlayerContext('7')
+        context.state.update(rng=seed, inventory=list(inventory))
+        return context
+
+
+class GeneratorTest(EncounterTestCase):
+
+    def test_splitmix64_reference_values(self):
+        # First outputs of splitmix64 seeded with 0
+        state, value = rpg.next_random(0)
+        self.assertEqual(value, 0xE220A8397B1DCDAF)
+        self.assertEqual(rpg.next_random(state)[1], 0x6E789E6AA1B965F4)
+
+    def test_weighted_table_covers_each_value_by_its_weight(self):
+        table = rpg.weighted_table([('a', 1), ('none', 0), ('b', 3), ('c', 2)], 'test')
+        self.assertEqual(table.values, ('a', 'b', 'c'))
+        draws = collections.Counter(table.values[rpg.bisect.bisect_right(table.cumulative, r)] for r in range(table.total))
+        self.assertEqual(draws, {'a': 1, 'b': 3, 'c': 2})
+
+    def test_weighted_table_rejects_bad_weights(self):
+        for entries in ([('a', -1)], [('a', 1.5)], [('a', 0)], []):
+            with self.assertRaises(ValueError):
+                rpg.weighted_table(entries, 'test')
+
+    def test_dice_distribution(self):
+        table = rpg.dice_table('2d6+1')
+        weights = dict(zip(table.values, (b - a for a, b in zip((0,) + table.cumulative, table.cumulative))))
+        self.assertEqual(table.total, 36)
+        self.assertEqual(weights, {3: 1, 4: 2, 5: 3, 6: 4, 7: 5, 8: 6, 9: 5, 10: 4, 11: 3, 12: 2, 13: 1})
+        for expression in ('d6', '0d6', '2d1', '21d6', '2d6*2'):
+            with self.assertRaises(ValueError):
+                rpg.dice_table(expression)
+
+    def test_draws_follow_the_weights(self):
+        context = self.context(seed=7)
+        table = rpg.weighted_table([('rare', 1), ('common', 9)], 'test')
+        draws = collections.Counter(context.roll(table) for _ in range(20000))
+        self.assertAlmostEqual(draws['rare'] / 20000, 0.1, delta=0.01)
+
+
+class BattleFightTest(EncounterTestCase):
+    """battle_fight with fixed seeds, with and without the sword"""
+
+    def fight(self, seed, inventory=()):
+        context = self.context(seed, inventory)
+        text = rpg.apply_scene(rpg.current_story, context, 'battle_fight', 'Tester')
+        return context, text
+
+    def test_wolf_beats_an_unarmed_player(self):
+        context, text = self.fight(2)
+        self.assertIn('гигантский волк', text)
+        self.assertIn('Бросок атаки: 7.', text)
+        self.assertEqual((context.state['health'], context.state['experience'], context.state['inventory']), (85, 0, []))
+
+    def test_sword_turns_the_same_roll_into_a_win(self):
+        # Same seed as above: the roll of 7 plus the sword's 8 beats the wolf's defense of 11
+        context, text = self.fight(2, [SWORD])
+        self.assertIn('Бросок атаки: 15.', text)
+        self.assertEqual((context.state['health'], context.state['experience']), (100, 15))
+        self.assertEqual(context.state['inventory'], [SWORD])
+
+    def test_bear(self):
+        context, text = self.fight(42)
+        self.assertIn('огромный медведь', text)
+        self.assertIn('Бросок атаки: 12.', text)
+        self.assertEqual((context.state['health'], context.state['experience']), (79, 0))
+
+        context, text = self.fight(42, [SWORD])
+        self.assertIn('Бросок атаки: 20.', text)
+        self.assertEqual(context.state['inventory'], [SWORD, 'Амулет медведя'])
+        self.assertEqual(context.state['health'], 100)
+
+    def test_same_seed_same_fight(self):
+        first = self.fight(123456789, [SWORD])
+        second = self.fight(123456789, [SWORD])
+        self.assertEqual(first[1], second[1])
+        self.assertEqual(first[0].state, second[0].state)
+
+    def test_generator_advances(self):
+        context, _ = self.fight(2)
+        # A lost fight draws the monster, the attack and the damage
+        state = 2
+        for _ in range(3):
+            state, _ = rpg.next_random(state)
+        self.assertEqual(context.state['rng'], state)
+
+    def test_reset_keeps_the_generator(self):
+        context, _ = self.fight(2)
+        rng = context.state['rng']
+        rpg.apply_scene(rpg.current_story, context, 'main_menu', 'Tester')
+        self.assertEqual(context.state['health'], 100)
+        self.assertEqual(context.state['rng'], rng)
+
+    def test_restored_save_replays_the_fight(self):
+        context = self.context(2)
+        saved = rpg.progress_state(context.state)
+        _, text = self.fight(2)
+
+        other = self.context(999)
+        rpg.restore_save(other, saved)
+        self.assertEqual(other.state['rng'], 2)
+        self.assertEqual(rpg.apply_scene(rpg.current_story, other, 'battle_fight', 'Tester'), text)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,188 @@
+"""
+Tests of the player progress log: an update appends one entry, the player
+record is only rewritten as a snapshot every EVENT_SNAPSHOT_EVERY entries,
+and reads (and admin.py exports) are the snapshot plus the entries after it.
+Without Redis the log file is read back on start and compacted.
+"""
+
+import collections
+import gzip
+import io
+import json
+import os
+import sys
+import tempfile
+import unittest
+from contextlib import redirect_stderr, redirect_stdout
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import telegram_rpg_bot as rpg
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+
+def update(player, **fields):
+    """Handle one update that changes the given fields; returns the committed state"""
+    context = rpg.PlayerContext(player)
+    for key, value in fields.items():
+        context.set(key, value)
+    context.record('scene', context.state['current_scene'])
+    context.commit()
+    return context.state
+
+
+@unittest.skipIf(fakeredis is None, "fakeredis is not installed")
+class RedisLogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = fakeredis.FakeRedis(decode_responses=True)
+        try:
+            self.redis.eval("return 1", 0)
+        except Exception:
+            self.skipTest("fakeredis has no Lua support")
+        patcher = mock.patch.multiple(
+            rpg, redis_client=self.redis, redis_ring=None, player_cache=collections.OrderedDict(),
+            read_player_script=None, log_update_script=None, EVENT_SNAPSHOT_EVERY=4
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def stored(self, player):
+        return json.loads(self.redis.get(rpg.player_key(player)))
+
+    def test_reads_apply_the_entries_after_the_snapshot(self):
+        first = update('7', current_scene='forest')
+        self.assertEqual(self.stored('7'), first)
+        latest = update('7', current_scene='castle', experience=10)
+        latest = update('7', health=70)
+        # The record is still the first snapshot; the read catches up
+        self.assertEqual(self.stored('7'), first)
+        self.assertEqual(rpg.read_player_state('7', cached=False), latest)
+        self.assertEqual(rpg.read_player_record('7', cached=False)[1], 2)
+        self.assertEqual(self.redis.xlen(rpg.player_key('7', 'events')), 3)
+
+    def test_entry_holds_the_changes_and_events(self):
+        update('7', current_scene='forest')
+        update('7', current_scene='castle')
+        _, entry = self.redis.xrange(rpg.player_key('7', 'events'))[-1]
+        self.assertEqual(json.loads(entry['s']), {'current_scene': 'castle'})
+        self.assertEqual(json.loads(entry['e']), [['scene', 'castle']])
+
+    def test_snapshot_every_n_entries(self):
+        for step in range(5):
+            state = update('7', experience=step)
+        # Entry 1 is a snapshot, 2-4 are past it and 5 is the next snapshot
+        self.assertEqual(self.stored('7'), state)
+        last_id = self.redis.xrange(rpg.player_key('7', 'events'))[-1][0]
+        self.assertEqual(self.redis.get(rpg.player_key('7', 'snapshotid')), last_id)
+        self.assertEqual(rpg.read_player_record('7', cached=False), (state, 0))
+
+    def test_removed_field(self):
+        update('7', party='-100:1')
+        context = rpg.PlayerContext('7')
+        del context.state['party']
+        context.changed = True
+        context.commit()
+        self.assertNotIn('party', rpg.read_player_state('7', cached=False))
+
+    def test_everything_expires_together(self):
+        update('7', current_scene='forest')
+        update('7', current_scene='castle')
+        for kind in ('player', 'snapshotid', 'events'):
+            self.assertEqual(self.redis.ttl(rpg.player_key('7', kind)), 86400)
+
+    def test_record_without_snapshot_id_is_whole(self):
+        # An imported record next to entries logged before the import
+        update('7', current_scene='forest')
+        update('7', current_scene='castle')
+        imported = dict(rpg.initial_player_state(), current_scene='cave')
+        self.redis.set(rpg.player_key('7'), json.dumps(imported))
+        self.redis.delete(rpg.player_key('7', 'snapshotid'))
+        self.assertEqual(rpg.read_player_record('7', cached=False), (imported, None))
+        # The next update stores a snapshot straight away
+        state = update('7', health=90)
+        self.assertEqual(self.stored('7'), state)
+
+    def test_export_import_round_trip(self):
+        import admin
+        update('7', current_scene='forest')
+        latest = update('7', current_scene='castle', experience=25)
+        with tempfile.TemporaryDirectory() as directory, redirect_stderr(io.StringIO()):
+            path = os.path.join(directory, 'players.ndjson.gz')
+            admin.export_players(path, progress_every=0)
+            with gzip.open(path, 'rt', encoding='utf-8') as exported:
+                self.assertEqual(json.loads(exported.readline())['state'], latest)
+            # Imported over newer progress, the entries logged since the export no longer apply
+            update('7', current_scene='cave')
+            admin.import_players(path, progress_every=0)
+        self.assertEqual(rpg.read_player_state('7', cached=False), latest)
+
+
+class FileLogTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'events.ndjson')
+        patcher = mock.patch.multiple(
+            rpg, redis_client=None, memory_players={}, event_counts={}, event_log_compacted_size=0,
+            EVENT_LOG_PATH=self.path, EVENT_SNAPSHOT_EVERY=4
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def restart(self):
+        states = dict(rpg.memory_players)
+        rpg.memory_players.clear()
+        rpg.event_counts.clear()
+        with redirect_stdout(io.StringIO()):
+            rpg.load_event_log()
+        return states
+
+    def lines(self):
+        with open(self.path, encoding='utf-8') as log_file:
+            return [json.loads(line) for line in log_file]
+
+    def test_restart_rebuilds_the_players(self):
+        for step in range(6):
+            update('7', experience=step)
+            update('8', health=100 - step)
+        context = rpg.PlayerContext('8')
+        del context.state['experience']
+        context.changed = True
+        context.commit()
+        before = self.restart()
+        self.assertEqual(rpg.memory_players, before)
+        self.assertEqual(rpg.event_counts, {'7': 1, '8': 2})
+
+    def test_broken_last_line_is_skipped(self):
+        update('7', experience=5)
+        with open(self.path, 'a', encoding='utf-8') as log_file:
+            log_file.write('{"c": "7", "s": {"exp')
+        self.assertEqual(self.restart(), rpg.memory_players)
+
+    def test_compacted_at_snapshot_time(self):
+        with mock.patch.object(rpg, 'EVENT_LOG_MAX_BYTES', 2000), redirect_stdout(io.StringIO()):
+            for step in range(40):
+                for player in ('7', '8', '9'):
+                    update(player, experience=step)
+        self.assertLess(len(self.lines()), 40)
+        self.assertLess(os.path.getsize(self.path), 2 * 2000)
+        self.assertEqual(self.restart(), rpg.memory_players)
+
+    def test_compaction_keeps_one_snapshot_per_player(self):
+        for step in range(3):
+            update('7', experience=step)
+            update('8', experience=step)
+        with rpg.event_log_lock, redirect_stdout(io.StringIO()):
+            rpg.compact_event_log()
+        self.assertEqual(self.lines(), [{'c': player, 'state': rpg.memory_players[player]} for player in ('7', '8')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,141 @@
+"""
+Tests of scene media against a fake bot: a file is uploaded once, later
+messages reuse its cached file_id, and a file_id Telegram rejects is
+dropped and the file uploaded again.
+"""
+
+import io
+import os
+import sys
+import types as pytypes
+import unittest
+from contextlib import redirect_stdout
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telebot import types
+from telebot.apihelper import ApiTelegramException
+
+import telegram_rpg_bot as rpg
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+
+def api_error(description):
+    return ApiTelegramException('sendPhoto', None, {'error_code': 400, 'description': description})
+
+
+class FakeBot:
+    """Records photo sends; an upload gets a new file_id, a file_id in `rejected` raises"""
+
+    def __init__(self, rejected=()):
+        self.rejected = set(rejected)
+        self.sent = []
+        self.edited = []
+        self.deleted = []
+
+    def photo_message(self, message_id, source):
+        if isinstance(source, str):
+            if source in self.rejected:
+                raise api_error('Bad Request: wrong file identifier/HTTP URL specified')
+            file_id = source
+        else:
+            file_id = f'file-{len(self.sent) + len(self.edited)}'
+        return types.Message.de_json({
+            'message_id': message_id, 'date': 0, 'chat': {'id': 1, 'type': 'private'},
+            'photo': [{'file_id': f'{file_id}-small', 'file_unique_id': 's', 'width': 90, 'height': 56},
+                      {'file_id': file_id, 'file_unique_id': 'o', 'width': 480, 'height': 300}]
+        })
+
+    def send_photo(self, chat_id, photo, caption=None, reply_markup=None):
+        message = self.photo_message(100 + len(self.sent), photo)
+        self.sent.append(photo if isinstance(photo, str) else 'upload')
+        return message
+
+    def edit_message_media(self, media, chat_id, message_id, reply_markup=None):
+        message = self.photo_message(message_id, media.media)
+        self.edited.append(media.media if isinstance(media.media, str) else 'upload')
+        return message
+
+    def delete_message(self, chat_id, message_id):
+        self.deleted.append(message_id)
+
+
+def callback(content_type='text', message_id=10):
+    message = pytypes.SimpleNamespace(chat=pytypes.SimpleNamespace(id=1), message_id=message_id, content_type=content_type)
+    return pytypes.SimpleNamespace(message=message)
+
+
+class MediaTest(unittest.TestCase):
+
+    def setUp(self):
+        self.bot = FakeBot()
+        patcher = mock.patch.multiple(rpg, bot=self.bot, redis_client=None, media_file_ids={})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.media = rpg.current_story.scenes['castle'].media
+
+    def show(self, call=None):
+        with redirect_stdout(io.StringIO()):
+            return rpg.show_media(call or callback(), 'Замок', None, self.media)
+
+    def test_story_has_media(self):
+        self.assertIsNotNone(self.media)
+        self.assertEqual(self.media.type, 'photo')
+        self.assertTrue(os.path.exists(self.media.path))
+
+    def test_uploaded_once_then_reused(self):
+        self.assertEqual(self.show(), 100)
+        self.assertEqual(self.bot.sent, ['upload'])
+        # The largest photo size is the file to reuse
+        self.assertEqual(rpg.media_file_ids[self.media.digest], 'file-0')
+        # The text message the scene replaced is deleted
+        self.assertEqual(self.bot.deleted, [10])
+
+        self.show()
+        self.assertEqual(self.bot.sent, ['upload', 'file-0'])
+
+    def test_media_message_is_edited_in_place(self):
+        rpg.media_file_ids[self.media.digest] = 'file-7'
+        self.assertEqual(self.show(callback('photo', message_id=42)), 42)
+        self.assertEqual(self.bot.edited, ['file-7'])
+        self.assertEqual((self.bot.sent, self.bot.deleted), ([], []))
+
+    def test_rejected_file_id_is_uploaded_again(self):
+        rpg.media_file_ids[self.media.digest] = 'stale'
+        self.bot.rejected.add('stale')
+        self.show()
+        self.assertEqual(self.bot.sent, ['upload'])
+        self.assertEqual(rpg.media_file_ids[self.media.digest], 'file-0')
+        self.show()
+        self.assertEqual(self.bot.sent, ['upload', 'file-0'])
+
+    def test_other_errors_keep_the_file_id(self):
+        rpg.media_file_ids[self.media.digest] = 'file-7'
+        with mock.patch.object(self.bot, 'send_photo', side_effect=api_error('Bad Request: message caption is too long')):
+            with self.assertRaises(ApiTelegramException):
+                self.show()
+        self.assertEqual(rpg.media_file_ids[self.media.digest], 'file-7')
+
+    @unittest.skipIf(fakeredis is None, "fakeredis is not installed")
+    def test_file_id_is_shared_through_redis(self):
+        redis = fakeredis.FakeRedis(decode_responses=True)
+        with mock.patch.object(rpg, 'redis_client', redis):
+            self.show()
+            self.assertEqual(redis.hget(rpg.MEDIA_KEY, self.media.digest), 'file-0')
+            # Another process, with nothing cached in memory, reuses it
+            rpg.media_file_ids.clear()
+            self.show()
+            self.assertEqual(self.bot.sent, ['upload', 'file-0'])
+
+            self.bot.rejected.add('file-0')
+            self.show()
+            self.assertEqual(redis.hget(rpg.MEDIA_KEY, self.media.digest), 'file-2')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,161 @@
+"""
+Tests of the party vote tally: majorities, changed votes and members who
+leave in the middle of a turn (taking turns with votes under the party
+lock). Each case runs on the in-memory tally and, when fakeredis (with Lua
+support) is installed, on the Redis scripts.
+"""
+
+import os
+import sys
+import threading
+import types
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import telegram_rpg_bot as rpg
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+
+class MemoryTallyTest(unittest.TestCase):
+    """The tally used without Redis"""
+
+    def setUp(self):
+        patcher = mock.patch.multiple(
+            rpg,
+            redis_client=None,
+            memory_parties={},
+            memory_votes={},
+            cast_vote_script=None,
+            withdraw_vote_script=None
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_majority_decides_once(self):
+        self.assertEqual(rpg.cast_vote('P', 0, 'a', 'forest', 2), (False, 1))
+        self.assertEqual(rpg.cast_vote('P', 0, 'b', 'forest', 2), (True, 2))
+        # A late vote for the decided choice does not decide it again
+        self.assertEqual(rpg.cast_vote('P', 0, 'c', 'forest', 2), (False, 3))
+
+    def test_repeated_vote(self):
+        rpg.cast_vote('P', 0, 'a', 'forest', 2)
+        self.assertEqual(rpg.cast_vote('P', 0, 'a', 'forest', 2), (False, -1))
+
+    def test_changed_vote_settles_a_split(self):
+        self.assertEqual(rpg.cast_vote('P', 0, 'a', 'forest', 2), (False, 1))
+        self.assertEqual(rpg.cast_vote('P', 0, 'b', 'castle', 2), (False, 1))
+        # 'b' comes round to the forest: their castle vote is taken back
+        self.assertEqual(rpg.cast_vote('P', 0, 'b', 'forest', 2), (True, 2))
+
+    def test_three_way_split(self):
+        for voter, choice in (('a', 'forest'), ('b', 'castle'), ('c', 'village')):
+            self.assertEqual(rpg.cast_vote('P', 0, voter, choice, 2), (False, 1))
+        self.assertEqual(rpg.cast_vote('P', 0, 'c', 'castle', 2), (True, 2))
+
+    def test_rounds_are_counted_apart(self):
+        rpg.cast_vote('P', 0, 'a', 'forest', 2)
+        self.assertEqual(rpg.cast_vote('P', 1, 'a', 'forest', 2), (False, 1))
+
+    def test_leaving_member_lets_the_rest_decide(self):
+        rpg.cast_vote('P', 0, 'a', 'forest', 2)
+        # 'b' leaves without voting: one vote is now a majority of one
+        self.assertEqual(rpg.withdraw_vote('P', 0, 'b', 1), 'forest')
+        # ... and only once
+        self.assertIsNone(rpg.withdraw_vote('P', 0, 'c', 1))
+
+    def test_leaving_member_takes_back_their_vote(self):
+        rpg.cast_vote('P', 0, 'a', 'forest', 3)
+        rpg.cast_vote('P', 0, 'b', 'castle', 3)
+        rpg.cast_vote('P', 0, 'c', 'castle', 3)
+        # 'c' leaves: castle is down to one vote of the two needed by three members
+        self.assertIsNone(rpg.withdraw_vote('P', 0, 'c', 2))
+        self.assertEqual(rpg.cast_vote('P', 0, 'd', 'castle', 2), (True, 2))
+
+    def test_leave_party_plays_the_decided_turn(self):
+        story = rpg.current_story
+        party_id = rpg.create_party(1, 10, 'text', story.locale)
+        rpg.add_party_member(party_id, 2, 20)
+        rpg.cast_vote(party_id, 0, '1', 'choice_forest', 2)
+
+        leaver = mock.Mock(chat_id='2', state={'party': party_id})
+        with mock.patch.object(rpg, 'outbound') as outbound:
+            self.assertEqual(rpg.leave_party(leaver, story), party_id)
+
+        state, members = rpg.load_party(party_id)
+        self.assertEqual(state['current_scene'], story.choices['choice_forest'])
+        self.assertEqual(state['round'], 1)
+        self.assertEqual(list(members), ['1'])
+        # The remaining member's message shows the new scene
+        self.assertEqual([call.args[0] for call in outbound.submit.call_args_list], [1])
+
+    def test_vote_waits_for_a_leave_to_play_its_turn(self):
+        story = rpg.current_story
+        party_id = rpg.create_party(1, 10, 'text', story.locale)
+        rpg.add_party_member(party_id, 2, 20)
+        rpg.cast_vote(party_id, 0, '1', 'choice_forest', 2)
+
+        # Member 2 leaves, which decides round 0; member 1 votes on from
+        # the forest while the leave is between the tally and the commit
+        withdrawn, resume = threading.Event(), threading.Event()
+        withdraw_vote = rpg.withdraw_vote
+
+        def slow_withdraw(*args):
+            choice = withdraw_vote(*args)
+            withdrawn.set()
+            resume.wait(5)
+            return choice
+
+        voter = mock.Mock(chat_id='1', state={'party': party_id})
+        call = types.SimpleNamespace(id='cb', from_user=types.SimpleNamespace(first_name='A'))
+        vote = threading.Thread(target=rpg.play_party_turn, args=(call, story, voter, 'forest_berries'))
+        with mock.patch.object(rpg, 'outbound'), mock.patch.object(rpg, 'bot') as bot, \
+                mock.patch.object(rpg, 'withdraw_vote', slow_withdraw):
+            leave = threading.Thread(target=rpg.leave_party, args=(mock.Mock(chat_id='2', state={'party': party_id}), story))
+            leave.start()
+            self.assertTrue(withdrawn.wait(5))
+            vote.start()
+            vote.join(0.2)
+            # Held back by the party lock
+            self.assertTrue(vote.is_alive())
+            resume.set()
+            leave.join(5)
+            vote.join(5)
+
+        # Each turn was played once, the vote from the state the leave left
+        state, members = rpg.load_party(party_id)
+        self.assertEqual((state['round'], state['current_scene']), (2, story.choices['forest_berries']))
+        self.assertEqual(list(members), ['1'])
+        bot.answer_callback_query.assert_called_once_with('cb')
+
+    def test_party_and_player_locks_are_apart(self):
+        # An update holds its player's lock while it takes the party's
+        with mock.patch.object(rpg, 'PLAYER_LOCK_TIMEOUT', 0.5):
+            for number in range(300):
+                with rpg.player_lock(str(number)), rpg.player_lock(rpg.party_target(f'{number:06X}')):
+                    pass
+
+
+@unittest.skipIf(fakeredis is None, "fakeredis is not installed")
+class RedisTallyTest(MemoryTallyTest):
+    """The same cases on the Lua scripts"""
+
+    def setUp(self):
+        super().setUp()
+        client = fakeredis.FakeRedis(decode_responses=True)
+        try:
+            client.eval("return 1", 0)
+        except Exception:
+            self.skipTest("fakeredis has no Lua support")
+        patcher = mock.patch.multiple(rpg, redis_client=client, redis_ring=None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,160 @@
+"""
+Tests of save slots: diff checkpoints fold back into the saved progress,
+slots start over after SAVE_CHAIN_LENGTH checkpoints, and admin.py export
+and import carry the saves:* lists. Each save case runs in memory and, when
+fakeredis (with Lua support) is installed, on Redis.
+"""
+
+import io
+import os
+import sys
+import tempfile
+import unittest
+from contextlib import redirect_stderr
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import telegram_rpg_bot as rpg
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+
+def progress_steps(count):
+    """A run of player states, each a little further than the one before"""
+    state = dict(rpg.initial_player_state(), rng=12345, locale='ru', message_id=10)
+    for step in range(count):
+        state = dict(state, inventory=list(state['inventory']))
+        state['current_scene'] = f'scene_{step % 4}'
+        state['health'] = 100 - step % 30
+        state['experience'] = step * 5
+        if step % 3 == 0:
+            state['inventory'].append(f'Предмет {step}')
+        if step == 5:
+            state['flag'] = True
+        if step == 9:
+            del state['flag']
+        yield state
+
+
+class MemorySavesTest(unittest.TestCase):
+    """Save slots without Redis"""
+
+    def setUp(self):
+        patcher = mock.patch.multiple(rpg, redis_client=None, memory_saves={}, append_save_script=None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def restored(self, slot):
+        progress, _ = rpg.read_saves('7', [slot])[slot]
+        progress.pop('saved_at')
+        return progress
+
+    def test_checkpoint_encodings(self):
+        previous = {'health': 100, 'inventory': []}
+        progress = {'health': 80, 'inventory': ['Меч'] * 200}
+        packed = rpg.pack_checkpoint(previous, progress)
+        # A long repetitive difference is stored compressed
+        self.assertTrue(packed.startswith('z'))
+        self.assertEqual(rpg.fold_checkpoints([rpg.pack_checkpoint({}, previous), packed]), progress)
+        small = rpg.pack_checkpoint(previous, {'health': 90})
+        self.assertTrue(small.startswith('{'))
+        self.assertEqual(rpg.unpack_checkpoint(small), {'s': {'health': 90}, 'd': ['inventory']})
+
+    def test_restore_after_diffs(self):
+        with mock.patch.object(rpg, 'SAVE_CHAIN_LENGTH', 100):
+            for count, state in enumerate(progress_steps(12), 1):
+                rpg.write_save('7', 1, state)
+                self.assertEqual(self.restored(1), rpg.progress_state(state))
+                self.assertEqual(rpg.read_saves('7', [1])[1][1], count)
+
+    def test_slots_are_separate(self):
+        states = list(progress_steps(6))
+        rpg.write_save('7', 1, states[2])
+        rpg.write_save('7', 2, states[5])
+        self.assertEqual(self.restored(1), rpg.progress_state(states[2]))
+        self.assertEqual(self.restored(2), rpg.progress_state(states[5]))
+        self.assertEqual(rpg.read_saves('7', [3])[3], (None, 0))
+
+    def test_session_fields_are_not_saved(self):
+        rpg.write_save('7', 1, next(progress_steps(1)))
+        for field in rpg.SESSION_FIELDS:
+            self.assertNotIn(field, self.restored(1))
+
+    def test_chain_starts_over_at_the_cap(self):
+        with mock.patch.object(rpg, 'SAVE_CHAIN_LENGTH', 4):
+            lengths = []
+            for state in progress_steps(10):
+                rpg.write_save('7', 1, state)
+                lengths.append(rpg.read_saves('7', [1])[1][1])
+            self.assertEqual(lengths, [1, 2, 3, 4, 1, 2, 3, 4, 1, 2])
+            # The compacted list starts with the whole progress
+            first = rpg.unpack_checkpoint(self.chain(1)[0])
+            self.assertEqual(first['s']['experience'], 40)
+            self.assertEqual(self.restored(1), rpg.progress_state(state))
+
+    def chain(self, slot):
+        return rpg.memory_saves[('7', slot)]
+
+
+@unittest.skipIf(fakeredis is None, "fakeredis is not installed")
+class RedisSavesTest(MemorySavesTest):
+    """The same cases on Redis lists and the append script"""
+
+    def setUp(self):
+        super().setUp()
+        self.redis = fakeredis.FakeRedis(decode_responses=True)
+        try:
+            self.redis.eval("return 1", 0)
+        except Exception:
+            self.skipTest("fakeredis has no Lua support")
+        patcher = mock.patch.multiple(rpg, redis_client=self.redis, redis_ring=None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def chain(self, slot):
+        return self.redis.lrange(rpg.saves_key('7', slot), 0, -1)
+
+    def test_slot_expires(self):
+        rpg.write_save('7', 1, next(progress_steps(1)))
+        self.assertEqual(self.redis.ttl(rpg.saves_key('7', 1)), rpg.SAVE_TTL_DAYS * 86400)
+
+    def test_changed_list_is_not_appended_to(self):
+        rpg.write_save('7', 1, next(progress_steps(1)))
+        key = rpg.saves_key('7', 1)
+        # Computed from an empty list, but the list has one checkpoint by now
+        self.assertEqual(rpg.append_save_script(keys=[key], args=[0, 1, '{"s":{}}', 60]), 0)
+        self.assertEqual(self.redis.llen(key), 1)
+
+    def test_export_import_round_trip(self):
+        import admin
+        states = list(progress_steps(5))
+        for state in states:
+            rpg.write_save('7', 1, state)
+        rpg.write_save('8', 0, states[1])
+        self.redis.set(rpg.player_key('7'), '{"current_scene": "start"}', ex=600)
+        chains = {key: self.redis.lrange(key, 0, -1) for key in self.redis.scan_iter(match='saves:*')}
+
+        with tempfile.TemporaryDirectory() as directory, redirect_stderr(io.StringIO()):
+            path = os.path.join(directory, 'players.ndjson.gz')
+            self.assertEqual(admin.export_players(path, progress_every=0), 3)
+            target = fakeredis.FakeRedis(decode_responses=True, server=fakeredis.FakeServer())
+            with mock.patch.object(rpg, 'redis_client', target):
+                # An existing slot is kept with --no-overwrite, replaced otherwise
+                target.rpush(rpg.saves_key('8', 0), 'kept')
+                admin.import_players(path, progress_every=0, overwrite=False)
+                self.assertEqual(target.lrange(rpg.saves_key('8', 0), 0, -1), ['kept'])
+                admin.import_players(path, progress_every=0)
+                for key, chain in chains.items():
+                    self.assertEqual(target.lrange(key, 0, -1), chain)
+                    self.assertGreater(target.ttl(key), rpg.SAVE_TTL_DAYS * 86400 - 60)
+                progress, _ = rpg.read_saves('7', [1])[1]
+        progress.pop('saved_at')
+        self.assertEqual(progress, rpg.progress_state(states[-1]))
+
+
+if __name__ == '__main__':
+    unittest.main()
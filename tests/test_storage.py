@@ -0,0 +1,140 @@
+"""
+Tests of the storage layout: hash tags, the client-side shard ring and the
+one-time move of players still stored under the legacy player:<id> key.
+"""
+
+import collections
+import io
+import json
+import os
+import sys
+import unittest
+from contextlib import redirect_stdout
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import telegram_rpg_bot as rpg
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+
+def ring_of(names):
+    return rpg.HashRing({name: name for name in names})
+
+
+class HashRingTest(unittest.TestCase):
+
+    def test_hash_tag(self):
+        self.assertEqual(rpg.key_hash_tag('player:{42}'), '42')
+        self.assertEqual(rpg.key_hash_tag('saves:{42}:1'), '42')
+        self.assertEqual(rpg.key_hash_tag('player:{-100:7}'), '-100:7')
+        self.assertEqual(rpg.key_hash_tag('player:42'), 'player:42')
+        self.assertEqual(rpg.key_hash_tag('odd:{}:key'), 'odd:{}:key')
+
+    def test_keys_of_one_player_share_a_node(self):
+        ring = ring_of(['a:6379', 'b:6379', 'c:6379'])
+        for player in ('1', '42', '-100:7', '123456789'):
+            kinds = ('player', 'events', 'snapshotid', 'debounce', 'lock', 'saves')
+            nodes = {ring.get_node(rpg.player_key(player, kind)) for kind in kinds}
+            nodes.add(ring.get_node(rpg.saves_key(player, 2)))
+            self.assertEqual(len(nodes), 1, player)
+
+    def test_mapping_is_stable(self):
+        # The same names give the same ring in every process
+        first, second = ring_of(['a:6379', 'b:6379']), ring_of(['a:6379', 'b:6379'])
+        for player in range(200):
+            key = rpg.player_key(player)
+            self.assertEqual(first.get_node(key), second.get_node(key))
+
+    def test_players_spread_over_nodes(self):
+        ring = ring_of(['a:6379', 'b:6379', 'c:6379'])
+        counts = collections.Counter(ring.get_node(rpg.player_key(player)) for player in range(6000))
+        for node in ('a:6379', 'b:6379', 'c:6379'):
+            self.assertGreater(counts[node], 1500)
+
+    def test_adding_a_node_moves_few_players(self):
+        before = ring_of(['a:6379', 'b:6379', 'c:6379'])
+        after = ring_of(['a:6379', 'b:6379', 'c:6379', 'd:6379'])
+        moved = 0
+        for player in range(4000):
+            key = rpg.player_key(player)
+            if before.get_node(key) != after.get_node(key):
+                # A player only ever moves to the new node
+                self.assertEqual(after.get_node(key), 'd:6379')
+                moved += 1
+        self.assertLess(moved, 4000 * 0.35)
+
+    def test_redis_for_uses_the_ring(self):
+        ring = ring_of(['a:6379', 'b:6379'])
+        with mock.patch.multiple(rpg, redis_client='primary', redis_ring=ring):
+            self.assertEqual(rpg.redis_for(rpg.player_key(5)), ring.get_node(rpg.player_key(5)))
+        with mock.patch.multiple(rpg, redis_client='primary', redis_ring=None):
+            self.assertEqual(rpg.redis_for(rpg.player_key(5)), 'primary')
+
+
+@unittest.skipIf(fakeredis is None, "fakeredis is not installed")
+class LegacyKeyTest(unittest.TestCase):
+    """Players saved as player:<id> before keys got a hash tag"""
+
+    def setUp(self):
+        self.redis = fakeredis.FakeRedis(decode_responses=True)
+        patcher = mock.patch.multiple(rpg, redis_client=self.redis, redis_ring=None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(rpg, 'player_cache', collections.OrderedDict())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.state = dict(rpg.initial_player_state(), current_scene='forest', experience=30)
+
+    def read(self, player):
+        with redirect_stdout(io.StringIO()):
+            return rpg.read_player_state(player, cached=False)
+
+    def test_legacy_state_is_moved_once(self):
+        self.redis.set(rpg.legacy_player_key('42'), json.dumps(self.state), px=5000000)
+        with mock.patch.object(rpg, 'migrate_legacy_player', wraps=rpg.migrate_legacy_player) as migrate:
+            self.assertEqual(self.read('42'), self.state)
+            self.assertEqual(self.read('42'), self.state)
+        self.assertEqual(migrate.call_count, 1)
+        self.assertFalse(self.redis.exists(rpg.legacy_player_key('42')))
+        self.assertEqual(json.loads(self.redis.get(rpg.player_key('42'))), self.state)
+        # The remaining lifetime goes along
+        self.assertTrue(4990000 < self.redis.pttl(rpg.player_key('42')) <= 5000000)
+
+    def test_current_key_wins(self):
+        newer = dict(self.state, current_scene='castle')
+        self.redis.set(rpg.player_key('42'), json.dumps(newer))
+        self.redis.set(rpg.legacy_player_key('42'), json.dumps(self.state))
+        self.assertEqual(self.read('42'), newer)
+        # Not even looked at while the current key exists
+        self.assertTrue(self.redis.exists(rpg.legacy_player_key('42')))
+        # A legacy copy that lost a race to a current write does not replace it
+        with redirect_stdout(io.StringIO()):
+            self.assertEqual(json.loads(rpg.migrate_legacy_player('42')), newer)
+        self.assertFalse(self.redis.exists(rpg.legacy_player_key('42')))
+
+    def test_new_player(self):
+        self.assertIsNone(self.read('43'))
+        self.assertFalse(self.redis.exists(rpg.player_key('43')))
+
+    def test_legacy_keys_are_read_from_the_primary_of_a_ring(self):
+        shards = {'a': self.redis, 'b': fakeredis.FakeRedis(decode_responses=True, server=fakeredis.FakeServer())}
+        ring = rpg.HashRing(shards)
+        self.redis.set(rpg.legacy_player_key('42'), json.dumps(self.state))
+        with mock.patch.object(rpg, 'redis_ring', ring):
+            self.assertEqual(self.read('42'), self.state)
+            self.assertTrue(ring.get_node(rpg.player_key('42')).exists(rpg.player_key('42')))
+        self.assertFalse(self.redis.exists(rpg.legacy_player_key('42')))
+
+    def test_chat_id_of_both_key_formats(self):
+        self.assertEqual(rpg.player_key_chat_id('player:{42}'), '42')
+        self.assertEqual(rpg.player_key_chat_id('player:{-100:7}'), '-100:7')
+        self.assertEqual(rpg.player_key_chat_id('player:42'), '42')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+"""
+Tests of how a stream worker takes over updates left pending by other
+workers, including entries trimmed from the stream in the meantime.
+"""
+
+import io
+import json
+import os
+import sys
+import unittest
+from contextlib import redirect_stdout
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import telegram_rpg_bot as rpg
+
+
+def pending(entry_id, times_delivered=1):
+    return {'message_id': entry_id, 'consumer': 'dead', 'time_since_delivered': 120000, 'times_delivered': times_delivered}
+
+
+class ClaimTest(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = mock.Mock()
+        patcher = mock.patch.multiple(rpg, redis_client=self.redis, STREAM_MAX_DELIVERIES=5)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def acked(self):
+        return [call.args[2] for call in self.redis.xack.call_args_list]
+
+    def retry(self, claimed):
+        self.redis.xclaim.return_value = claimed
+        with mock.patch.object(rpg, 'handle_stream_entry') as handle, redirect_stdout(io.StringIO()):
+            rpg.retry_stale_entries('me')
+        return [call.args[1] for call in handle.call_args_list]
+
+    def test_claimed_entries_are_handled(self):
+        self.redis.xpending_range.return_value = [pending('1-0'), pending('2-0')]
+        update = {'update': json.dumps({'update_id': 1})}
+        self.assertEqual(self.retry([('1-0', update), ('2-0', update)]), ['1-0', '2-0'])
+        self.assertEqual(self.redis.xclaim.call_args.args[4], ['1-0', '2-0'])
+        self.assertEqual(self.acked(), [])
+
+    def test_trimmed_entries(self):
+        self.redis.xpending_range.return_value = [pending('1-0'), pending('2-0'), pending('3-0')]
+        update = {'update': json.dumps({'update_id': 1})}
+        # Older Redis returns nil for an entry trimmed from the stream,
+        # newer ones the id without fields
+        self.assertEqual(self.retry([('1-0', update), (None, None), ('3-0', {})]), ['1-0'])
+        self.assertEqual(self.acked(), ['3-0'])
+
+    def test_entry_delivered_too_often_is_dropped(self):
+        self.redis.xpending_range.return_value = [pending('1-0', times_delivered=5)]
+        self.assertEqual(self.retry([]), [])
+        self.assertEqual(self.acked(), ['1-0'])
+        self.redis.xclaim.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()